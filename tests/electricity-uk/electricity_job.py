@@ -0,0 +1,94 @@
+import argparse
+from functools import reduce
+from operator import add
+
+from pyspark.sql import SparkSession
+from pyspark.sql.functions import col, lit, split
+from pyspark.sql.types import StructType, StructField, StringType, DoubleType, TimestampType
+
+# half-hourly reading columns of the data set: _00_30, _01_00, ..., _23_30, _24_00
+HALF_HOUR_COLUMNS = [f"_{minutes // 60:02d}_{minutes % 60:02d}" for minutes in range(30, 24 * 60 + 1, 30)]
+
+SCHEMA = StructType(
+    [
+        StructField("id", StringType()),
+        StructField("date", TimestampType()),
+        StructField("location", StringType()),
+        StructField("postcode", StringType()),
+        StructField("units", StringType()),
+        StructField("totalunits", DoubleType()),
+    ]
+    + [StructField(column, DoubleType()) for column in HALF_HOUR_COLUMNS]
+    + [
+        StructField("mpan", StringType()),
+        StructField("msid", StringType())
+    ]
+)
+
+
+def create_spark_session():
+    spark = SparkSession \
+        .builder \
+        .appName("electricity-uk") \
+        .getOrCreate()
+    return spark
+
+
+def read_electricity_data(spark, input_path):
+    """
+    Convenience wrapper function to get a read dataframe for the BANES electricity csv
+    :param spark: spark session to execute queries against
+    :param input_path: location of the csv file(s)
+    :return: spark dataframe with the readings typed after SCHEMA, no schema inference pass over the data
+    """
+    return spark.read \
+        .option("header", True) \
+        .schema(SCHEMA) \
+        .csv(input_path)
+
+
+def transform_electricity_data(electricity_df):
+    """
+    The function keeps the readings with a postcode, reduces the postcode to its district (the outward code, e.g. BS31)
+    and adds the day's total consumption summed over the half-hourly columns.
+    :param electricity_df: dataframe read by read_electricity_data
+    :return: transformed dataframe
+    """
+    # a single column expression folded over the typed columns, null if any of the readings is missing
+    total_consumption = reduce(add, [col(column) for column in HALF_HOUR_COLUMNS])
+
+    return electricity_df \
+        .where(col("postcode").isNotNull()) \
+        .withColumn("postcode", split(col("postcode"), " ").getItem(0)) \
+        .withColumn("Country", lit("United Kingdom")) \
+        .withColumn("total_consumption", total_consumption)
+
+
+def write_electricity_data(electricity_df, output_path):
+    """
+    The function writes the dataframe as parquet partitioned by postcode district. The rows are shuffled by district
+    first, so every district is written by one task in parallel with the others into a single file.
+    :param electricity_df: dataframe returned by transform_electricity_data
+    :param output_path: location of the parquet output
+    """
+    electricity_df \
+        .repartition("postcode") \
+        .write \
+        .mode("overwrite") \
+        .partitionBy("postcode") \
+        .parquet(output_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Totals the BANES electricity readings per day and meter")
+    parser.add_argument("--input", default="BANES Energy Data Electricity.csv", help="location of the csv file(s)")
+    parser.add_argument("--output", default="./country", help="location of the parquet output")
+    args = parser.parse_args()
+
+    spark = create_spark_session()
+    electricity_df = read_electricity_data(spark, args.input)
+    write_electricity_data(transform_electricity_data(electricity_df), args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,9 +2,11 @@ from datetime import datetime, timedelta
 import os
 from airflow import DAG
 from airflow.operators.dummy_operator import DummyOperator
+from airflow.operators.postgres_operator import PostgresOperator
+from airflow.operators.python_operator import PythonOperator, ShortCircuitOperator
 from airflow.operators import (StageToRedshiftOperator, LoadFactOperator,
                                LoadDimensionOperator, DataQualityOperator)
-from helpers import SqlQueries
+from helpers import SqlQueries, S3Partitions
 
 
 # AWS_KEY = os.environ.get('AWS_KEY')
@@ -63,10 +65,131 @@ def get_data_quality_test_cases():
                 ''',
             DataQualityOperator.TEST_EXPECTED_RESULT: 0,
             DataQualityOperator.TEST_ASSERTION_TYPE: DataQualityOperator.ASSERT_TRUE
+        },
+        {
+            DataQualityOperator.TEST_NAME: 'Songplays table should have data in it (from the table statistics)',
+            DataQualityOperator.TEST_METHOD: DataQualityOperator.TEST_METHOD_STATISTICS,
+            DataQualityOperator.TEST_TABLE: 'songplays',
+            DataQualityOperator.TEST_TOLERANCE: 0.1,
+            DataQualityOperator.TEST_EXPECTED_RESULT: 0,
+            DataQualityOperator.TEST_ASSERTION_TYPE: DataQualityOperator.ASSERT_MORE_THAN
+        },
+        {
+            DataQualityOperator.TEST_NAME: 'Songplays loaded by the run should always have a user',
+            DataQualityOperator.TEST_METHOD: DataQualityOperator.TEST_METHOD_PARTITION,
+            DataQualityOperator.TEST_TABLE: 'songplays',
+            DataQualityOperator.TEST_PARTITION_COLUMN: 'start_time',
+            DataQualityOperator.TEST_CONDITION: 'userid is null',
+            DataQualityOperator.TEST_EXPECTED_RESULT: 0,
+            DataQualityOperator.TEST_ASSERTION_TYPE: DataQualityOperator.ASSERT_TRUE
         }
     ]
 
 
+def create_partitioned_staging_tasks(dag, task_id, target_table, s3_bucket, s3_prefix, chunk_count, pool, **stage_kwargs):
+    """
+    Creates the tasks to stage the partitions of the DAG run's data interval with chunk_count concurrent COPY tasks:
+    1. The target table is truncated and the partition keys under s3_prefix are listed and split into chunks.
+    2. Each chunk is appended to the target table by its own StageToRedshiftOperator (chunks with no partitions are
+    skipped). The COPY tasks run in the given pool, so the number of concurrent COPYs on the cluster stays bounded.
+    :return: (first task, list of the COPY tasks)
+    """
+    list_partitions = PythonOperator(
+        task_id=f'{task_id}_list_partitions',
+        python_callable=S3Partitions.list_interval_chunks,
+        provide_context=True,
+        op_kwargs={
+            's3_bucket': s3_bucket,
+            's3_prefix': s3_prefix,
+            'aws_conn_id': stage_kwargs['aws_conn_id'],
+            'chunk_count': chunk_count
+        },
+        dag=dag
+    )
+
+    truncate_target = PostgresOperator(
+        task_id=f'{task_id}_truncate',
+        postgres_conn_id=stage_kwargs['redshift_conn_id'],
+        sql=f"TRUNCATE TABLE {target_table}",
+        dag=dag
+    )
+
+    copy_tasks = [
+        StageToRedshiftOperator(
+            task_id=f'{task_id}_chunk_{chunk}',
+            dag=dag,
+            pool=pool,
+            target_table=target_table,
+            s3_bucket=s3_bucket,
+            s3_key=s3_prefix,
+            load_mode=StageToRedshiftOperator.LOAD_MODE_APPEND,
+            partitions_task_id=list_partitions.task_id,
+            partition_chunk=chunk,
+            **stage_kwargs
+        )
+        for chunk in range(chunk_count)
+    ]
+
+    truncate_target >> list_partitions >> copy_tasks
+    return truncate_target, copy_tasks
+
+
+def create_dimension_tasks(dag, time_interval_column):
+    """
+    Creates the tasks loading the dimensions from the staging tables and the songplays fact.
+    :param time_interval_column: column restricting the time dimension upsert to the DAG run's data interval, None to
+    upsert the times of the whole fact.
+    :return: list of the dimension tasks, the users task first
+    """
+    # staging_events only holds the run's events, so the users are upserted rather than reloaded from them
+    load_user_dimension_table = LoadDimensionOperator(
+        task_id='Load_user_dim_table',
+        redshift_conn_id='redshift',
+        target_table='users',
+        load_dimension_sql_query=SqlQueries.user_table_insert,
+        load_mode=LoadDimensionOperator.LOAD_MODE_UPSERT,
+        key_column='userid',
+        dag=dag
+    )
+
+    load_song_dimension_table = LoadDimensionOperator(
+        task_id='Load_song_dim_table',
+        redshift_conn_id='redshift',
+        target_table='songs',
+        load_dimension_sql_query=SqlQueries.song_table_insert,
+        dag=dag
+    )
+
+    load_artist_dimension_table = LoadDimensionOperator(
+        task_id='Load_artist_dim_table',
+        redshift_conn_id='redshift',
+        target_table='artists',
+        load_dimension_sql_query=SqlQueries.artist_table_insert,
+        dag=dag
+    )
+
+    load_time_dimension_table = LoadDimensionOperator(
+        task_id='Load_time_dim_table',
+        redshift_conn_id='redshift',
+        target_table='time',
+        load_dimension_sql_query=SqlQueries.time_table_insert,
+        load_mode=LoadDimensionOperator.LOAD_MODE_UPSERT,
+        key_column='start_time',
+        interval_column=time_interval_column,
+        dag=dag
+    )
+
+    return [load_user_dimension_table, load_song_dimension_table, load_artist_dimension_table,
+            load_time_dimension_table]
+
+
+def is_last_backfill_batch(backfill_end, **context):
+    """
+    python_callable of the ShortCircuitOperator letting the dimension loads run only for the batch closing the range.
+    """
+    return context['next_execution_date'] >= backfill_end
+
+
 ####################################################################################################################
 #                                                                                                                  #
 #                                                     DAG arguments                                                #
@@ -99,13 +222,19 @@ dag = DAG('udac_example_dag',
 
 start_operator = DummyOperator(task_id='Begin_execution', dag=dag)
 
-stage_events_to_redshift = StageToRedshiftOperator(
-    task_id='Stage_events',
-    provide_context=False,
+# Log files are partitioned by day: log_data/{year}/{month}/{year}-{month}-{day}-events.json. The partitions of the
+# run's interval are copied by up to EVENTS_STAGING_CHUNKS tasks, at most as many at a time as the slots of the
+# redshift_copy pool (create it with `airflow pool -s redshift_copy 4 "Concurrent COPYs on the cluster"`).
+EVENTS_STAGING_CHUNKS = 4
+
+stage_events_start, stage_events_chunks = create_partitioned_staging_tasks(
     dag=dag,
+    task_id='Stage_events',
     target_table="staging_events",
     s3_bucket="udacity-dend",
-    s3_key="log_data",
+    s3_prefix="log_data",
+    chunk_count=EVENTS_STAGING_CHUNKS,
+    pool='redshift_copy',
     redshift_conn_id="redshift",
     aws_conn_id="aws_credentials",
     region="us-west-2",
@@ -130,40 +259,13 @@ load_songplays_table = LoadFactOperator(
     redshift_conn_id='redshift',
     target_table='songplays',
     load_fact_sql_query=SqlQueries.songplay_table_insert,
+    load_mode=LoadFactOperator.LOAD_MODE_DELETE_INSERT,
+    # the event chunks without partitions are skipped
+    trigger_rule='none_failed',
     dag=dag
 )
 
-load_user_dimension_table = LoadDimensionOperator(
-    task_id='Load_user_dim_table',
-    redshift_conn_id='redshift',
-    target_table='users',
-    load_dimension_sql_query=SqlQueries.user_table_insert,
-    dag=dag
-)
-
-load_song_dimension_table = LoadDimensionOperator(
-    task_id='Load_song_dim_table',
-    redshift_conn_id='redshift',
-    target_table='songs',
-    load_dimension_sql_query=SqlQueries.song_table_insert,
-    dag=dag
-)
-
-load_artist_dimension_table = LoadDimensionOperator(
-    task_id='Load_artist_dim_table',
-    redshift_conn_id='redshift',
-    target_table='artists',
-    load_dimension_sql_query=SqlQueries.artist_table_insert,
-    dag=dag
-)
-
-load_time_dimension_table = LoadDimensionOperator(
-    task_id='Load_time_dim_table',
-    redshift_conn_id='redshift',
-    target_table='time',
-    load_dimension_sql_query=SqlQueries.time_table_insert,
-    dag=dag
-)
+load_dimension_tables = create_dimension_tasks(dag, time_interval_column='start_time')
 
 run_quality_checks = DataQualityOperator(
     task_id='Run_data_quality_checks',
@@ -181,10 +283,99 @@ end_operator = DummyOperator(task_id='Stop_execution', dag=dag)
 ####################################################################################################################
 
 
-start_operator >> stage_events_to_redshift >> load_songplays_table
+start_operator >> stage_events_start
+stage_events_chunks >> load_songplays_table
 start_operator >> stage_songs_to_redshift >> load_songplays_table
-load_songplays_table >> load_user_dimension_table >> run_quality_checks
-load_songplays_table >> load_song_dimension_table >> run_quality_checks
-load_songplays_table >> load_artist_dimension_table >> run_quality_checks
-load_songplays_table >> load_time_dimension_table >> run_quality_checks
+load_songplays_table >> load_dimension_tables >> run_quality_checks
 run_quality_checks >> end_operator
+
+####################################################################################################################
+#                                                                                                                  #
+#                                                    Backfill DAG                                                  #
+#                                                                                                                  #
+####################################################################################################################
+
+# Loading the history with the hourly DAG takes a run per hour, each one staging the day's log file and reloading every
+# dimension. The backfill DAG coalesces the range into monthly batches instead:
+# 1. staging_events is loaded with a single COPY of the month's log_data/{year}/{month}/ prefix,
+# 2. the month's songplays are deleted and inserted in a single statement,
+# 3. the month's users are upserted, so the users table ends with the latest state of every user of the range,
+# 4. the other dimensions are loaded (and checked) only once, by the batch closing the range: songs and artists are
+# reloaded from the staged song data and the times of the whole fact are upserted, as the hourly runs leave them.
+# The batches share the staging tables, so they run one at a time.
+BACKFILL_START = datetime(2018, 11, 1)
+BACKFILL_END = datetime(2018, 12, 1)
+
+backfill_dag = DAG('udac_example_backfill_dag',
+                   default_args={
+                       **default_args,
+                       'start_date': BACKFILL_START,
+                       'end_date': BACKFILL_END - timedelta(microseconds=1)
+                   },
+                   catchup=True,
+                   max_active_runs=1,
+                   description='Load the history in monthly batches',
+                   schedule_interval='@monthly'
+                   )
+
+backfill_start_operator = DummyOperator(task_id='Begin_execution', dag=backfill_dag)
+
+backfill_stage_events_to_redshift = StageToRedshiftOperator(
+    task_id='Stage_events',
+    dag=backfill_dag,
+    target_table="staging_events",
+    s3_bucket="udacity-dend",
+    s3_key="log_data/{{ execution_date.strftime('%Y/%m') }}/",
+    redshift_conn_id="redshift",
+    aws_conn_id="aws_credentials",
+    region="us-west-2",
+    log_json_path='s3://udacity-dend/log_json_path.json'
+)
+
+backfill_stage_songs_to_redshift = StageToRedshiftOperator(
+    task_id='Stage_songs',
+    dag=backfill_dag,
+    target_table="staging_songs",
+    s3_bucket="udacity-dend",
+    s3_key="song_data",
+    redshift_conn_id="redshift",
+    aws_conn_id="aws_credentials",
+    region="us-west-2",
+    log_json_path='auto'
+)
+
+backfill_load_songplays_table = LoadFactOperator(
+    task_id='Load_songplays_fact_table',
+    redshift_conn_id='redshift',
+    target_table='songplays',
+    load_fact_sql_query=SqlQueries.songplay_table_insert,
+    load_mode=LoadFactOperator.LOAD_MODE_DELETE_INSERT,
+    dag=backfill_dag
+)
+
+backfill_is_last_batch = ShortCircuitOperator(
+    task_id='Is_last_batch',
+    python_callable=is_last_backfill_batch,
+    provide_context=True,
+    op_kwargs={'backfill_end': BACKFILL_END},
+    dag=backfill_dag
+)
+
+backfill_load_user_dimension_table, *backfill_load_dimension_tables = create_dimension_tasks(
+    backfill_dag, time_interval_column=None
+)
+
+backfill_run_quality_checks = DataQualityOperator(
+    task_id='Run_data_quality_checks',
+    redshift_conn_id='redshift',
+    test_cases=get_data_quality_test_cases(),
+    dag=backfill_dag
+)
+
+backfill_end_operator = DummyOperator(task_id='Stop_execution', dag=backfill_dag)
+
+backfill_start_operator >> [backfill_stage_events_to_redshift, backfill_stage_songs_to_redshift]
+[backfill_stage_events_to_redshift, backfill_stage_songs_to_redshift] >> backfill_load_songplays_table
+backfill_load_songplays_table >> backfill_load_user_dimension_table >> backfill_is_last_batch
+backfill_is_last_batch >> backfill_load_dimension_tables
+backfill_load_dimension_tables >> backfill_run_quality_checks >> backfill_end_operator
@@ -4,6 +4,7 @@ from airflow.plugins_manager import AirflowPlugin
 
 import operators
 import helpers
+import hooks
 
 # Defining the plugin class
 class UdacityPlugin(AirflowPlugin):
@@ -14,7 +15,11 @@ class UdacityPlugin(AirflowPlugin):
         operators.LoadDimensionOperator,
         operators.DataQualityOperator
     ]
+    hooks = [
+        hooks.RedshiftHook
+    ]
     helpers = [
         helpers.SqlQueries,
-        helpers.TestReference
+        helpers.TestReference,
+        helpers.S3Partitions
     ]
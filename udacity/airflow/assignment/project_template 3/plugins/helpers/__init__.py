@@ -1,7 +1,9 @@
 from helpers.sql_queries import SqlQueries
 from helpers.test_reference import TestReference
+from helpers.s3_partitions import S3Partitions
 
 __all__ = [
     'SqlQueries',
-    'TestReference'
+    'TestReference',
+    'S3Partitions'
 ]
\ No newline at end of file
@@ -0,0 +1,60 @@
+import os
+from datetime import timedelta
+
+from airflow.hooks.S3_hook import S3Hook
+
+
+class S3Partitions:
+    """
+    Helper to find the s3 keys of the daily partitions (prefix/{year}/{month}/{year}-{month}-{day}) covering a DAG
+    run's data interval and to spread them over a fixed number of staging tasks.
+    A local directory (file:///path) can be used instead of the bucket to test the listing without s3.
+    """
+    LOCAL_BUCKET_PREFIX = 'file://'
+
+    @staticmethod
+    def get_daily_prefixes(prefix, interval_start, interval_end):
+        day = interval_start.date()
+        last_day = (interval_end - timedelta(microseconds=1)).date()
+        prefixes = []
+        while day <= last_day:
+            prefixes.append(f"{prefix}/{day.strftime('%Y/%m')}/{day.isoformat()}")
+            day = day + timedelta(days=1)
+        return prefixes
+
+    @staticmethod
+    def list_keys(s3_bucket, prefixes, aws_conn_id):
+        if s3_bucket.startswith(S3Partitions.LOCAL_BUCKET_PREFIX):
+            return S3Partitions.__list_local_keys(s3_bucket[len(S3Partitions.LOCAL_BUCKET_PREFIX):], prefixes)
+        s3 = S3Hook(aws_conn_id=aws_conn_id)
+        keys = []
+        for prefix in prefixes:
+            keys.extend(s3.list_keys(bucket_name=s3_bucket, prefix=prefix) or [])
+        return sorted(keys)
+
+    @staticmethod
+    def split_into_chunks(keys, chunk_count):
+        """
+        Spreads the keys round-robin over chunk_count chunks, some of which may be empty.
+        """
+        return [keys[chunk::chunk_count] for chunk in range(chunk_count)]
+
+    @staticmethod
+    def list_interval_chunks(s3_bucket, s3_prefix, aws_conn_id, chunk_count, **context):
+        """
+        python_callable listing the partitions of the DAG run's data interval, split into chunk_count chunks.
+        The chunks are returned (and so pushed to XCom) for the StageToRedshiftOperator tasks to pull.
+        """
+        prefixes = S3Partitions.get_daily_prefixes(s3_prefix, context['execution_date'], context['next_execution_date'])
+        keys = S3Partitions.list_keys(s3_bucket, prefixes, aws_conn_id)
+        return S3Partitions.split_into_chunks(keys, chunk_count)
+
+    @staticmethod
+    def __list_local_keys(directory, prefixes):
+        keys = []
+        for root, _, file_names in os.walk(directory):
+            for file_name in file_names:
+                key = os.path.relpath(os.path.join(root, file_name), directory).replace(os.sep, '/')
+                if any(key.startswith(prefix) for prefix in prefixes):
+                    keys.append(key)
+        return sorted(keys)
@@ -19,10 +19,14 @@ class SqlQueries:
                 AND events.length = songs.duration
     """)
 
+    # the latest event of a user sets its level
     user_table_insert = ("""
-        SELECT distinct userid, firstname, lastname, gender, level
-        FROM staging_events
-        WHERE page='NextSong'
+        SELECT userid, firstname, lastname, gender, level
+        FROM (SELECT userid, firstname, lastname, gender, level,
+                     ROW_NUMBER() OVER (PARTITION BY userid ORDER BY ts DESC) AS event_rank
+            FROM staging_events
+            WHERE page='NextSong' AND userid IS NOT NULL) user_events
+        WHERE event_rank = 1
     """)
 
     song_table_insert = ("""
@@ -36,7 +40,8 @@ class SqlQueries:
     """)
 
     time_table_insert = ("""
-        SELECT start_time, extract(hour from start_time), extract(day from start_time), extract(week from start_time), 
-               extract(month from start_time), extract(year from start_time), extract(dayofweek from start_time)
+        SELECT start_time, extract(hour from start_time) AS hour, extract(day from start_time) AS day,
+               extract(week from start_time) AS week, extract(month from start_time) AS month,
+               extract(year from start_time) AS year, extract(dayofweek from start_time) AS weekday
         FROM songplays
     """)
\ No newline at end of file
@@ -1,35 +1,72 @@
-from airflow.hooks.postgres_hook import PostgresHook
+import queue
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 from airflow.models import BaseOperator
 from airflow.utils.decorators import apply_defaults
 
+from operators.telemetry_mixin import TelemetryMixin
+
 
-class DataQualityOperator(BaseOperator):
+class DataQualityOperator(TelemetryMixin, BaseOperator):
 
     ui_color = '#89DA59'
-    
+
     TEST_NAME = "testName"
     TEST_QUERY = "testQuery"
     TEST_EXPECTED_RESULT = "testExpectedResult"
     TEST_ASSERTION_TYPE = 'assertionType'
+    # Optional keys of the test cases that are not answered with TEST_QUERY, see the TEST_METHOD_* values.
+    TEST_METHOD = 'testMethod'
+    TEST_TABLE = 'testTable'
+    TEST_CONDITION = 'testCondition'
+    TEST_TOLERANCE = 'testTolerance'
+    TEST_SAMPLE_PERCENT = 'testSamplePercent'
+    TEST_SAMPLE_KEY = 'testSampleKey'
+    TEST_PARTITION_COLUMN = 'testPartitionColumn'
 
     ASSERT_TRUE = '='
     ASSERT_FALSE = '!='
     ASSERT_LESS_THAN = '<'
     ASSERT_MORE_THAN = '>'
 
+    # The result of TEST_QUERY is compared exactly.
+    TEST_METHOD_EXACT = 'exact'
+    # The row count of TEST_TABLE is taken from the table statistics (svv_table_info on redshift, pg_class on postgres)
+    # without scanning the table. A table without statistics row (empty on redshift, missing) or never analyzed on
+    # postgres fails the test case.
+    TEST_METHOD_STATISTICS = 'statistics'
+    # The count of the TEST_TABLE rows matching TEST_CONDITION is estimated from a TEST_SAMPLE_PERCENT sample of the
+    # table (rows picked by a hash of TEST_SAMPLE_KEY on redshift, TABLESAMPLE on postgres).
+    TEST_METHOD_SAMPLE = 'sample'
+    # The TEST_TABLE rows matching TEST_CONDITION are only counted in the DAG run's data interval of
+    # TEST_PARTITION_COLUMN.
+    TEST_METHOD_PARTITION = 'partition'
+
 
     __TEST_SUCCESS = 'Success'
     __TEST_MESSAGE = 'Message'
+    __TEST_SECONDS = 'Seconds'
+    __TEST_BATCH_SIZE = 'BatchSize'
+
+    # Test queries of the form "select count(1) from <table> [where <condition>]" are combined into one scan per table.
+    __COUNT_QUERY_PATTERN = re.compile(
+        r'^\s*select\s+count\(\s*(?:1|\*)\s*\)\s+from\s+([\w."]+)(?:\s+where\s+(.+?))?\s*;?\s*$',
+        re.IGNORECASE | re.DOTALL
+    )
 
     @apply_defaults
     def __init__(self,
                  redshift_conn_id,
                  test_cases,
+                 max_connections=4,
                  *args, **kwargs):
 
         super(DataQualityOperator, self).__init__(*args, **kwargs)
         self.__redshift_conn_id = redshift_conn_id
         self.__test_cases = test_cases
+        self.__max_connections = max_connections
 
         self.__assertions = {
                 DataQualityOperator.ASSERT_TRUE: DataQualityOperator.__assert_true,
@@ -41,10 +78,32 @@ class DataQualityOperator(BaseOperator):
 
     def execute(self, context):
         self.log.info('executing DataQualityOperator')
-        redshift = PostgresHook(postgres_conn_id=self.__redshift_conn_id)
-        test_results = []
-        for test_case in self.__test_cases:
-            test_results.append(self.__run_test(test_case, redshift))
+        with self.get_redshift_hook(self.__redshift_conn_id) as redshift:
+            test_groups = self.__group_test_cases(context, redshift.is_redshift())
+            self.log.info(f"running {len(self.__test_cases)} test cases as {len(test_groups)} queries")
+
+            # the hook's connection is the first of the pool, the others are opened with the same session settings
+            connections = queue.Queue()
+            connections.put(redshift.get_conn())
+            extra_connections = []
+            try:
+                for _ in range(min(self.__max_connections, len(test_groups)) - 1):
+                    conn = redshift.open_conn()
+                    extra_connections.append(conn)
+                    connections.put(conn)
+
+                with ThreadPoolExecutor(max_workers=len(extra_connections) + 1) as executor:
+                    group_results = list(executor.map(
+                        lambda test_group: self.__run_test_group(test_group, connections, redshift), test_groups
+                    ))
+            finally:
+                for conn in extra_connections:
+                    conn.close()
+
+        test_results = [result for _, result in sorted(
+            (indexed_result for group_result in group_results for indexed_result in group_result),
+            key=lambda indexed_result: indexed_result[0]
+        )]
 
         failed_tests = list(filter(lambda tr: tr[self.__TEST_SUCCESS] is False, test_results))
         successful_tests = list(filter(lambda tr: tr[self.__TEST_SUCCESS] is True, test_results))
@@ -60,30 +119,151 @@ class DataQualityOperator(BaseOperator):
     #                                                                                                                  #
     ####################################################################################################################
 
-    def __run_test(self, test_case, redshift):
-        result = redshift.get_records(test_case[DataQualityOperator.TEST_QUERY])
+    def __group_test_cases(self, context, is_redshift):
+        """
+        Groups the test cases into queries: the exact count test cases against the same table become the columns of a
+        single select, any other test case is run on its own.
+        :return: list of (query, [(test case index, test case)])
+        """
+        count_groups = {}
+        test_groups = []
+        for index, test_case in enumerate(self.__test_cases):
+            method = test_case.get(DataQualityOperator.TEST_METHOD, DataQualityOperator.TEST_METHOD_EXACT)
+            if method != DataQualityOperator.TEST_METHOD_EXACT:
+                test_groups.append((self.__get_estimate_query(test_case, method, context, is_redshift),
+                                    [(index, test_case)]))
+                continue
+            match = DataQualityOperator.__COUNT_QUERY_PATTERN.match(test_case[DataQualityOperator.TEST_QUERY])
+            if match:
+                table, condition = match.group(1), match.group(2)
+                count_groups.setdefault(table.lower(), (table, []))[1].append((index, test_case, condition))
+            else:
+                test_groups.append((test_case[DataQualityOperator.TEST_QUERY], [(index, test_case)]))
+
+        for table, count_test_cases in count_groups.values():
+            columns = ',\n'.join(
+                f"count(CASE WHEN {condition} THEN 1 END)" if condition else "count(*)"
+                for _, _, condition in count_test_cases
+            )
+            test_groups.append((f"SELECT {columns}\nFROM {table}",
+                                [(index, test_case) for index, test_case, _ in count_test_cases]))
+        return test_groups
+
+    @staticmethod
+    def __get_estimate_query(test_case, method, context, is_redshift):
+        """
+        Builds the query answering a test case from the table statistics, a sample or the run's partition.
+        """
+        table = test_case[DataQualityOperator.TEST_TABLE]
+        condition = test_case.get(DataQualityOperator.TEST_CONDITION)
+        matching_rows = f"count(CASE WHEN {condition} THEN 1 END)" if condition else "count(*)"
+
+        if method == DataQualityOperator.TEST_METHOD_STATISTICS:
+            if condition:
+                raise ValueError(f"{DataQualityOperator.TEST_CONDITION} is not supported by the statistics method")
+            if is_redshift:
+                return f"SELECT tbl_rows FROM svv_table_info WHERE \"table\" = '{table}'"
+            # reltuples is -1 (0 before Postgres 14) until the table is first vacuumed or analyzed, such a table
+            # gets a null row count and fails the test case instead of passing it with a made up count
+            return f"""
+                SELECT CASE WHEN c.reltuples >= 0 AND COALESCE(
+                    s.last_analyze, s.last_autoanalyze, s.last_vacuum, s.last_autovacuum
+                ) IS NOT NULL THEN c.reltuples::bigint END
+                FROM pg_class c
+                LEFT JOIN pg_stat_user_tables s ON s.relid = c.oid
+                WHERE c.relname = '{table}'
+            """
+
+        if method == DataQualityOperator.TEST_METHOD_SAMPLE:
+            percent = test_case.get(DataQualityOperator.TEST_SAMPLE_PERCENT, 1)
+            if is_redshift:
+                return f"""
+                    SELECT {matching_rows} * 100.0 / {percent}
+                    FROM {table}
+                    WHERE MOD(ABS(FNV_HASH({test_case[DataQualityOperator.TEST_SAMPLE_KEY]})), 10000) < {percent * 100}
+                """
+            return f"SELECT {matching_rows} * 100.0 / {percent} FROM {table} TABLESAMPLE SYSTEM ({percent})"
+
+        if method == DataQualityOperator.TEST_METHOD_PARTITION:
+            partition_column = test_case[DataQualityOperator.TEST_PARTITION_COLUMN]
+            return f"""
+                SELECT {matching_rows}
+                FROM {table}
+                WHERE {partition_column} >= '{context['execution_date'].strftime('%Y-%m-%d %H:%M:%S')}'
+                AND {partition_column} < '{context['next_execution_date'].strftime('%Y-%m-%d %H:%M:%S')}'
+            """
 
+        raise ValueError(f"Unknown test method {method}")
+
+    def __run_test_group(self, test_group, connections, redshift):
+        query, indexed_test_cases = test_group
+        conn = connections.get()
+        try:
+            start = time.time()
+            cursor = conn.cursor()
+            cursor.execute(query)
+            result = cursor.fetchone()
+            conn.commit()
+            seconds = round(time.time() - start, 3)
+            redshift.record_statement(query, seconds, cursor.rowcount)
+        except Exception:
+            # the connection goes back to the pool, the next test group must not get it in an aborted transaction
+            conn.rollback()
+            raise
+        finally:
+            connections.put(conn)
+
+        # a query without row (e.g. the statistics of an empty or missing table) gives no result to every test case
+        if result is None:
+            result = [None] * len(indexed_test_cases)
+        return [
+            (index, self.__run_test(test_case, result[position], seconds, len(indexed_test_cases)))
+            for position, (index, test_case) in enumerate(indexed_test_cases)
+        ]
+
+    def __run_test(self, test_case, actual_result, seconds, batch_size):
+        tolerance = test_case.get(DataQualityOperator.TEST_TOLERANCE, 0)
+        if tolerance and actual_result is not None:
+            actual_result = float(actual_result)
         return {
+            DataQualityOperator.TEST_NAME: test_case.get(DataQualityOperator.TEST_NAME),
             DataQualityOperator.__TEST_MESSAGE: f"""
-            Actual result {result[0][0]} should be {test_case[DataQualityOperator.TEST_ASSERTION_TYPE]} Expected result {test_case[DataQualityOperator.TEST_EXPECTED_RESULT]}.
+            Actual result {actual_result} should be {test_case[DataQualityOperator.TEST_ASSERTION_TYPE]} Expected result {test_case[DataQualityOperator.TEST_EXPECTED_RESULT]}.
         """,
-            DataQualityOperator.__TEST_SUCCESS: self.__assertions[test_case[DataQualityOperator.TEST_ASSERTION_TYPE]](
+            # a query without result (e.g. max() over an empty table) fails the test case
+            DataQualityOperator.__TEST_SUCCESS: actual_result is not None and self.__assertions[
+                test_case[DataQualityOperator.TEST_ASSERTION_TYPE]
+            ](
                 test_case[DataQualityOperator.TEST_EXPECTED_RESULT],
-                result[0][0]
-            )
+                actual_result,
+                tolerance
+            ),
+            DataQualityOperator.__TEST_SECONDS: seconds,
+            DataQualityOperator.__TEST_BATCH_SIZE: batch_size
         }
 
+    # The estimated results are compared with a relative tolerance: an assertion passes if it holds for any value in
+    # the [actual * (1 - tolerance), actual * (1 + tolerance)] range. A zero tolerance is an exact comparison.
+
     @staticmethod
-    def __assert_true(expected, actual):
+    def __assert_true(expected, actual, tolerance=0):
+        if tolerance:
+            return actual * (1 - tolerance) <= expected <= actual * (1 + tolerance)
         return expected == actual
     @staticmethod
-    def __assert_false(expected, actual):
+    def __assert_false(expected, actual, tolerance=0):
+        if tolerance:
+            return not actual * (1 - tolerance) <= expected <= actual * (1 + tolerance)
         return expected != actual
 
     @staticmethod
-    def __assert_less_than(expected, actual):
+    def __assert_less_than(expected, actual, tolerance=0):
+        if tolerance:
+            return actual * (1 - tolerance) < expected
         return actual < expected
 
     @staticmethod
-    def __assert_more_than(expected, actual):
+    def __assert_more_than(expected, actual, tolerance=0):
+        if tolerance:
+            return actual * (1 + tolerance) > expected
         return actual > expected
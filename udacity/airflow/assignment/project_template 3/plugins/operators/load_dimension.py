@@ -1,28 +1,56 @@
-from airflow.hooks.postgres_hook import PostgresHook
 from airflow.models import BaseOperator
 from airflow.utils.decorators import apply_defaults
 
-class LoadDimensionOperator(BaseOperator):
+from operators.telemetry_mixin import TelemetryMixin
+
+class LoadDimensionOperator(TelemetryMixin, BaseOperator):
 
     ui_color = '#80BD9E'
 
+    # Appends all the rows returned by the query.
+    LOAD_MODE_APPEND = 'append'
+    # Builds the dimension into a staging copy and swaps it in with a rename, so readers never see an empty table.
+    LOAD_MODE_SWAP = 'swap'
+    # Replaces the rows whose keys are in the source rows and inserts the new keys, taking the source rows from the DAG
+    # run's data interval if an interval column is provided. The source query must return a row per key.
+    LOAD_MODE_UPSERT = 'upsert'
+
     @apply_defaults
     def __init__(self,
                  redshift_conn_id,
                  target_table,
                  load_dimension_sql_query,
                  is_reload_from_fact=True,
+                 load_mode=None,
+                 key_column=None,
+                 interval_column=None,
                  *args, **kwargs):
 
         super(LoadDimensionOperator, self).__init__(*args, **kwargs)
         self.__redshift_conn_id = redshift_conn_id
         self.__target_table = target_table
         self.__load_dimension_sql_query = load_dimension_sql_query
-        self.__isReloadFromFact = is_reload_from_fact
+        self.__load_mode = load_mode or (
+            LoadDimensionOperator.LOAD_MODE_SWAP if is_reload_from_fact else LoadDimensionOperator.LOAD_MODE_APPEND
+        )
+        self.__key_column = key_column
+        self.__interval_column = interval_column
+
+        if self.__load_mode == LoadDimensionOperator.LOAD_MODE_UPSERT and not key_column:
+            raise ValueError(f"key_column is required for the {LoadDimensionOperator.LOAD_MODE_UPSERT} load mode")
 
     def execute(self, context):
         self.log.info('executing LoadDimensionOperator')
-        self.__reload_target_table_from_fact_table() if self.__isReloadFromFact else self.__append_to_target_table()
+        if self.__load_mode == LoadDimensionOperator.LOAD_MODE_APPEND:
+            rows_changed = self.__append_to_target_table()
+        elif self.__load_mode == LoadDimensionOperator.LOAD_MODE_SWAP:
+            rows_changed = self.__reload_target_table_with_swap()
+        elif self.__load_mode == LoadDimensionOperator.LOAD_MODE_UPSERT:
+            rows_changed = self.__upsert_to_target_table(context)
+        else:
+            raise ValueError(f"Unknown load mode {self.__load_mode}")
+        self.log.info(f"{rows_changed} rows changed in table {self.__target_table}")
+        return rows_changed
 
     ####################################################################################################################
     #                                                                                                                  #
@@ -32,13 +60,22 @@ class LoadDimensionOperator(BaseOperator):
 
     def __append_to_target_table(self):
         self.log.info(f"appending data to table {self.__target_table}")
-        redshift = PostgresHook(postgres_conn_id=self.__redshift_conn_id)
-        redshift.run(self.__get_append_sql_query())
+        return self.__run_in_transaction([self.__get_append_sql_query()])[0]
 
-    def __reload_target_table_from_fact_table(self):
-        self.log.info(f"reloading data to table {self.__target_table}")
-        redshift = PostgresHook(postgres_conn_id=self.__redshift_conn_id)
-        redshift.run(self.__get_truncate_sql_query())
+    def __reload_target_table_with_swap(self):
+        self.log.info(f"reloading data to table {self.__target_table} through {self.__target_table}_staging")
+        return self.__run_in_transaction(self.__get_swap_sql_queries())[2]
+
+    def __upsert_to_target_table(self, context):
+        self.log.info(f"upserting {self.__key_column} keys to table {self.__target_table}")
+        return self.__run_in_transaction(self.__get_upsert_sql_queries(context))[-1]
+
+    def __run_in_transaction(self, queries):
+        """
+        Runs the queries in a single transaction and returns the number of rows affected by each of them.
+        """
+        with self.get_redshift_hook(self.__redshift_conn_id) as redshift:
+            return redshift.run(queries)
 
     def __get_append_sql_query(self):
         return f"""
@@ -46,9 +83,43 @@ class LoadDimensionOperator(BaseOperator):
             {self.__load_dimension_sql_query};
         """
 
-    def __get_truncate_sql_query(self):
-        return f"""
-            TRUNCATE TABLE {self.__target_table};
-            INSERT INTO {self.__target_table}
+    def __get_swap_sql_queries(self):
+        staging_table = f"{self.__target_table}_staging"
+        return [
+            f"DROP TABLE IF EXISTS {staging_table};",
+            f"CREATE TABLE {staging_table} (LIKE {self.__target_table});",
+            f"""
+            INSERT INTO {staging_table}
             {self.__load_dimension_sql_query};
-        """
+            """,
+            f"ALTER TABLE {self.__target_table} RENAME TO {self.__target_table}_old;",
+            f"ALTER TABLE {staging_table} RENAME TO {self.__target_table};",
+            f"DROP TABLE {self.__target_table}_old;"
+        ]
+
+    def __get_upsert_sql_queries(self, context):
+        source_query = self.__load_dimension_sql_query
+        if self.__interval_column:
+            source_query = f"""
+                SELECT *
+                FROM ({self.__load_dimension_sql_query}) AS dimension
+                WHERE dimension.{self.__interval_column} >= '{context['execution_date'].strftime('%Y-%m-%d %H:%M:%S')}'
+                AND dimension.{self.__interval_column} < '{context['next_execution_date'].strftime('%Y-%m-%d %H:%M:%S')}'
+            """
+        new_rows_table = f"{self.__target_table}_new_rows"
+        return [
+            f"CREATE TEMP TABLE {new_rows_table} (LIKE {self.__target_table});",
+            f"""
+            INSERT INTO {new_rows_table}
+            {source_query};
+            """,
+            f"""
+            DELETE FROM {self.__target_table}
+            USING {new_rows_table}
+            WHERE {self.__target_table}.{self.__key_column} = {new_rows_table}.{self.__key_column};
+            """,
+            f"""
+            INSERT INTO {self.__target_table}
+            SELECT DISTINCT * FROM {new_rows_table};
+            """
+        ]
@@ -1,27 +1,67 @@
-from airflow.hooks.postgres_hook import PostgresHook
 from airflow.models import BaseOperator
 from airflow.utils.decorators import apply_defaults
 
-class LoadFactOperator(BaseOperator):
+from operators.telemetry_mixin import TelemetryMixin
+
+class LoadFactOperator(TelemetryMixin, BaseOperator):
 
     ui_color = '#F98866'
 
+    # Appends all the rows returned by the query (not idempotent).
+    LOAD_MODE_APPEND = 'append'
+    # Deletes the rows of the DAG run's data interval and inserts the interval's rows in one transaction.
+    LOAD_MODE_DELETE_INSERT = 'delete_insert'
+    # Builds the interval's rows into a shadow table of the run first, so that the target is not locked while the query
+    # runs. On redshift the interval is then deleted from the target and the shadow table's data blocks are moved into
+    # it with ALTER TABLE APPEND, without copying the rows; as ALTER TABLE APPEND cannot run in a transaction, the
+    # interval is empty in between. On postgres the shadow rows replace the interval with a delete and insert in one
+    # transaction.
+    LOAD_MODE_SHADOW_SWAP = 'shadow_swap'
+
     @apply_defaults
     def __init__(self,
                  redshift_conn_id,
                  target_table,
                  load_fact_sql_query,
+                 load_mode=LOAD_MODE_APPEND,
+                 interval_column='start_time',
                  *args, **kwargs):
 
         super(LoadFactOperator, self).__init__(*args, **kwargs)
         self.__redshift_conn_id = redshift_conn_id
         self.__target_table = target_table
         self.__load_fact_sql_query = load_fact_sql_query
+        self.__load_mode = load_mode
+        self.__interval_column = interval_column
 
     def execute(self, context):
         self.log.info('executing LoadFactOperator')
-        redshift = PostgresHook(postgres_conn_id=self.__redshift_conn_id)
-        redshift.run(self.__get_append_to_facts_table_query())
+        with self.get_redshift_hook(self.__redshift_conn_id) as redshift:
+            if self.__load_mode == LoadFactOperator.LOAD_MODE_APPEND:
+                redshift.run(self.__get_append_to_facts_table_query())
+                return
+
+            interval_start, interval_end = self.__get_data_interval(context)
+            self.log.info(f"loading {self.__target_table} for the interval {interval_start} - {interval_end}")
+            if self.__load_mode == LoadFactOperator.LOAD_MODE_DELETE_INSERT:
+                # RedshiftHook.run executes the whole string in a single transaction
+                redshift.run(self.__get_delete_insert_query(interval_start, interval_end))
+            elif self.__load_mode == LoadFactOperator.LOAD_MODE_SHADOW_SWAP:
+                # the shadow table is named after the run, so that concurrent and backfill runs do not share it
+                shadow_table = f"{self.__target_table}_shadow_{context['ts_nodash']}"
+                try:
+                    redshift.run(self.__get_build_shadow_table_query(shadow_table, interval_start, interval_end))
+                    if redshift.is_redshift():
+                        redshift.run([
+                            self.__get_delete_interval_query(interval_start, interval_end),
+                            f"ALTER TABLE {self.__target_table} APPEND FROM {shadow_table};"
+                        ], autocommit=True)
+                    else:
+                        redshift.run(self.__get_swap_shadow_table_query(shadow_table, interval_start, interval_end))
+                finally:
+                    redshift.run(f"DROP TABLE IF EXISTS {shadow_table};")
+            else:
+                raise ValueError(f"Unknown load mode {self.__load_mode}")
 
     ####################################################################################################################
     #                                                                                                                  #
@@ -29,8 +69,56 @@ class LoadFactOperator(BaseOperator):
     #                                                                                                                  #
     ####################################################################################################################
 
+    @staticmethod
+    def __get_data_interval(context):
+        return (
+            context['execution_date'].strftime('%Y-%m-%d %H:%M:%S'),
+            context['next_execution_date'].strftime('%Y-%m-%d %H:%M:%S')
+        )
+
+    def __get_interval_condition(self, interval_start, interval_end, table_alias):
+        return f"""
+            {table_alias}.{self.__interval_column} >= '{interval_start}'
+            AND {table_alias}.{self.__interval_column} < '{interval_end}'
+        """
+
+    def __get_interval_rows_query(self, interval_start, interval_end):
+        return f"""
+            SELECT *
+            FROM ({self.__load_fact_sql_query}) AS fact
+            WHERE {self.__get_interval_condition(interval_start, interval_end, 'fact')}
+        """
+
     def __get_append_to_facts_table_query(self):
         return f"""
             INSERT INTO {self.__target_table}
             {self.__load_fact_sql_query};
         """
+
+    def __get_delete_interval_query(self, interval_start, interval_end):
+        return f"""
+            DELETE FROM {self.__target_table}
+            WHERE {self.__get_interval_condition(interval_start, interval_end, self.__target_table)};
+        """
+
+    def __get_delete_insert_query(self, interval_start, interval_end):
+        return f"""
+            {self.__get_delete_interval_query(interval_start, interval_end)}
+            INSERT INTO {self.__target_table}
+            {self.__get_interval_rows_query(interval_start, interval_end)};
+        """
+
+    def __get_build_shadow_table_query(self, shadow_table, interval_start, interval_end):
+        return f"""
+            DROP TABLE IF EXISTS {shadow_table};
+            CREATE TABLE {shadow_table} (LIKE {self.__target_table});
+            INSERT INTO {shadow_table}
+            {self.__get_interval_rows_query(interval_start, interval_end)};
+        """
+
+    def __get_swap_shadow_table_query(self, shadow_table, interval_start, interval_end):
+        return f"""
+            {self.__get_delete_interval_query(interval_start, interval_end)}
+            INSERT INTO {self.__target_table}
+            SELECT * FROM {shadow_table};
+        """
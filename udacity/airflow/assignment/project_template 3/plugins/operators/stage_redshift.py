@@ -1,12 +1,20 @@
-from airflow.hooks.postgres_hook import PostgresHook
 from airflow.contrib.hooks.aws_hook import AwsHook
+from airflow.exceptions import AirflowSkipException
 from airflow.models import BaseOperator
 from airflow.utils.decorators import apply_defaults
 
+from operators.telemetry_mixin import TelemetryMixin
 
-class StageToRedshiftOperator(BaseOperator):
+
+class StageToRedshiftOperator(TelemetryMixin, BaseOperator):
     ui_color = '#358140'
 
+    # s3_key is rendered from the task context, e.g. "log_data/{{ execution_date.strftime('%Y/%m') }}/{{ ds }}"
+    template_fields = ("s3_key",)
+
+    LOAD_MODE_TRUNCATE = 'truncate'
+    LOAD_MODE_APPEND = 'append'
+
     @apply_defaults
     def __init__(self,
                  redshift_conn_id,
@@ -16,6 +24,9 @@ class StageToRedshiftOperator(BaseOperator):
                  s3_key,
                  region="us-west-2",
                  log_json_path='auto',
+                 load_mode=LOAD_MODE_TRUNCATE,
+                 partitions_task_id=None,
+                 partition_chunk=None,
                  *args, **kwargs):
         super(StageToRedshiftOperator, self).__init__(*args, **kwargs)
 
@@ -23,23 +34,36 @@ class StageToRedshiftOperator(BaseOperator):
         self.__aws_conn_id = aws_conn_id
         self.__target_table = target_table
         self.__s3_bucket = s3_bucket
-        self.__s3_key = s3_key
+        self.s3_key = s3_key
         self.__region = region
         self.__log_json_path = log_json_path
-        self.__execution_date = kwargs.get("execution_datetime")
+        self.__load_mode = load_mode
+        # When set, the keys to copy are pulled at runtime from the partition_chunk chunk of the key chunks returned by
+        # the partitions_task_id task (see S3Partitions.list_interval_chunks) instead of copying s3_key.
+        self.__partitions_task_id = partitions_task_id
+        self.__partition_chunk = partition_chunk
 
     def execute(self, context):
         self.log.info('Running StageToRedshiftOperator')
-
-        redshift = PostgresHook(postgres_conn_id=self.__redshift_conn_id)
-        self.log.info("Clearing data from the target Redshift table")
-        redshift.run(f"TRUNCATE TABLE  {self.__target_table}")
-        self.log.info("Copying data from S3 to Redshift")
+        s3_keys = self.__get_s3_keys(context)
+        if not s3_keys:
+            raise AirflowSkipException(f"No partitions to copy in chunk {self.__partition_chunk}")
 
         aws_hook = AwsHook(self.__aws_conn_id)
         credentials = aws_hook.get_credentials()
 
-        redshift.run(self.__get_copy_sql_query(access_key=credentials.access_key, secret_key=credentials.secret_key))
+        queries = []
+        if self.__load_mode == StageToRedshiftOperator.LOAD_MODE_TRUNCATE:
+            self.log.info("Clearing data from the target Redshift table")
+            queries.append(f"TRUNCATE TABLE {self.__target_table}")
+        self.log.info(f"Copying data from {len(s3_keys)} s3 keys in s3://{self.__s3_bucket} to Redshift")
+        queries.extend(
+            self.__get_copy_sql_query(s3_key=s3_key, access_key=credentials.access_key, secret_key=credentials.secret_key)
+            for s3_key in s3_keys
+        )
+
+        with self.get_redshift_hook(self.__redshift_conn_id) as redshift:
+            redshift.run(queries)
 
     ####################################################################################################################
     #                                                                                                                  #
@@ -47,14 +71,17 @@ class StageToRedshiftOperator(BaseOperator):
     #                                                                                                                  #
     ####################################################################################################################
 
+    def __get_s3_keys(self, context):
+        if self.__partitions_task_id is None:
+            return [self.s3_key]
+        chunks = context['ti'].xcom_pull(task_ids=self.__partitions_task_id) or []
+        return chunks[self.__partition_chunk] if self.__partition_chunk < len(chunks) else []
+
     def __get_copy_sql_query(self,
+                             s3_key: str,
                              access_key: str,
                              secret_key: str):
-        s3_path = f"s3://{self.__s3_bucket}/{self.__s3_key}" + (
-            f"/{self.__execution_date.strftime('%Y')}/{self.__execution_date.strftime('%d')}"
-            if self.__execution_date
-            else ""
-        )
+        s3_path = f"s3://{self.__s3_bucket}/{s3_key}"
         return f"""
         COPY {self.__target_table}
         FROM '{s3_path}'
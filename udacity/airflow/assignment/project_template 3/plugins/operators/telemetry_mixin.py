@@ -0,0 +1,100 @@
+import time
+
+from airflow.settings import Stats
+
+from hooks import RedshiftHook
+
+
+class TelemetryMixin:
+    """
+    Mixin timing the SQL of an operator. The operator gets its hooks from get_redshift_hook and, once execute returns,
+    the statements they ran are summed up and
+    - pushed to XCom under the TELEMETRY_XCOM_KEY key,
+    - sent to StatsD as <dag_id>.<task_id>.* timers, counters and gauges (enable statsd_on in the [scheduler] section of
+    airflow.cfg, a UDP listener on statsd_host:statsd_port is enough to receive them),
+    - compared with the previous runs of the task: the summaries of the last TELEMETRY_HISTORY_SIZE runs are carried
+    over in XCom and the change of the duration and throughput against their average is logged.
+    The mixin must come before BaseOperator in the bases of the operator.
+    """
+
+    TELEMETRY_XCOM_KEY = 'telemetry'
+    TELEMETRY_HISTORY_SIZE = 10
+
+    def pre_execute(self, context):
+        super(TelemetryMixin, self).pre_execute(context)
+        self.__hooks = []
+        self.__start = time.time()
+
+    def post_execute(self, context, result=None):
+        super(TelemetryMixin, self).post_execute(context, result)
+        telemetry = self.__get_telemetry(context)
+        context['ti'].xcom_push(key=TelemetryMixin.TELEMETRY_XCOM_KEY, value=telemetry)
+        self.__send_to_statsd(telemetry)
+        self.__log_telemetry(telemetry)
+
+    def get_redshift_hook(self, redshift_conn_id):
+        """
+        Creates a RedshiftHook labelled with the task id, the statements it runs are part of the task's telemetry.
+        """
+        hook = RedshiftHook(redshift_conn_id, query_group=self.task_id)
+        self.__hooks.append(hook)
+        return hook
+
+    ####################################################################################################################
+    #                                                                                                                  #
+    #                                                 Private functions                                                #
+    #                                                                                                                  #
+    ####################################################################################################################
+
+    def __get_telemetry(self, context):
+        statements = [statement for hook in self.__hooks for statement in hook.statement_metrics]
+        sql_seconds = sum(statement['seconds'] for statement in statements)
+        # DDL and session statements report -1 rows
+        rows = sum(max(statement['rows'], 0) for statement in statements)
+        summary = {
+            'execution_date': context['execution_date'].isoformat(),
+            'seconds': round(time.time() - self.__start, 3),
+            'sql_seconds': round(sql_seconds, 3),
+            'rows': rows,
+            'rows_per_second': round(rows / sql_seconds, 1) if sql_seconds else None
+        }
+
+        previous_telemetry = context['ti'].xcom_pull(task_ids=self.task_id,
+                                                     key=TelemetryMixin.TELEMETRY_XCOM_KEY,
+                                                     include_prior_dates=True) or {}
+        history = previous_telemetry.get('history', []) + [summary]
+        return {
+            **summary,
+            'statements': statements,
+            'history': history[-TelemetryMixin.TELEMETRY_HISTORY_SIZE:]
+        }
+
+    def __send_to_statsd(self, telemetry):
+        prefix = f"{self.dag_id}.{self.task_id}"
+        Stats.timing(f"{prefix}.duration", telemetry['seconds'] * 1000)
+        Stats.timing(f"{prefix}.sql_duration", telemetry['sql_seconds'] * 1000)
+        Stats.incr(f"{prefix}.rows", telemetry['rows'])
+        Stats.gauge(f"{prefix}.statements", len(telemetry['statements']))
+        if telemetry['rows_per_second'] is not None:
+            Stats.gauge(f"{prefix}.rows_per_second", telemetry['rows_per_second'])
+
+    def __log_telemetry(self, telemetry):
+        for statement in telemetry['statements']:
+            self.log.info(f"{statement['seconds']}s, {statement['rows']} rows: {statement['statement']}")
+        self.log.info(f"{self.task_id} took {telemetry['seconds']}s ({telemetry['sql_seconds']}s of SQL), "
+                      f"{telemetry['rows']} rows, {telemetry['rows_per_second']} rows/s")
+
+        previous_runs = telemetry['history'][:-1]
+        if not previous_runs:
+            return
+        self.log.info(f"against the average of the {len(previous_runs)} previous runs: "
+                      f"duration {TelemetryMixin.__get_change(telemetry, previous_runs, 'seconds')}, "
+                      f"throughput {TelemetryMixin.__get_change(telemetry, previous_runs, 'rows_per_second')}")
+
+    @staticmethod
+    def __get_change(telemetry, previous_runs, metric):
+        values = [run[metric] for run in previous_runs if run[metric] is not None]
+        if not values or telemetry[metric] is None or not sum(values):
+            return "n/a"
+        average = sum(values) / len(values)
+        return f"{(telemetry[metric] - average) / average:+.0%}"
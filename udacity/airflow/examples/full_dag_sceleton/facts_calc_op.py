@@ -1,11 +1,22 @@
 import logging
 
-from airflow.hooks.postgres_hook import PostgresHook
 from airflow.models import BaseOperator
 from airflow.utils.decorators import apply_defaults
 
+from operators.telemetry_mixin import TelemetryMixin
+
+
+class FactsCalculatorOperator(TelemetryMixin, BaseOperator):
+    # Recalculates the destination table from the whole origin table on every run.
+    MODE_FULL = 'full'
+    # Keeps the count, sum, min and max of the fact per group and DAG run's data interval in a state table and only
+    # aggregates the origin rows of the run's interval. The partial aggregates of a new interval are folded into the
+    # destination rows of their groups, which keep the count and sum of the fact besides the max, min and average.
+    # Re-running an interval replaces its partial aggregates and recalculates the destination rows of its groups from
+    # the state table, so the runs are idempotent. The state is built from the first incremental run on, so the DAG has
+    # to catch up from the start of the origin data.
+    MODE_INCREMENTAL = 'incremental'
 
-class FactsCalculatorOperator(BaseOperator):
     facts_sql_template = """
     DROP TABLE IF EXISTS {destination_table};
     CREATE TABLE {destination_table} AS
@@ -18,6 +29,86 @@ class FactsCalculatorOperator(BaseOperator):
     GROUP BY {groupby_column};
     """
 
+    # the partial aggregates of one data interval
+    state_select_template = """
+    SELECT
+        '{interval_start}'::timestamp AS interval_start,
+        {groupby_column},
+        COUNT({fact_column}) AS count_{fact_column},
+        COALESCE(SUM({fact_column}), 0) AS sum_{fact_column},
+        MIN({fact_column}) AS min_{fact_column},
+        MAX({fact_column}) AS max_{fact_column}
+    FROM {origin_table}
+    WHERE {interval_column} >= '{interval_start}'
+    AND {interval_column} < '{interval_end}'
+    GROUP BY {groupby_column}
+    """
+
+    # the destination rows merged from the partial aggregates of the groups in the groups table
+    merged_facts_select_template = """
+    SELECT
+        state.{groupby_column},
+        MAX(state.max_{fact_column}) AS max_{fact_column},
+        MIN(state.min_{fact_column}) AS min_{fact_column},
+        SUM(state.sum_{fact_column})::double precision / NULLIF(SUM(state.count_{fact_column}), 0)
+            AS average_{fact_column},
+        SUM(state.count_{fact_column}) AS count_{fact_column},
+        SUM(state.sum_{fact_column}) AS sum_{fact_column}
+    FROM {state_table} AS state
+    JOIN (SELECT DISTINCT {groupby_column} FROM {groups_table}) AS touched
+    ON {state_group_matches_groups}
+    GROUP BY state.{groupby_column}
+    """
+
+    # a new interval: its partial aggregates are added to the destination rows of their groups, the groups without
+    # destination row get one
+    fold_facts_sql_template = """
+    CREATE TEMP TABLE {partial_table} AS
+    {state_select};
+    INSERT INTO {state_table}
+    SELECT * FROM {partial_table};
+    UPDATE {destination_table}
+    SET max_{fact_column} = GREATEST({destination_table}.max_{fact_column}, interval_facts.max_{fact_column}),
+        min_{fact_column} = LEAST({destination_table}.min_{fact_column}, interval_facts.min_{fact_column}),
+        average_{fact_column} = ({destination_table}.sum_{fact_column} + interval_facts.sum_{fact_column})::double precision
+            / NULLIF({destination_table}.count_{fact_column} + interval_facts.count_{fact_column}, 0),
+        count_{fact_column} = {destination_table}.count_{fact_column} + interval_facts.count_{fact_column},
+        sum_{fact_column} = {destination_table}.sum_{fact_column} + interval_facts.sum_{fact_column}
+    FROM {partial_table} AS interval_facts
+    WHERE {destination_group_matches_partial};
+    INSERT INTO {destination_table}
+    SELECT
+        interval_facts.{groupby_column},
+        interval_facts.max_{fact_column},
+        interval_facts.min_{fact_column},
+        interval_facts.sum_{fact_column}::double precision / NULLIF(interval_facts.count_{fact_column}, 0),
+        interval_facts.count_{fact_column},
+        interval_facts.sum_{fact_column}
+    FROM {partial_table} AS interval_facts
+    LEFT JOIN {destination_table}
+    ON {destination_group_matches_partial}
+    WHERE {destination_table}.count_{fact_column} IS NULL;
+    DROP TABLE {partial_table};
+    """
+
+    # a re-run interval: the min and max of the replaced partial aggregates cannot be taken out of the destination rows,
+    # the rows of the groups of the old and new partial aggregates are recalculated from the state table
+    rerun_facts_sql_template = """
+    CREATE TEMP TABLE {groups_table} AS
+    SELECT DISTINCT {groupby_column} FROM {state_table} WHERE interval_start = '{interval_start}';
+    DELETE FROM {state_table} WHERE interval_start = '{interval_start}';
+    INSERT INTO {state_table}
+    {state_select};
+    INSERT INTO {groups_table}
+    SELECT DISTINCT {groupby_column} FROM {state_table} WHERE interval_start = '{interval_start}';
+    DELETE FROM {destination_table}
+    USING {groups_table} AS touched
+    WHERE {destination_group_matches_groups};
+    INSERT INTO {destination_table}
+    {merged_facts_select};
+    DROP TABLE {groups_table};
+    """
+
     @apply_defaults
     def __init__(self,
                  redshift_conn_id="",
@@ -25,6 +116,8 @@ class FactsCalculatorOperator(BaseOperator):
                  destination_table="",
                  fact_column="",
                  groupby_column="",
+                 mode=MODE_FULL,
+                 interval_column="",
                  *args, **kwargs):
 
         super(FactsCalculatorOperator, self).__init__(*args, **kwargs)
@@ -33,13 +126,106 @@ class FactsCalculatorOperator(BaseOperator):
         self.destination_table = destination_table
         self.fact_column = fact_column
         self.groupby_column = groupby_column
+        self.mode = mode
+        self.interval_column = interval_column
+        self.state_table = f"{destination_table}_state"
+
+        if mode == FactsCalculatorOperator.MODE_INCREMENTAL and not interval_column:
+            raise ValueError(f"interval_column is required for the {FactsCalculatorOperator.MODE_INCREMENTAL} mode")
 
     def execute(self, context):
-        redshift = PostgresHook(postgres_conn_id=self.redshift_conn_id)
-        facts_sql = FactsCalculatorOperator.facts_sql_template.format(
-            origin_table=self.origin_table,
+        with self.get_redshift_hook(self.redshift_conn_id) as redshift:
+            if self.mode == FactsCalculatorOperator.MODE_FULL:
+                facts_sql = FactsCalculatorOperator.facts_sql_template.format(
+                    origin_table=self.origin_table,
+                    destination_table=self.destination_table,
+                    fact_column=self.fact_column,
+                    groupby_column=self.groupby_column
+                )
+            elif self.mode == FactsCalculatorOperator.MODE_INCREMENTAL:
+                interval_start = context['execution_date'].strftime('%Y-%m-%d %H:%M:%S')
+                interval_end = context['next_execution_date'].strftime('%Y-%m-%d %H:%M:%S')
+                self.create_incremental_tables(redshift, interval_start, interval_end)
+                is_rerun = redshift.get_first(
+                    f"SELECT 1 FROM {self.state_table} WHERE interval_start = %s LIMIT 1", parameters=(interval_start,)
+                ) is not None
+                logging.info(f"Folding the {self.origin_table} rows of {interval_start} - {interval_end} "
+                             f"into {self.destination_table}{' (re-run)' if is_rerun else ''}")
+                facts_sql = self.get_incremental_facts_sql(interval_start, interval_end, is_rerun)
+            else:
+                raise ValueError(f"Unknown mode {self.mode}")
+            redshift.run(facts_sql)
+
+    def create_incremental_tables(self, redshift_hook, interval_start, interval_end):
+        """
+        Creates the empty state table on the first incremental run, the column types are taken from the origin table.
+        A missing destination table is created from the partial aggregates already in the state table.
+        """
+        if not self.table_exists(redshift_hook, self.state_table):
+            redshift_hook.run(f"""
+                CREATE TABLE {self.state_table} AS
+                SELECT * FROM ({self.get_state_select(interval_start, interval_end)}) AS state
+                WHERE 1 = 0;
+            """)
+        if not self.table_exists(redshift_hook, self.destination_table):
+            redshift_hook.run(f"""
+                CREATE TABLE {self.destination_table} AS
+                SELECT * FROM ({self.get_merged_facts_select(self.state_table)}) AS facts;
+            """)
+
+    def get_incremental_facts_sql(self, interval_start, interval_end, is_rerun):
+        if is_rerun:
+            groups_table = f"{self.destination_table}_rerun_groups"
+            return FactsCalculatorOperator.rerun_facts_sql_template.format(
+                state_table=self.state_table,
+                destination_table=self.destination_table,
+                groups_table=groups_table,
+                groupby_column=self.groupby_column,
+                interval_start=interval_start,
+                state_select=self.get_state_select(interval_start, interval_end),
+                destination_group_matches_groups=self.get_group_match(self.destination_table, 'touched'),
+                merged_facts_select=self.get_merged_facts_select(groups_table)
+            )
+        return FactsCalculatorOperator.fold_facts_sql_template.format(
+            state_table=self.state_table,
             destination_table=self.destination_table,
+            partial_table=f"{self.destination_table}_partial",
             fact_column=self.fact_column,
-            groupby_column=self.groupby_column
+            groupby_column=self.groupby_column,
+            state_select=self.get_state_select(interval_start, interval_end),
+            destination_group_matches_partial=self.get_group_match(self.destination_table, 'interval_facts')
         )
-        redshift.run(facts_sql)
\ No newline at end of file
+
+    def get_state_select(self, interval_start, interval_end):
+        return FactsCalculatorOperator.state_select_template.format(
+            origin_table=self.origin_table,
+            fact_column=self.fact_column,
+            groupby_column=self.groupby_column,
+            interval_column=self.interval_column,
+            interval_start=interval_start,
+            interval_end=interval_end
+        )
+
+    def get_merged_facts_select(self, groups_table):
+        return FactsCalculatorOperator.merged_facts_select_template.format(
+            state_table=self.state_table,
+            groups_table=groups_table,
+            fact_column=self.fact_column,
+            groupby_column=self.groupby_column,
+            state_group_matches_groups=self.get_group_match('state', 'touched')
+        )
+
+    def get_group_match(self, table, other_table):
+        # the groups are matched on a key that is never null, an equality the planner can hash join on: rows without
+        # group key are a group of their own, the other keys are compared as text
+        return f"{self.get_group_key(table)} = {self.get_group_key(other_table)}"
+
+    def get_group_key(self, table):
+        return f"CASE WHEN {table}.{self.groupby_column} IS NULL THEN 'n' " \
+               f"ELSE 'v' || {table}.{self.groupby_column}::varchar END"
+
+    @staticmethod
+    def table_exists(redshift_hook, table):
+        return redshift_hook.get_first(
+            "SELECT 1 FROM information_schema.tables WHERE table_name = %s", parameters=(table,)
+        ) is not None
\ No newline at end of file
@@ -1,10 +1,19 @@
+import csv
+import gzip
+import os
+import tempfile
+import time
+
 from airflow.contrib.hooks.aws_hook import AwsHook
-from airflow.hooks.postgres_hook import PostgresHook
+from airflow.hooks.S3_hook import S3Hook
 from airflow.models import BaseOperator
+from airflow.settings import Stats
 from airflow.utils.decorators import apply_defaults
 
+from operators.telemetry_mixin import TelemetryMixin
+
 
-class S3ToRedshiftOperator(BaseOperator):
+class S3ToRedshiftOperator(TelemetryMixin, BaseOperator):
     template_fields = ("s3_key",)
     copy_sql = """
         COPY {}
@@ -15,6 +24,50 @@ class S3ToRedshiftOperator(BaseOperator):
         DELIMITER '{}'
     """
 
+    # the csv is copied as it is
+    FORMAT_CSV = 'csv'
+    # the csv is split into gzip compressed csv parts before the copy
+    FORMAT_GZIP = 'gzip'
+    # the csv is converted into parquet parts before the copy, with the column types of the table (needs pyarrow)
+    FORMAT_PARQUET = 'parquet'
+
+    # the table is cleared with a DELETE in the copy's transaction (leaves deleted rows until the next VACUUM)
+    CLEAR_MODE_DELETE = 'delete'
+    # the table is cleared with a TRUNCATE (commits immediately on redshift, readers may see the table empty)
+    CLEAR_MODE_TRUNCATE = 'truncate'
+    # the data is copied into a new table swapped in with a rename, readers see the previous data until the swap
+    CLEAR_MODE_SWAP = 'swap'
+
+    copy_gzip_sql = """
+        COPY {}
+        FROM '{}'
+        ACCESS_KEY_ID '{}'
+        SECRET_ACCESS_KEY '{}'
+        IGNOREHEADER {}
+        DELIMITER '{}'
+        GZIP
+    """
+
+    copy_parquet_sql = """
+        COPY {}
+        FROM '{}'
+        ACCESS_KEY_ID '{}'
+        SECRET_ACCESS_KEY '{}'
+        FORMAT AS PARQUET
+    """
+
+    # postgres/redshift column types -> pyarrow type aliases, numeric columns become decimals of the column's precision
+    # and the other types are read as strings
+    arrow_types = {
+        'smallint': 'int16',
+        'integer': 'int32',
+        'bigint': 'int64',
+        'real': 'float',
+        'double precision': 'double',
+        'boolean': 'bool',
+        'date': 'date32',
+        'timestamp without time zone': 'timestamp[us]',
+    }
 
     @apply_defaults
     def __init__(self,
@@ -25,7 +78,19 @@ class S3ToRedshiftOperator(BaseOperator):
                  s3_key="",
                  delimiter=",",
                  ignore_headers=1,
+                 copy_format=FORMAT_CSV,
+                 parts=None,
+                 parts_bucket=None,
+                 clear_mode=CLEAR_MODE_TRUNCATE,
                  *args, **kwargs):
+        """
+        :param copy_format: FORMAT_CSV copies s3_key, FORMAT_GZIP and FORMAT_PARQUET pre-stage it into parts first.
+        :param parts: number of parts to pre-stage, defaults to the number of slices of the cluster so that every slice
+        loads one part.
+        :param parts_bucket: bucket of the parts, defaults to s3_bucket. The parts are written under
+        <s3_key>.<copy_format>/ and replaced on every run.
+        :param clear_mode: how the previous data of the table is cleared, one of the CLEAR_MODE_* values.
+        """
 
         super(S3ToRedshiftOperator, self).__init__(*args, **kwargs)
         self.table = table
@@ -35,24 +100,176 @@ class S3ToRedshiftOperator(BaseOperator):
         self.delimiter = delimiter
         self.ignore_headers = ignore_headers
         self.aws_credentials_id = aws_credentials_id
+        self.copy_format = copy_format
+        self.parts = parts
+        self.parts_bucket = parts_bucket or s3_bucket
+        self.clear_mode = clear_mode
 
     def execute(self, context):
         aws_hook = AwsHook(self.aws_credentials_id)
         credentials = aws_hook.get_credentials()
-        redshift = PostgresHook(postgres_conn_id=self.redshift_conn_id)
+        rendered_key = self.s3_key.format(**context)
 
-        self.log.info("Clearing data from destination Redshift table")
-        redshift.run("DELETE FROM {}".format(self.table))
+        with self.get_redshift_hook(self.redshift_conn_id) as redshift:
+            prestage_seconds = 0
+            s3_path = "s3://{}/{}".format(self.s3_bucket, rendered_key)
+            if self.copy_format != S3ToRedshiftOperator.FORMAT_CSV:
+                start = time.time()
+                s3_path = self.prestage(redshift, rendered_key)
+                prestage_seconds = round(time.time() - start, 3)
 
-        self.log.info("Copying data from S3 to Redshift")
-        rendered_key = self.s3_key.format(**context)
-        s3_path = "s3://{}/{}".format(self.s3_bucket, rendered_key)
-        formatted_sql = S3ToRedshiftOperator.copy_sql.format(
-            self.table,
+            self.log.info(f"Clearing data from destination Redshift table ({self.clear_mode}) and copying data from "
+                          f"{s3_path} to Redshift ({self.copy_format})")
+            start = time.time()
+            if self.clear_mode == S3ToRedshiftOperator.CLEAR_MODE_SWAP:
+                swap_table = f"{self.table}_swap"
+                redshift.run([
+                    f"DROP TABLE IF EXISTS {swap_table}",
+                    f"CREATE TABLE {swap_table} (LIKE {self.table})",
+                    self.get_copy_sql(swap_table, s3_path, credentials),
+                    f"ALTER TABLE {self.table} RENAME TO {self.table}_old",
+                    f"ALTER TABLE {swap_table} RENAME TO {self.table}",
+                    f"DROP TABLE {self.table}_old"
+                ])
+            elif self.clear_mode == S3ToRedshiftOperator.CLEAR_MODE_TRUNCATE:
+                redshift.run([f"TRUNCATE TABLE {self.table}", self.get_copy_sql(self.table, s3_path, credentials)])
+            elif self.clear_mode == S3ToRedshiftOperator.CLEAR_MODE_DELETE:
+                # the DELETE and the COPY run in one transaction, readers never see the table empty
+                redshift.run([f"DELETE FROM {self.table}", self.get_copy_sql(self.table, s3_path, credentials)])
+            else:
+                raise ValueError(f"Unknown clear mode {self.clear_mode}")
+            load_seconds = round(time.time() - start, 3)
+
+        self.log.info(f"Loaded {self.table} from {self.copy_format} in {load_seconds}s "
+                      f"(pre-staging {prestage_seconds}s)")
+        Stats.timing(f"{self.dag_id}.{self.task_id}.load.{self.copy_format}", load_seconds * 1000)
+        Stats.timing(f"{self.dag_id}.{self.task_id}.prestage.{self.copy_format}", prestage_seconds * 1000)
+        return {'format': self.copy_format, 'load_seconds': load_seconds, 'prestage_seconds': prestage_seconds}
+
+    def get_copy_sql(self, table, s3_path, credentials):
+        if self.copy_format == S3ToRedshiftOperator.FORMAT_PARQUET:
+            return S3ToRedshiftOperator.copy_parquet_sql.format(
+                table, s3_path, credentials.access_key, credentials.secret_key
+            )
+        copy_sql = S3ToRedshiftOperator.copy_gzip_sql \
+            if self.copy_format == S3ToRedshiftOperator.FORMAT_GZIP else S3ToRedshiftOperator.copy_sql
+        return copy_sql.format(
+            table,
             s3_path,
             credentials.access_key,
             credentials.secret_key,
             self.ignore_headers,
             self.delimiter
         )
-        redshift.run(formatted_sql)
+
+    def prestage(self, redshift_hook, rendered_key):
+        """
+        Splits the csv into parts of copy_format and uploads them to parts_bucket, replacing the parts of the previous
+        runs.
+        :return: s3 path of the prefix of the parts, to copy all of them at once.
+        """
+        s3 = S3Hook(aws_conn_id=self.aws_credentials_id)
+        parts = self.parts or self.get_slice_count(redshift_hook)
+        parts_prefix = f"{rendered_key}.{self.copy_format}/"
+
+        with tempfile.TemporaryDirectory() as directory:
+            csv_path = os.path.join(directory, 'source.csv')
+            self.log.info(f"Downloading s3://{self.s3_bucket}/{rendered_key}")
+            s3.get_key(rendered_key, bucket_name=self.s3_bucket).download_file(csv_path)
+
+            if self.copy_format == S3ToRedshiftOperator.FORMAT_GZIP:
+                part_paths = self.split_to_gzip(csv_path, directory, parts)
+            elif self.copy_format == S3ToRedshiftOperator.FORMAT_PARQUET:
+                part_paths = self.split_to_parquet(csv_path, directory, parts, self.get_column_types(redshift_hook))
+            else:
+                raise ValueError(f"Unknown format {self.copy_format}")
+
+            previous_parts = s3.list_keys(bucket_name=self.parts_bucket, prefix=parts_prefix)
+            if previous_parts:
+                s3.delete_objects(bucket=self.parts_bucket, keys=previous_parts)
+            for part_path in part_paths:
+                s3.load_file(part_path, parts_prefix + os.path.basename(part_path),
+                             bucket_name=self.parts_bucket, replace=True)
+        self.log.info(f"Pre-staged {len(part_paths)} {self.copy_format} parts to s3://{self.parts_bucket}/{parts_prefix}")
+        return f"s3://{self.parts_bucket}/{parts_prefix}"
+
+    def split_to_gzip(self, csv_path, directory, parts):
+        """
+        Deals the records of the csv round-robin into gzip parts, every part keeps the header lines for IGNOREHEADER.
+        The lines of a record are copied as they are, the delimited text COPY reads the parts exactly as it reads the csv.
+        The records are delimited by the csv module, so a quoted field with a line break stays in one part.
+        """
+        part_paths = [os.path.join(directory, f"part-{part:04d}.csv.gz") for part in range(parts)]
+        part_files = [gzip.open(part_path, 'wt', encoding='utf-8', newline='') for part_path in part_paths]
+        try:
+            with open(csv_path, encoding='utf-8', newline='') as csv_file:
+                for _ in range(self.ignore_headers):
+                    header = csv_file.readline()
+                    for part_file in part_files:
+                        part_file.write(header)
+
+                # the lines the csv reader consumed for the current record
+                record_lines = []
+
+                def read_lines():
+                    for line in csv_file:
+                        record_lines.append(line)
+                        yield line
+
+                for record_number, _ in enumerate(csv.reader(read_lines(), delimiter=self.delimiter)):
+                    part_files[record_number % parts].write(''.join(record_lines))
+                    record_lines.clear()
+        finally:
+            for part_file in part_files:
+                part_file.close()
+        return part_paths
+
+    def split_to_parquet(self, csv_path, directory, parts, column_types):
+        """
+        Reads the csv with the column types of the table (by position, as the csv COPY does) and writes it into
+        parquet parts of about the same number of rows.
+        """
+        try:
+            import pyarrow
+            import pyarrow.csv
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError(f"pyarrow is required for the {S3ToRedshiftOperator.FORMAT_PARQUET} format")
+
+        column_names = [name for name, _, _, _ in column_types]
+        arrow_types = {
+            name: pyarrow.decimal128(precision, scale) if data_type == 'numeric'
+            else pyarrow.type_for_alias(S3ToRedshiftOperator.arrow_types.get(data_type, 'string'))
+            for name, data_type, precision, scale in column_types
+        }
+        table = pyarrow.csv.read_csv(
+            csv_path,
+            read_options=pyarrow.csv.ReadOptions(column_names=column_names, skip_rows=self.ignore_headers),
+            parse_options=pyarrow.csv.ParseOptions(delimiter=self.delimiter),
+            convert_options=pyarrow.csv.ConvertOptions(column_types=arrow_types)
+        )
+
+        rows_per_part = -(-table.num_rows // parts)
+        part_paths = []
+        for part in range(parts):
+            part_path = os.path.join(directory, f"part-{part:04d}.parquet")
+            pyarrow.parquet.write_table(table.slice(part * rows_per_part, rows_per_part), part_path)
+            part_paths.append(part_path)
+        return part_paths
+
+    def get_column_types(self, redshift_hook):
+        return redshift_hook.get_records(
+            """
+            SELECT column_name, data_type, numeric_precision, numeric_scale
+            FROM information_schema.columns
+            WHERE table_name = %s
+            ORDER BY ordinal_position
+            """,
+            parameters=(self.table,)
+        )
+
+    @staticmethod
+    def get_slice_count(redshift_hook):
+        if not redshift_hook.is_redshift():
+            return 1
+        return redshift_hook.get_first("SELECT COUNT(*) FROM stv_slices")[0]
@@ -1,6 +1,7 @@
 from airflow.plugins_manager import AirflowPlugin
 
 import operators
+import hooks
 
 # Defining the plugin class
 class UdacityPlugin(AirflowPlugin):
@@ -9,3 +10,6 @@ class UdacityPlugin(AirflowPlugin):
         operators.HasRowsOperator,
         operators.S3ToRedshiftOperator
     ]
+    hooks = [
+        hooks.RedshiftHook
+    ]
@@ -0,0 +1,5 @@
+from hooks.redshift_hook import RedshiftHook
+
+__all__ = [
+    'RedshiftHook'
+]
\ No newline at end of file
@@ -0,0 +1,174 @@
+import re
+import time
+from contextlib import closing
+
+from airflow.hooks.postgres_hook import PostgresHook
+
+CREDENTIALS_PATTERN = re.compile(r"(ACCESS_KEY_ID|SECRET_ACCESS_KEY|CREDENTIALS)\s+'[^']*'", re.IGNORECASE)
+
+
+def describe_statement(statement, max_length=120):
+    """
+    Convenience method to get a one line description of a statement for the metrics, without the credentials.
+    """
+    description = CREDENTIALS_PATTERN.sub(r"\1 '***'", ' '.join(statement.split()))
+    return description if len(description) <= max_length else f"{description[:max_length - 3]}..."
+
+
+class RedshiftHook(PostgresHook):
+    """
+    PostgresHook sharing one connection between all the queries of a task instead of opening a connection per call.
+    The session is set up once, when the connection is opened:
+    - query_group: labels the task's queries in stl_query and routes them to the matching WLM queue (redshift only)
+    - statement_timeout: aborts the statements running longer than the timeout, in milliseconds
+    - wlm_query_slot_count: number of WLM slots (and so memory) given to the task's queries (redshift only)
+    The settings not passed to the constructor are taken from the extra of the connection, e.g.
+    {"statement_timeout": 600000, "wlm_query_slot_count": 2}.
+    Use the hook as a context manager or call close() when the task is done.
+    The duration and row count of every statement are kept in statement_metrics (see TelemetryMixin).
+    """
+
+    SESSION_SETTINGS = ('query_group', 'statement_timeout', 'wlm_query_slot_count')
+    __REDSHIFT_ONLY_SETTINGS = ('query_group', 'wlm_query_slot_count')
+
+    def __init__(self,
+                 redshift_conn_id,
+                 query_group=None,
+                 statement_timeout=None,
+                 wlm_query_slot_count=None,
+                 **kwargs):
+        super(RedshiftHook, self).__init__(postgres_conn_id=redshift_conn_id, **kwargs)
+        self.__session_settings = {
+            'query_group': query_group,
+            'statement_timeout': statement_timeout,
+            'wlm_query_slot_count': wlm_query_slot_count
+        }
+        self.__conn = None
+        self.__is_redshift = None
+        self.statement_metrics = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def get_conn(self):
+        """
+        Returns the connection shared by the task, opening it on the first call.
+        """
+        if self.__conn is None or self.__conn.closed:
+            self.__conn = self.open_conn()
+        return self.__conn
+
+    def open_conn(self):
+        """
+        Opens a new connection with the session set up, for the callers that need several concurrent sessions.
+        The caller has to close it.
+        """
+        conn = super(RedshiftHook, self).get_conn()
+        try:
+            self.__set_up_session(conn)
+        except Exception:
+            conn.close()
+            raise
+        return conn
+
+    def close(self):
+        if self.__conn is not None and not self.__conn.closed:
+            self.__conn.close()
+        self.__conn = None
+
+    def record_statement(self, statement, seconds, rows):
+        """
+        Adds a statement to statement_metrics, for the statements run on the connections returned by open_conn.
+        """
+        self.statement_metrics.append({
+            'statement': describe_statement(statement),
+            'seconds': round(seconds, 3),
+            'rows': rows
+        })
+
+    def is_redshift(self):
+        self.get_conn()
+        return self.__is_redshift
+
+    def run(self, sql, autocommit=False, parameters=None):
+        """
+        Runs the statements in a single transaction on the shared connection: either all of them are committed or the
+        transaction is rolled back.
+        :param sql: statement or list of statements, a statement may hold several queries separated by ;
+        :param autocommit: runs every statement in its own transaction instead (e.g. for VACUUM).
+        :param parameters: query parameters, applied to every statement.
+        :return: number of rows affected by each statement.
+        """
+        if isinstance(sql, str):
+            sql = [sql]
+        conn = self.get_conn()
+        conn.autocommit = autocommit
+        try:
+            row_counts = []
+            with closing(conn.cursor()) as cursor:
+                for statement in sql:
+                    self.log.info(describe_statement(statement))
+                    start = time.time()
+                    cursor.execute(statement, parameters)
+                    self.record_statement(statement, time.time() - start, cursor.rowcount)
+                    row_counts.append(cursor.rowcount)
+            if not autocommit:
+                conn.commit()
+            return row_counts
+        except Exception:
+            if not autocommit:
+                conn.rollback()
+            raise
+        finally:
+            conn.autocommit = False
+
+    def get_records(self, sql, parameters=None):
+        return self.__fetch(sql, parameters, lambda cursor: cursor.fetchall())
+
+    def get_first(self, sql, parameters=None):
+        return self.__fetch(sql, parameters, lambda cursor: cursor.fetchone())
+
+    ####################################################################################################################
+    #                                                                                                                  #
+    #                                                 Private functions                                                #
+    #                                                                                                                  #
+    ####################################################################################################################
+
+    def __fetch(self, sql, parameters, fetch):
+        conn = self.get_conn()
+        try:
+            with closing(conn.cursor()) as cursor:
+                start = time.time()
+                cursor.execute(sql, parameters)
+                result = fetch(cursor)
+                self.record_statement(sql, time.time() - start, cursor.rowcount)
+            # ends the read transaction, so the shared session does not stay idle in transaction
+            conn.commit()
+            return result
+        except Exception:
+            conn.rollback()
+            raise
+
+    def __get_session_settings(self):
+        extra = self.get_connection(self.postgres_conn_id).extra_dejson
+        return {
+            name: value if value is not None else extra.get(name)
+            for name, value in self.__session_settings.items()
+        }
+
+    def __set_up_session(self, conn):
+        with closing(conn.cursor()) as cursor:
+            if self.__is_redshift is None:
+                cursor.execute("SELECT version()")
+                self.__is_redshift = 'redshift' in cursor.fetchone()[0].lower()
+            for name, value in self.__get_session_settings().items():
+                if value is None:
+                    continue
+                if name in RedshiftHook.__REDSHIFT_ONLY_SETTINGS and not self.__is_redshift:
+                    self.log.info(f"{name} is only supported by redshift, not setting it")
+                    continue
+                cursor.execute(f"SET {name} TO %s", (value,))
+        conn.commit()
@@ -1,29 +1,64 @@
 import logging
 
-from airflow.hooks.postgres_hook import PostgresHook
 from airflow.models import BaseOperator
 from airflow.utils.decorators import apply_defaults
 
+from operators.telemetry_mixin import TelemetryMixin
 
-class HasRowsOperator(BaseOperator):
+
+class HasRowsOperator(TelemetryMixin, BaseOperator):
+
+    # Counts all the rows of the table.
+    METHOD_EXACT = 'exact'
+    # Takes the row count from the table statistics (svv_table_info on redshift, pg_class on postgres), no table scan.
+    METHOD_STATISTICS = 'statistics'
+    # Counts only the rows of the DAG run's data interval of the partition column.
+    METHOD_PARTITION = 'partition'
 
     @apply_defaults
     def __init__(self,
                  redshift_conn_id="",
                  table="",
+                 method=METHOD_EXACT,
+                 partition_column="",
                  *args, **kwargs):
 
         super(HasRowsOperator, self).__init__(*args, **kwargs)
         self.table = table
         self.redshift_conn_id = redshift_conn_id
+        self.method = method
+        self.partition_column = partition_column
 
     def execute(self, context):
-        redshift_hook = PostgresHook(self.redshift_conn_id)
-        records = redshift_hook.get_records(f"SELECT COUNT(*) FROM {self.table}")
-        if len(records) < 1 or len(records[0]) < 1:
+        with self.get_redshift_hook(self.redshift_conn_id) as redshift_hook:
+            records = redshift_hook.get_records(self.get_count_sql(redshift_hook, context))
+        if len(records) < 1 or len(records[0]) < 1 or records[0][0] is None:
             raise ValueError(f"Data quality check failed. {self.table} returned no results")
         num_records = records[0][0]
         if num_records < 1:
             raise ValueError(f"Data quality check failed. {self.table} contained 0 rows")
-        logging.info(f"Data quality on table {self.table} check passed with {records[0][0]} records")
+        logging.info(f"Data quality on table {self.table} check passed with {records[0][0]} records ({self.method})")
+
+    def get_count_sql(self, redshift_hook, context):
+        if self.method == HasRowsOperator.METHOD_STATISTICS:
+            if redshift_hook.is_redshift():
+                return f"SELECT tbl_rows FROM svv_table_info WHERE \"table\" = '{self.table}'"
+            # reltuples is -1 (0 before Postgres 14) until the table is first vacuumed or analyzed, such a table gets
+            # a null row count and fails the check
+            return f"""
+                SELECT CASE WHEN c.reltuples >= 0 AND COALESCE(
+                    s.last_analyze, s.last_autoanalyze, s.last_vacuum, s.last_autovacuum
+                ) IS NOT NULL THEN c.reltuples::bigint END
+                FROM pg_class c
+                LEFT JOIN pg_stat_user_tables s ON s.relid = c.oid
+                WHERE c.relname = '{self.table}'
+            """
+        if self.method == HasRowsOperator.METHOD_PARTITION:
+            return f"""
+                SELECT COUNT(*)
+                FROM {self.table}
+                WHERE {self.partition_column} >= '{context['execution_date'].strftime('%Y-%m-%d %H:%M:%S')}'
+                AND {self.partition_column} < '{context['next_execution_date'].strftime('%Y-%m-%d %H:%M:%S')}'
+            """
+        return f"SELECT COUNT(*) FROM {self.table}"
 
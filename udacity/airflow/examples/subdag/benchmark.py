@@ -0,0 +1,130 @@
+#Benchmark of get_s3_to_redshift_dag (a SubDag per table) against get_s3_to_redshift_tasks (the tables' tasks side by
+#side in the parent DAG) on a local Postgres standing in for Redshift.
+#The COPY from S3 is replaced with a stand-in inserting generated rows and sleeping for the COPY latency, the create and
+#check tasks run as they are. Both DAG shapes are run once with a backfill on the local executor (the Airflow metadata
+#database has to be Postgres or MySQL for it) and their end to end latency is printed.
+#
+#   python benchmark.py --conn-id postgres_default --tables 4 --rows 100000 --copy-seconds 5
+
+import argparse
+import datetime
+import time
+
+from airflow import DAG
+from airflow.api.common.experimental.pool import create_pool
+from airflow.executors.local_executor import LocalExecutor
+from airflow.hooks.postgres_hook import PostgresHook
+from airflow.models import BaseOperator
+from airflow.operators.dummy_operator import DummyOperator
+from airflow.operators.subdag_operator import SubDagOperator
+from airflow.utils.decorators import apply_defaults
+
+from lesson3.exercise3 import subdag
+
+
+CREATE_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS {table} (
+    id INTEGER NOT NULL,
+    value VARCHAR(256)
+);
+"""
+
+
+class LocalCopyOperator(BaseOperator):
+    """
+    Stand-in of S3ToRedshiftOperator replacing the table's rows with generated ones.
+    """
+    rows = 100000
+    copy_seconds = 5
+
+    @apply_defaults
+    def __init__(self,
+                 redshift_conn_id="",
+                 aws_credentials_id="",
+                 table="",
+                 s3_bucket="",
+                 s3_key="",
+                 *args, **kwargs):
+
+        super(LocalCopyOperator, self).__init__(*args, **kwargs)
+        self.table = table
+        self.redshift_conn_id = redshift_conn_id
+
+    def execute(self, context):
+        PostgresHook(postgres_conn_id=self.redshift_conn_id).run(f"""
+            DELETE FROM {self.table};
+            INSERT INTO {self.table}
+            SELECT i, md5(i::text) FROM generate_series(1, {LocalCopyOperator.rows}) AS i;
+            SELECT pg_sleep({LocalCopyOperator.copy_seconds});
+        """)
+
+
+def get_subdag_dag(dag_id, conn_id, tables, start_date):
+    dag = DAG(dag_id, start_date=start_date, schedule_interval=None)
+    end_task = DummyOperator(task_id="end", dag=dag)
+    for table in tables:
+        task_id = f"{table}_subdag"
+        SubDagOperator(
+            subdag=subdag.get_s3_to_redshift_dag(
+                dag_id, task_id, conn_id, "", table, CREATE_TABLE_SQL.format(table=table), "", "",
+                start_date=start_date, schedule_interval=None
+            ),
+            task_id=task_id,
+            dag=dag,
+        ) >> end_task
+    return dag
+
+
+def get_tasks_dag(dag_id, conn_id, tables, start_date):
+    dag = DAG(dag_id, start_date=start_date, schedule_interval=None)
+    end_task = DummyOperator(task_id="end", dag=dag)
+    for table in tables:
+        _, last_task = subdag.get_s3_to_redshift_tasks(
+            dag_id, f"{table}_tasks", conn_id, "", table, CREATE_TABLE_SQL.format(table=table), "", "", dag=dag
+        )
+        last_task >> end_task
+    return dag
+
+
+def run_dag(dag, start_date, parallelism):
+    """
+    Runs the DAG once and returns its end to end latency in seconds.
+    """
+    dag.clear()
+    start = time.time()
+    dag.run(start_date=start_date, end_date=start_date, executor=LocalExecutor(parallelism=parallelism))
+    return round(time.time() - start, 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compares the latency of the subdag and the tasks DAG shapes")
+    parser.add_argument('--conn-id', default='postgres_default', help="connection to the local Postgres")
+    parser.add_argument('--tables', type=int, default=2, help="number of tables to load")
+    parser.add_argument('--rows', type=int, default=100000, help="rows loaded by each stand-in COPY")
+    parser.add_argument('--copy-seconds', type=float, default=5, help="latency added to each stand-in COPY")
+    parser.add_argument('--parallelism', type=int, default=4, help="slots of the executor and the shared pool")
+    args = parser.parse_args()
+
+    # both DAG shapes load the same tables with the stand-in COPY
+    LocalCopyOperator.rows = args.rows
+    LocalCopyOperator.copy_seconds = args.copy_seconds
+    subdag.S3ToRedshiftOperator = LocalCopyOperator
+    create_pool(subdag.S3_TO_REDSHIFT_POOL, args.parallelism, "Concurrent loads from S3 to Redshift")
+
+    tables = [f"benchmark_table_{table}" for table in range(args.tables)]
+    start_date = datetime.datetime(2020, 1, 1)
+    latencies = {
+        'subdag': run_dag(get_subdag_dag("benchmark.subdag", args.conn_id, tables, start_date),
+                          start_date, args.parallelism),
+        'tasks': run_dag(get_tasks_dag("benchmark.tasks", args.conn_id, tables, start_date),
+                         start_date, args.parallelism),
+    }
+
+    print(f"{len(tables)} tables, {args.rows} rows and {args.copy_seconds}s per copy")
+    for shape, seconds in latencies.items():
+        print(f"{shape:>8}: {seconds}s")
+    print(f"speedup: {latencies['subdag'] / latencies['tasks']:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
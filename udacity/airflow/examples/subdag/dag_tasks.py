@@ -0,0 +1,56 @@
+#Instructions
+#Same DAG as dag.py, with the S3 to RedShift Copy operations added as tasks of the DAG instead of SubDags, so the
+#trips and stations loads run side by side (see get_s3_to_redshift_tasks).
+
+import datetime
+
+from airflow import DAG
+from airflow.operators.postgres_operator import PostgresOperator
+
+from lesson3.exercise3.subdag import get_s3_to_redshift_tasks
+import sql_statements
+
+
+start_date = datetime.datetime.utcnow()
+
+dag = DAG(
+    "lesson3.exercise3.tasks",
+    start_date=start_date,
+)
+
+trips_task_id = "trips_tasks"
+trips_first_task, trips_last_task = get_s3_to_redshift_tasks(
+    "lesson3.exercise3.tasks",
+    trips_task_id,
+    "redshift",
+    "aws_credentials",
+    "trips",
+    sql_statements.CREATE_TRIPS_TABLE_SQL,
+    s3_bucket="udac-data-pipelines",
+    s3_key="divvy/unpartitioned/divvy_trips_2018.csv",
+    dag=dag,
+)
+
+stations_task_id = "stations_tasks"
+stations_first_task, stations_last_task = get_s3_to_redshift_tasks(
+    "lesson3.exercise3.tasks",
+    stations_task_id,
+    "redshift",
+    "aws_credentials",
+    "stations",
+    sql_statements.CREATE_STATIONS_TABLE_SQL,
+    s3_bucket="udac-data-pipelines",
+    s3_key="divvy/unpartitioned/divvy_stations_2017.csv",
+    dag=dag,
+)
+
+location_traffic_task = PostgresOperator(
+    task_id="calculate_location_traffic",
+    dag=dag,
+    postgres_conn_id="redshift",
+    sql=sql_statements.LOCATION_TRAFFIC_SQL
+)
+
+
+trips_last_task >> location_traffic_task
+stations_last_task >> location_traffic_task
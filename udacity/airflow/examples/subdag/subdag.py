@@ -49,13 +49,72 @@ def get_s3_to_redshift_dag(
         s3_key=s3_key
     )
 
-   check_rows = HasRowsOperator(
-    task_id=f"check_{table}_rows",
-    dag=dag,
-    redshift_conn_id=redshift_conn_id,
-    table=table
-)
+    check_rows = HasRowsOperator(
+        task_id=f"check_{table}_rows",
+        dag=dag,
+        redshift_conn_id=redshift_conn_id,
+        table=table
+    )
 
     create_task >> copy_task >> check_rows
 
     return dag
+
+
+# Pool shared by the loads of all the tables, create it with
+# `airflow pool -s s3_to_redshift 4 "Concurrent loads from S3 to Redshift"`.
+S3_TO_REDSHIFT_POOL = "s3_to_redshift"
+
+
+# Adds the same create, load and check tasks as get_s3_to_redshift_dag to the parent DAG itself. A SubDagOperator holds
+# a worker slot while its subdag runs and runs the subdag's tasks one after the other on its own executor, so the loads
+# of several tables are serialized. Here, the tasks of all the tables are scheduled by the parent DAG's executor side by
+# side, with the task ids prefixed with task_id as a task group would do (task groups are not available in Airflow
+# 1.10). The loads and checks run in a shared pool, so the number of concurrent loads on the cluster stays bounded.
+# The parent DAG is passed with the dag keyword argument and the pool with the pool keyword argument, the other keyword
+# arguments (the subdag's DAG arguments) are ignored.
+# Returns the first and the last task of the table's chain.
+def get_s3_to_redshift_tasks(
+        parent_dag_name,
+        task_id,
+        redshift_conn_id,
+        aws_credentials_id,
+        table,
+        create_sql_stmt,
+        s3_bucket,
+        s3_key,
+        *args, **kwargs):
+    dag = kwargs["dag"]
+    if dag.dag_id != parent_dag_name:
+        raise ValueError(f"The tasks of {task_id} are added to {dag.dag_id}, not to {parent_dag_name}")
+    pool = kwargs.get("pool", S3_TO_REDSHIFT_POOL)
+
+    create_task = PostgresOperator(
+        task_id=f"{task_id}.create_{table}_table",
+        dag=dag,
+        postgres_conn_id=redshift_conn_id,
+        sql=create_sql_stmt
+    )
+
+    copy_task = S3ToRedshiftOperator(
+        task_id=f"{task_id}.load_{table}_from_s3_to_redshift",
+        dag=dag,
+        pool=pool,
+        table=table,
+        redshift_conn_id=redshift_conn_id,
+        aws_credentials_id=aws_credentials_id,
+        s3_bucket=s3_bucket,
+        s3_key=s3_key
+    )
+
+    check_rows = HasRowsOperator(
+        task_id=f"{task_id}.check_{table}_rows",
+        dag=dag,
+        pool=pool,
+        redshift_conn_id=redshift_conn_id,
+        table=table
+    )
+
+    create_task >> copy_task >> check_rows
+
+    return create_task, check_rows
@@ -0,0 +1,167 @@
+"""
+Compares the allocations and the throughput of the row by row pipeline etl.py used to run (pandas DataFrames turned into
+a parameter dict per row) with the Arrow pipeline. Every pipeline loads the data into a new sparkify database, the
+DuckDB in-memory database by default: python benchmark.py --database :memory: --scale 10
+The Python heap is traced with tracemalloc, the Arrow buffers live outside of it and are counted by the memory pool.
+"""
+import argparse
+import glob
+import time
+import tracemalloc
+
+import pandas as pd
+import pyarrow
+
+import etl
+from create_tables import add_backend_arguments, create_database, create_tables
+from sql_queries import *
+from warehouse.pgcopy import BinaryCopyStream
+
+SONG_FILES = 'data/song_data/**/*.json'
+LOG_FILES = 'data/log_data/**/*.json'
+
+# the memory pools of the measures, kept alive as long as the buffers they allocated
+MEMORY_POOLS = []
+
+PG_SONGPLAY_TYPES = {
+    'start_time': 'bigint',
+    'user_id': 'integer',
+    'level': 'text',
+    'song_id': 'text',
+    'artist_id': 'text',
+    'session_id': 'integer',
+    'location': 'text',
+    'user_agent': 'text'
+}
+
+
+def load_by_row(warehouse, scale):
+    """
+    The row by row pipeline: the files are read into DataFrames, then every row becomes a dict of Python objects bound
+    to an INSERT, and every songplay looks its song up with a query.
+    """
+    song_df = pd.concat([pd.read_json(file_name, lines=True) for file_name in glob.glob(SONG_FILES, recursive=True)])
+    log_df = pd.concat(
+        [pd.read_json(file_name, lines=True) for file_name in glob.glob(LOG_FILES, recursive=True)] * scale
+    )
+    song_df = song_df.drop_duplicates('song_id')
+    for i, song_row in song_df[['song_id', 'title', 'artist_id', 'year', 'duration']].iterrows():
+        warehouse.execute(song_table_insert, {
+            'songId': song_row.song_id, 'title': song_row.title, 'artistId': song_row.artist_id,
+            'year': song_row.year, 'duration': song_row.duration
+        })
+    for i, artist_row in song_df.iterrows():
+        warehouse.execute(artist_table_insert, {
+            'artistId': artist_row.artist_id, 'name': artist_row.artist_name, 'location': artist_row.artist_location,
+            'latitude': artist_row.artist_latitude, 'longitude': artist_row.artist_longitude
+        })
+    warehouse.commit()
+
+    log_df = log_df.loc[log_df['page'] == 'NextSong']
+    ts = pd.to_datetime(log_df.ts.drop_duplicates(), unit='ms')
+    time_df = pd.DataFrame({
+        'startTime': log_df.ts.drop_duplicates(), 'hour': ts.dt.hour, 'day': ts.dt.day,
+        'week': ts.dt.isocalendar().week, 'month': ts.dt.month, 'year': ts.dt.year, 'weekday': ts.dt.weekday
+    })
+    for i, time_row in time_df.iterrows():
+        warehouse.execute(time_table_insert, time_row.to_dict())
+    user_df = log_df.dropna(subset=['userId']).filter(items=['userId', 'firstName', 'lastName', 'gender', 'level'])
+    for i, user_row in user_df.iterrows():
+        warehouse.execute(user_table_insert, user_row.to_dict())
+    for i, log_row in log_df.iterrows():
+        results = warehouse.fetch_one(song_select, {
+            'title': log_row.song, 'artistName': log_row.artist, 'duration': log_row.length
+        })
+        songid, artistid = results if results else (None, None)
+        warehouse.execute(songplay_table_insert, {
+            'startTime': log_row.ts, 'userId': log_row.userId, 'level': log_row.level, 'songId': songid,
+            'artistId': artistid, 'sessionId': log_row.sessionId, 'location': log_row.location,
+            'userAgent': log_row.userAgent
+        })
+    warehouse.commit()
+    return len(song_df) + len(log_df)
+
+
+def load_with_arrow(warehouse, scale):
+    """
+    The Arrow pipeline of etl.py.
+    """
+    song_tables = list(etl.get_files_as_tables(SONG_FILES, etl.SONG_SCHEMA))
+    log_tables = list(etl.get_files_as_tables(LOG_FILES, etl.LOG_SCHEMA)) * scale
+    for table_name, transform in [('songs', etl.transform_songs), ('artists', etl.transform_artists)]:
+        etl.load_stage_output(warehouse, table_name, transform(warehouse, song_tables))
+    warehouse.commit()
+    for table_name, transform in [('time', etl.transform_time), ('users', etl.transform_users),
+                                  ('songplays', etl.transform_songplays)]:
+        etl.load_stage_output(warehouse, table_name, transform(warehouse, log_tables))
+    warehouse.commit()
+    return sum(table.num_rows for table in song_tables) + \
+        sum(etl.filter_next_songs(table).num_rows for table in log_tables)
+
+
+def encode_by_row(log_df):
+    """
+    The Python objects the row by row pipeline hands to psycopg2 for the songplays.
+    """
+    log_df = log_df.loc[log_df['page'] == 'NextSong']
+    rows = [log_row.to_dict() for i, log_row in log_df.iterrows()]
+    return len(rows)
+
+
+def encode_with_arrow(log_table):
+    """
+    The binary COPY stream the Postgres backend sends for the songplays.
+    """
+    songplays = etl.select_columns(etl.filter_next_songs(log_table), {
+        'ts': 'start_time', 'userId': 'user_id', 'level': 'level', 'song': 'song_id', 'artist': 'artist_id',
+        'sessionId': 'session_id', 'location': 'location', 'userAgent': 'user_agent'
+    })
+    stream = BinaryCopyStream(songplays.to_batches(max_chunksize=65536), PG_SONGPLAY_TYPES)
+    while stream.read(8192):
+        pass
+    return songplays.num_rows
+
+
+def measure(name, func, *args):
+    """
+    Runs the function once, then prints its throughput and its peak allocations.
+    """
+    memory_pool = pyarrow.proxy_memory_pool(pyarrow.default_memory_pool())
+    MEMORY_POOLS.append(memory_pool)
+    pyarrow.set_memory_pool(memory_pool)
+    tracemalloc.start()
+    start = time.perf_counter()
+    rows = func(*args)
+    seconds = time.perf_counter() - start
+    python_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print(f"{name:<12} {rows:>9} rows {seconds:>8.3f} s {rows / seconds:>10.0f} rows/s "
+          f"python heap peak {python_peak / 2 ** 20:>7.1f} MiB arrow pool peak {memory_pool.max_memory() / 2 ** 20:>6.1f} MiB")
+
+
+def main():
+    """
+    Main function to run the benchmark
+    :return:
+    """
+    parser = argparse.ArgumentParser(description="Compares the row by row and the Arrow pipelines")
+    add_backend_arguments(parser)
+    parser.add_argument('--scale', type=int, default=1, help="times the log data is repeated")
+    args = parser.parse_args()
+
+    for name, func in [('row load', load_by_row), ('arrow load', load_with_arrow)]:
+        warehouse = create_database(args.backend, args.database)
+        create_tables(warehouse)
+        try:
+            measure(name, func, warehouse, args.scale)
+        finally:
+            warehouse.close()
+
+    log_table = pyarrow.concat_tables([etl.get_files_as_table(LOG_FILES, etl.LOG_SCHEMA)] * args.scale)
+    log_df = log_table.to_pandas()
+    measure('row encode', encode_by_row, log_df)
+    measure('arrow encode', encode_with_arrow, log_table)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,70 +1,110 @@
-import psycopg2
+import argparse
+import os
+import sys
+
 from sql_queries import create_table_queries, drop_table_queries
 
+# the warehouse backends are shared by the Sparkify projects
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from warehouse import BACKEND_DUCKDB, BACKEND_POSTGRES, get_backend
+
+DEFAULT_DSN = "host=127.0.0.1 dbname=studentdb user=student password=student"
+SPARKIFY_DSN = "host=127.0.0.1 dbname=sparkifydb user=student password=student"
+SPARKIFY_DUCKDB_DATABASE = 'sparkify.duckdb'
+
+
+def add_backend_arguments(parser):
+    """
+    Adds the arguments selecting the database the star schema is built in, DuckDB by default for local development.
+    """
+    parser.add_argument('--backend', choices=[BACKEND_DUCKDB, BACKEND_POSTGRES], default=BACKEND_DUCKDB,
+                        help="engine of the sparkify database")
+    parser.add_argument('--database', default=SPARKIFY_DUCKDB_DATABASE,
+                        help="DuckDB database file (':memory:' for an in-memory database)")
+
+
+def connect_to_sparkify(backend, database=SPARKIFY_DUCKDB_DATABASE):
+    """
+    Connects to the sparkify database.
+    :param backend: BACKEND_DUCKDB or BACKEND_POSTGRES.
+    :param database: DuckDB database file.
+    :return: warehouse backend connected to the sparkify database.
+    """
+    if backend == BACKEND_DUCKDB:
+        return get_backend(BACKEND_DUCKDB, database=database)
+    return get_backend(BACKEND_POSTGRES, dsn=SPARKIFY_DSN)
+
 
-def create_database():
+def create_database(backend, database=SPARKIFY_DUCKDB_DATABASE):
     """
-    - Creates and connects to the sparkifydb
-    - Returns the connection and cursor to sparkifydb
+    - Creates and connects to the sparkifydb (a new DuckDB database file for the DuckDB backend)
+    - Returns the warehouse backend connected to sparkifydb
     """
-    
+    if backend == BACKEND_DUCKDB:
+        if database != ':memory:' and os.path.exists(database):
+            os.remove(database)
+        return connect_to_sparkify(backend, database)
+
+    import psycopg2
+
     # connect to default database
-    conn = psycopg2.connect("host=127.0.0.1 dbname=studentdb user=student password=student")
+    conn = psycopg2.connect(DEFAULT_DSN)
     conn.set_session(autocommit=True)
     cur = conn.cursor()
-    
+
     # create sparkify database with UTF8 encoding
     cur.execute("DROP DATABASE IF EXISTS sparkifydb")
     cur.execute("CREATE DATABASE sparkifydb WITH ENCODING 'utf8' TEMPLATE template0")
 
     # close connection to default database
-    conn.close()    
-    
+    conn.close()
+
     # connect to sparkify database
-    conn = psycopg2.connect("host=127.0.0.1 dbname=sparkifydb user=student password=student")
-    cur = conn.cursor()
-    
-    return cur, conn
+    return connect_to_sparkify(backend, database)
 
 
-def drop_tables(cur, conn):
+def drop_tables(warehouse):
     """
     Drops each table using the queries in `drop_table_queries` list.
     """
     for query in drop_table_queries:
-        cur.execute(query)
-        conn.commit()
+        warehouse.execute(query)
+        warehouse.commit()
 
 
-def create_tables(cur, conn):
+def create_tables(warehouse):
     """
-    Creates each table using the queries in `create_table_queries` list. 
+    Creates each table using the queries in `create_table_queries` list.
     """
     for query in create_table_queries:
-        cur.execute(query)
-        conn.commit()
+        warehouse.execute(query)
+        warehouse.commit()
 
 
 def main():
     """
-    - Drops (if exists) and Creates the sparkify database. 
-    
-    - Establishes connection with the sparkify database and gets
-    cursor to it.  
-    
-    - Drops all the tables.  
-    
-    - Creates all tables needed. 
-    
-    - Finally, closes the connection. 
+    - Drops (if exists) and Creates the sparkify database.
+
+    - Establishes connection with the sparkify database through the
+    selected warehouse backend.
+
+    - Drops all the tables.
+
+    - Creates all tables needed.
+
+    - Finally, closes the connection.
     """
-    cur, conn = create_database()
-    
-    drop_tables(cur, conn)
-    create_tables(cur, conn)
+    parser = argparse.ArgumentParser(description="Creates the sparkify database and its tables")
+    add_backend_arguments(parser)
+    args = parser.parse_args()
 
-    conn.close()
+    warehouse = create_database(args.backend, args.database)
+
+    drop_tables(warehouse)
+    create_tables(warehouse)
+
+    warehouse.close()
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,149 @@
+import os
+import shutil
+import tempfile
+from typing import Iterator, List, Optional, Sequence
+
+import numpy
+import pyarrow
+import pyarrow.ipc
+
+
+class DedupMap:
+    """
+    Map keeping a single row per key of the record batches added to it, the row with the highest order value (e.g. the
+    latest event of a user) or, without an order column, the first row of the key (e.g. unique start times).
+
+    The rows are hash partitioned by key. The batches are buffered in memory, once the buffers hold more than
+    max_rows_in_memory rows they are deduplicated and spilled to a file per partition, so the memory only holds the
+    buffers and, when the result is read, the rows of one partition. The keys must be integer columns.
+    The result is read once, after all the rows have been added.
+    """
+
+    def __init__(self, key_columns: Sequence[str], order_column: Optional[str] = None, partition_count: int = 16,
+                 max_rows_in_memory: int = 100000, spill_dir: Optional[str] = None):
+        """
+        :param key_columns: integer columns of the key.
+        :param order_column: column whose highest value selects the row of a key, None to keep the first row.
+        :param partition_count: number of hash partitions, a power of 2.
+        :param max_rows_in_memory: buffered rows above which the buffers are spilled to disk.
+        :param spill_dir: directory of the spill files, the system temporary directory by default.
+        """
+        if partition_count & (partition_count - 1):
+            raise ValueError(f"The partition count must be a power of 2, got {partition_count}")
+        self.key_columns = list(key_columns)
+        self.order_column = order_column
+        self.partition_count = partition_count
+        self.max_rows_in_memory = max_rows_in_memory
+        self.spilled_rows = 0
+
+        self.__spill_dir = tempfile.mkdtemp(prefix='dedup-', dir=spill_dir)
+        self.__buffers: List[List[pyarrow.Table]] = [[] for _ in range(partition_count)]
+        self.__buffered_rows = 0
+        self.__spill_writers = [None] * partition_count
+        self.__is_read = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def add(self, batch):
+        """
+        Adds the rows of a record batch or a table to the map.
+        """
+        if self.__is_read:
+            raise ValueError("Rows cannot be added to the map once its result has been read")
+        table = pyarrow.Table.from_batches([batch]) if isinstance(batch, pyarrow.RecordBatch) else batch
+        partitions = self.__get_partitions(table)
+        for partition in numpy.unique(partitions):
+            self.__buffers[partition].append(table.filter(pyarrow.array(partitions == partition)))
+        self.__buffered_rows += table.num_rows
+        if self.__buffered_rows > self.max_rows_in_memory:
+            self.__spill()
+
+    def partitions(self) -> Iterator[pyarrow.Table]:
+        """
+        Reads the result one partition at a time, the map takes no more rows afterwards.
+        :return: the rows of the keys of every partition, one row per key.
+        """
+        if self.__is_read:
+            raise ValueError("The result of the map has already been read")
+        self.__is_read = True
+        return self.__read_partitions()
+
+    def deduplicate(self, table: pyarrow.Table) -> pyarrow.Table:
+        """
+        The function keeps the row of every key of a table, with sorts and numpy comparisons over whole columns.
+        """
+        if table.num_rows == 0:
+            return table
+        sort_keys = [(column, 'ascending') for column in self.key_columns]
+        if self.order_column:
+            sort_keys.append((self.order_column, 'descending'))
+        table = table.sort_by(sort_keys)
+
+        # the first row of every key in the sort order
+        first_of_key = numpy.zeros(table.num_rows, dtype=bool)
+        first_of_key[0] = True
+        for column in self.key_columns:
+            keys = table[column].to_numpy()
+            first_of_key[1:] |= keys[1:] != keys[:-1]
+        return table.filter(pyarrow.array(first_of_key))
+
+    def close(self):
+        """
+        Removes the spill files.
+        """
+        for writer in self.__spill_writers:
+            if writer is not None:
+                writer.close()
+        shutil.rmtree(self.__spill_dir, ignore_errors=True)
+
+    ####################################################################################################################
+    #                                                                                                                  #
+    #                                               Private functions                                                  #
+    #                                                                                                                  #
+    ####################################################################################################################
+
+    def __get_partitions(self, table: pyarrow.Table) -> numpy.ndarray:
+        """
+        Hashes the keys of the rows with Fibonacci hashing, the high bits of the product pick the partition.
+        """
+        key_hash = numpy.zeros(table.num_rows, dtype=numpy.uint64)
+        for column in self.key_columns:
+            keys = table[column].to_numpy().astype(numpy.int64).view(numpy.uint64)
+            key_hash = (key_hash ^ keys) * numpy.uint64(0x9E3779B97F4A7C15)
+        bit_count = self.partition_count.bit_length() - 1
+        return (key_hash >> numpy.uint64(64 - bit_count)).astype(numpy.int64) if bit_count else \
+            numpy.zeros(table.num_rows, dtype=numpy.int64)
+
+    def __read_partitions(self):
+        for partition in range(self.partition_count):
+            tables = self.__buffers[partition]
+            self.__buffers[partition] = []
+            if self.__spill_writers[partition] is not None:
+                self.__spill_writers[partition].close()
+                self.__spill_writers[partition] = None
+                with pyarrow.OSFile(self.__get_spill_path(partition), 'rb') as spill_file:
+                    tables.append(pyarrow.ipc.open_stream(spill_file).read_all())
+                os.remove(self.__get_spill_path(partition))
+            if tables:
+                yield self.deduplicate(pyarrow.concat_tables(tables))
+
+    def __spill(self):
+        for partition, tables in enumerate(self.__buffers):
+            if not tables:
+                continue
+            spilled_table = self.deduplicate(pyarrow.concat_tables(tables))
+            if self.__spill_writers[partition] is None:
+                self.__spill_writers[partition] = pyarrow.ipc.new_stream(
+                    self.__get_spill_path(partition), spilled_table.schema
+                )
+            self.__spill_writers[partition].write_table(spilled_table)
+            self.spilled_rows += spilled_table.num_rows
+            self.__buffers[partition] = []
+        self.__buffered_rows = 0
+
+    def __get_spill_path(self, partition: int) -> str:
+        return os.path.join(self.__spill_dir, f"partition-{partition}.arrows")
@@ -1,9 +1,67 @@
+import argparse
 import glob
-import pandas as pd
-import psycopg2
+import os
 
+import pyarrow
+import pyarrow.compute
+import pyarrow.ipc
+import pyarrow.json
+
+import dedup
+from create_tables import add_backend_arguments, connect_to_sparkify
+from stage_cache import StageCache, fingerprint_files
+from warehouse.backend import keep_last_per_key
 from sql_queries import *
 
+# The files are parsed straight into Arrow columns of these types, the fields the files do not have are left null and
+# the fields the schemas do not mention are ignored
+SONG_SCHEMA = pyarrow.schema([
+    ('num_songs', pyarrow.int64()),
+    ('artist_id', pyarrow.string()),
+    ('artist_latitude', pyarrow.float64()),
+    ('artist_longitude', pyarrow.float64()),
+    ('artist_location', pyarrow.string()),
+    ('artist_name', pyarrow.string()),
+    ('song_id', pyarrow.string()),
+    ('title', pyarrow.string()),
+    ('duration', pyarrow.float64()),
+    ('year', pyarrow.int64())
+])
+
+LOG_SCHEMA = pyarrow.schema([
+    ('artist', pyarrow.string()),
+    ('auth', pyarrow.string()),
+    ('firstName', pyarrow.string()),
+    ('gender', pyarrow.string()),
+    ('itemInSession', pyarrow.int64()),
+    ('lastName', pyarrow.string()),
+    ('length', pyarrow.float64()),
+    ('level', pyarrow.string()),
+    ('location', pyarrow.string()),
+    ('method', pyarrow.string()),
+    ('page', pyarrow.string()),
+    ('registration', pyarrow.float64()),
+    ('sessionId', pyarrow.int64()),
+    ('song', pyarrow.string()),
+    ('status', pyarrow.int64()),
+    ('ts', pyarrow.int64()),
+    ('userAgent', pyarrow.string()),
+    ('userId', pyarrow.string())
+])
+
+# merge keys and update columns of the dimension tables, the other tables are appended to
+TABLE_MERGES = {
+    'songs': (['song_id'], None),
+    'artists': (['artist_id'], ['name', 'location', 'latitude', 'longitude']),
+    'time': (['start_time'], None),
+    'users': (['user_id'], ['first_name', 'last_name', 'gender', 'level'])
+}
+
+STAGE_OUTPUT_FILE = 'stage.arrow'
+
+# rows the deduplication of the users and the start times buffers before spilling them to disk
+DEDUP_MAX_ROWS_IN_MEMORY = 100000
+
 
 ########################################################################################################################
 #                                                                                                                      #
@@ -12,49 +70,39 @@ from sql_queries import *
 ########################################################################################################################
 
 
-def process_songs(cur, df):
+def transform_songs(warehouse, tables):
     """
-    Processing dataframe to populate songs table
-    :param cur: cursor to execute against
-    :param df: dataframe to process
-    :return:
+    Transforming tables to populate songs table
+    :param warehouse: warehouse backend to execute against
+    :param tables: pyarrow table of every file to process
+    :return: pyarrow tables with the rows of the songs table
     """
     # Transform the data and prepare for insertion
     song_column_name_mapping = {
-        'song_id': 'songId',
+        'song_id': 'song_id',
         'title': 'title',
-        'artist_id': 'artistId',
+        'artist_id': 'artist_id',
         'year': 'year',
         'duration': 'duration'
     }
-    song_df = df.drop_duplicates('song_id').filter(items=list(song_column_name_mapping.keys())).rename(
-        columns=song_column_name_mapping
-    )
-
-    # Load the data into database
-    for i, song_row in song_df.iterrows():
-        cur.execute(song_table_insert, song_row.to_dict())
+    yield select_columns(pyarrow.concat_tables(tables), song_column_name_mapping)
 
 
-def process_artists(cur, df):
+def transform_artists(warehouse, tables):
     """
-    Processing dataframe to populate artists table
-    :param cur: cursor to execute against
-    :param df: dataframe to process
-    :return:
+    Transforming tables to populate artists table
+    :param warehouse: warehouse backend to execute against
+    :param tables: pyarrow table of every file to process
+    :return: pyarrow tables with the rows of the artists table
     """
-    process_songs(cur=cur, df=df)
     artist_column_name_mapping = {
-        'artist_id': 'artistId',
+        'artist_id': 'artist_id',
         'artist_name': 'name',
         'artist_location': 'location',
         'artist_latitude': 'latitude',
         'artist_longitude': 'longitude'
     }
-    artist_df = df.filter(items=list(artist_column_name_mapping.keys())).rename(
-        columns=artist_column_name_mapping)
-    for i, artist_row in artist_df.iterrows():
-        cur.execute(artist_table_insert, artist_row.to_dict())
+    yield select_columns(pyarrow.concat_tables(tables), artist_column_name_mapping)
 
 
 ########################################################################################################################
@@ -63,89 +111,91 @@ def process_artists(cur, df):
 #                                                                                                                      #
 ########################################################################################################################
 
-def process_time(cur, df):
+def transform_time(warehouse, tables):
     """
-    Processing dataframe to populate time table
-    :param cur: cursor to execute against
-    :param df: dataframe to process
-    :return:
+    Transforming tables to populate time table, the files are deduplicated one at a time
+    :param warehouse: warehouse backend to execute against
+    :param tables: pyarrow table of every file to process
+    :return: pyarrow tables with the rows of the time table, one per partition of the start times
     """
-    # filter by NextSong action
-    df = df.loc[df['page'] == 'NextSong']
+    # filter by NextSong action, a row per start time
+    start_times = (select_columns(filter_next_songs(table), {'ts': 'start_time'}) for table in tables)
 
     # prepare time
-    time_df = df.filter(items=['ts']) \
-        .drop_duplicates(subset=['ts']) \
-        .rename(columns={'ts': 'startTime'}) \
-        .assign(ts=lambda r: pd.to_datetime(r.startTime, unit='ms')) \
-        .assign(year=lambda r: r.ts.dt.year) \
-        .assign(month=lambda r: r.ts.dt.month) \
-        .assign(week=lambda r: r.ts.dt.week) \
-        .assign(weekday=lambda r: r.ts.dt.weekday) \
-        .assign(day=lambda r: r.ts.dt.day) \
-        .assign(hour=lambda r: r.ts.dt.hour) \
-        .drop(columns=['ts'])
-
-    for i, time_row in time_df.iterrows():
-        cur.execute(time_table_insert, time_row.to_dict())
-
-
-def process_users(cur, df):
-    """
-    Processing dataframe to populate users table
-    :param cur: cursor to execute against
-    :param df: dataframe to process
-    :return:
+    for partition in deduplicate(start_times, ['start_time']):
+        start_time = partition['start_time']
+        ts = start_time.cast(pyarrow.timestamp('ms'))
+        yield pyarrow.table({
+            'start_time': start_time,
+            'hour': pyarrow.compute.hour(ts),
+            'day': pyarrow.compute.day(ts),
+            'week': pyarrow.compute.iso_week(ts),
+            'month': pyarrow.compute.month(ts),
+            'year': pyarrow.compute.year(ts),
+            'weekday': pyarrow.compute.day_of_week(ts)
+        })
+
+
+def transform_users(warehouse, tables):
     """
-    # filter by NextSong action
-    df = df.loc[df['page'] == 'NextSong']
-    # load user table
-    user_column_names = ['userId', 'firstName', 'lastName', 'gender', 'level']
+    Transforming tables to populate users table, the files are deduplicated one at a time
+    :param warehouse: warehouse backend to execute against
+    :param tables: pyarrow table of every file to process
+    :return: pyarrow tables with the rows of the users table, one per partition of the users
+    """
+    user_column_name_mapping = {
+        'userId': 'user_id',
+        'firstName': 'first_name',
+        'lastName': 'last_name',
+        'gender': 'gender',
+        'level': 'level',
+        'ts': 'ts'
+    }
 
-    user_df = df.dropna(subset=['userId']).assign(userId=lambda r: r.userId.astype(str)).filter(
-        items=user_column_names)
-    #
-    # # insert user records
-    for i, user_row in user_df.iterrows():
-        cur.execute(user_table_insert, user_row)
+    def get_user_events(table):
+        # filter by NextSong action
+        table = filter_known_users(filter_next_songs(table))
+        user_table = select_columns(table, user_column_name_mapping)
+        return user_table.set_column(0, 'user_id', user_table['user_id'].cast(pyarrow.int32()))
 
+    # a row per user, the latest event of a user sets its level
+    for partition in deduplicate((get_user_events(table) for table in tables), ['user_id'], order_column='ts'):
+        yield partition.select(['user_id', 'first_name', 'last_name', 'gender', 'level'])
 
-def process_songplays(cur, df):
+
+def transform_songplays(warehouse, tables):
     """
-    Processing dataframe to populate songplays table
-    :param cur: cursor to execute against
-    :param df: dataframe to process
-    :return:
+    Transforming tables to populate songplays table
+    :param warehouse: warehouse backend to execute against
+    :param tables: pyarrow table of every file to process
+    :return: pyarrow tables with the rows of the songplays table, one per file
     """
-    # filter by NextSong action
-    df = df.loc[df['page'] == 'NextSong']
-    # # insert songplay records
-    for i, log_row in df.iterrows():
-        # get songid and artistid from song and artist tables
-        cur.execute(song_select, {
-            'title': log_row.song,
-            'artistName': log_row.artist,
-            'duration': log_row.length
-        })
-        results = cur.fetchone()
+    # get songid and artistid from song and artist tables, the events of unknown songs keep null ids
+    song_lookup = keep_last_per_key(warehouse.fetch_table(song_lookup_select), ['title', 'artist_name', 'duration'])
+    for table in tables:
+        yield get_songplays(filter_known_users(filter_next_songs(table)), song_lookup)
 
-        if results:
-            songid, artistid = results
-        else:
-            songid, artistid = None, None
-
-        # insert songplay record
-        songplay_data = {
-            'startTime': log_row.ts,
-            'userId': log_row.userId,
-            'level': log_row.level,
-            'songId': songid,
-            'artistId': artistid,
-            'sessionId': log_row.sessionId,
-            'location': log_row.location,
-            'userAgent': log_row.userAgent
-        }
-        cur.execute(songplay_table_insert, songplay_data)
+
+def get_songplays(table, song_lookup):
+    """
+    Convenience method to get the songplays of the NextSong events of a file.
+    """
+    table = table.join(song_lookup, keys=['song', 'artist', 'length'],
+                       right_keys=['title', 'artist_name', 'duration'], join_type='left outer')
+
+    # prepare songplay records
+    songplay_column_name_mapping = {
+        'ts': 'start_time',
+        'userId': 'user_id',
+        'level': 'level',
+        'song_id': 'song_id',
+        'artist_id': 'artist_id',
+        'sessionId': 'session_id',
+        'location': 'location',
+        'userAgent': 'user_agent'
+    }
+    songplay_table = select_columns(table, songplay_column_name_mapping)
+    return songplay_table.set_column(1, 'user_id', songplay_table['user_id'].cast(pyarrow.int32()))
 
 ########################################################################################################################
 #                                                                                                                      #
@@ -154,36 +204,169 @@ def process_songplays(cur, df):
 ########################################################################################################################
 
 
-def get_files_as_dataframe(path_to_files):
+def select_columns(table, column_name_mapping):
+    """
+    Selects the columns of the mapping and renames them to the table column names, without copying the data.
+    :param table: pyarrow table to select from.
+    :param column_name_mapping: table column name of every selected column.
+    :return: pyarrow table with the selected columns.
+    """
+    return table.select(list(column_name_mapping.keys())).rename_columns(list(column_name_mapping.values()))
+
+
+def filter_next_songs(table):
+    """
+    Keeps the NextSong events of the log data.
+    """
+    return table.filter(pyarrow.compute.equal(table['page'], 'NextSong'))
+
+
+def filter_known_users(table):
+    """
+    Keeps the events of logged in users, the logged out events have an empty userId that is not an integer.
+    """
+    # not_equal is null for the null userIds, the filter drops them too
+    return table.filter(pyarrow.compute.not_equal(table['userId'], ''))
+
+
+def deduplicate(tables, key_columns, order_column=None):
+    """
+    Keeps a row per key of the tables, the tables are fed to a dedup map one at a time (one per file) and the result is
+    read one partition at a time, so that the memory the deduplication takes stays bounded as the log data grows.
+    :param tables: pyarrow tables to deduplicate.
+    :param key_columns: integer columns of the key.
+    :param order_column: column whose highest value selects the row of a key, None to keep the first row.
+    :return: pyarrow tables with a row per key, one per partition of the keys.
+    """
+    with dedup.DedupMap(key_columns, order_column=order_column,
+                        max_rows_in_memory=DEDUP_MAX_ROWS_IN_MEMORY) as dedup_map:
+        for table in tables:
+            dedup_map.add(table)
+        if dedup_map.spilled_rows:
+            print(f"Deduplication spilled {dedup_map.spilled_rows} rows to disk")
+        yield from dedup_map.partitions()
+
+
+def load_table(warehouse, table_name, table):
+    """
+    Loads the rows of a table into the database: the dimensions are merged into their table, the facts are appended.
+    :param warehouse: warehouse backend to load the data into
+    :param table_name: name of the database table
+    :param table: pyarrow table with the rows of the database table
     """
-    Recursively goes through a group files in a given directory and generates a single dataframe for those files.
+    if table_name in TABLE_MERGES:
+        key_columns, update_columns = TABLE_MERGES[table_name]
+        warehouse.merge(table_name, table, key_columns=key_columns, update_columns=update_columns)
+    else:
+        warehouse.bulk_load(table_name, table)
+
+
+def load_stage_output(warehouse, table_name, stage_tables, entry_dir=None):
+    """
+    Loads the tables a stage outputs one at a time, and stores them in its stage cache entry as an Arrow IPC file.
+    :param warehouse: warehouse backend to load the data into
+    :param table_name: name of the database table
+    :param stage_tables: pyarrow tables with the rows of the database table
+    :param entry_dir: directory of the new stage cache entry, None to only load the tables
+    """
+    writer = None
+    try:
+        for stage_table in stage_tables:
+            if entry_dir:
+                if writer is None:
+                    writer = pyarrow.ipc.new_file(os.path.join(entry_dir, STAGE_OUTPUT_FILE), stage_table.schema)
+                writer.write_table(stage_table)
+            if stage_table.num_rows:
+                load_table(warehouse, table_name, stage_table)
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+def read_stage_output(entry_dir):
+    """
+    Reads the output of a stage from its stage cache entry one record batch at a time, the file is memory mapped rather
+    than copied.
+    """
+    output_path = os.path.join(entry_dir, STAGE_OUTPUT_FILE)
+    if not os.path.exists(output_path):
+        # the stage did not output any row
+        return
+    reader = pyarrow.ipc.open_file(pyarrow.memory_map(output_path))
+    for i in range(reader.num_record_batches):
+        yield pyarrow.Table.from_batches([reader.get_batch(i)])
+
+
+def get_files_as_tables(path_to_files, schema):
+    """
+    Recursively goes through a group files in a given directory and reads them one at a time into a pyarrow table.
     :param path_to_files: path to files that need to be extracted.
-    :return: dataframe with the data of all the files in the file group.
+    :param schema: pyarrow schema of the files.
+    :return: pyarrow table with the data of every file in the file group.
     """
     all_files = glob.glob(path_to_files, recursive=True)
     print('{} files found in {}'.format(len(all_files), path_to_files))
 
-    return pd.concat([pd.read_json(file_name, lines=True) for file_name in all_files])
+    parse_options = pyarrow.json.ParseOptions(explicit_schema=schema, unexpected_field_behavior='ignore')
+    for file_name in all_files:
+        yield pyarrow.json.read_json(file_name, parse_options=parse_options)
+
 
+def get_files_as_table(path_to_files, schema):
+    """
+    Reads a group of files into a single pyarrow table, the table keeps the record batches of the files as its chunks.
+    """
+    return pyarrow.concat_tables(list(get_files_as_tables(path_to_files, schema)))
+
+
+# the code the transform function of a stage depends on besides the helper functions, hashed into its stage cache key
+STAGE_CODE = {
+    'songplays': [get_songplays, keep_last_per_key, song_lookup_select]
+}
 
-def process_data(cur, conn, filepath, funcs):
+
+def process_data(warehouse, filepath, schema, stages, stage_cache=None, parameters=None):
     """
-    The function extracts the files in a given path to a dataframe and then transforms and saves it by invoking the
-    func functions passed to it as a parameter. Only works with json files at the moment. Any non-json files will be
+    The function extracts the files in a given path to pyarrow tables and then transforms and saves them by invoking the
+    stage functions passed to it as a parameter. Every stage reads the files one at a time and loads its output one
+    table at a time. Only works with json files at the moment. Any non-json files will be
     ignored.
-    :param cur: cursor to execute data load against
-    :param conn: connection to the database
+    With a stage cache, a stage whose input files, parameters and transform function did not change since a previous run
+    is not transformed again, its output is read from the cache. The files are only read by the stages to compute.
+    :param warehouse: warehouse backend to load the data into
     :param filepath: upper-level path to a file group
-    :param funcs: functions to with the logic to save the data to a database.
+    :param schema: pyarrow schema of the files in the file group
+    :param stages: transform function of every table to populate from the file group.
     If an additional table needs to be populated from the same file group, just add a specific to that table function to
-    the funcs array
+    the stages dict
+    :param stage_cache: cache of the stage outputs, None to transform all the stages
+    :param parameters: other parameters of the stages, the stages are recomputed when they change
+    :return: fingerprints of the files of the file group
     """
     filepath_recursive_postfix = '**/*.json'
-    # Get the dataframe from all the files
-    df = get_files_as_dataframe(f'{filepath}/{filepath_recursive_postfix}')
-    for func in funcs:
-        func(cur, df)
-    conn.commit()
+    path_to_files = f'{filepath}/{filepath_recursive_postfix}'
+    inputs = fingerprint_files(glob.glob(path_to_files, recursive=True))
+    parameters = dict(parameters or {}, schema=schema.to_string())
+
+    for table_name, transform in stages.items():
+        key = StageCache.get_key(table_name, inputs, parameters,
+                                 code=[transform, select_columns, filter_next_songs, filter_known_users, deduplicate,
+                                       dedup, *STAGE_CODE.get(table_name, [])])
+        entry_dir = stage_cache.get(key) if stage_cache else None
+        if entry_dir:
+            print(f"Stage {table_name} is unchanged, reading its output from the stage cache")
+            load_stage_output(warehouse, table_name, read_stage_output(entry_dir))
+            continue
+
+        # the stage reads the files as it goes
+        stage_tables = transform(warehouse, get_files_as_tables(path_to_files, schema))
+        if stage_cache:
+            with stage_cache.put(key) as new_entry_dir:
+                load_stage_output(warehouse, table_name, stage_tables, entry_dir=new_entry_dir)
+        else:
+            load_stage_output(warehouse, table_name, stage_tables)
+    warehouse.commit()
+    return inputs
 
 
 def main():
@@ -191,24 +374,36 @@ def main():
     Main function to run the project
     :return:
     """
-    conn = psycopg2.connect("host=127.0.0.1 dbname=sparkifydb user=student password=student")
+    parser = argparse.ArgumentParser(description="Loads the song and log data into the sparkify database")
+    add_backend_arguments(parser)
+    parser.add_argument('--cache-dir', default='.stage_cache', help="directory of the stage cache")
+    parser.add_argument('--cache-max-mb', type=int, default=1024,
+                        help="size of the stage cache above which the least recently used stages are evicted")
+    parser.add_argument('--no-cache', action='store_true', help="transform all the stages")
+    args = parser.parse_args()
+
+    stage_cache = None if args.no_cache else StageCache(args.cache_dir, max_bytes=args.cache_max_mb << 20)
+    warehouse = connect_to_sparkify(args.backend, args.database)
     try:
-        cur = conn.cursor()
-
         song_data_file_path = 'data/song_data'
         print(f"Processing file path:{song_data_file_path}")
-        process_data(cur, conn, filepath=song_data_file_path, funcs=[process_songs, process_artists])
+        song_data_inputs = process_data(warehouse, filepath=song_data_file_path, schema=SONG_SCHEMA,
+                                        stages={'songs': transform_songs, 'artists': transform_artists},
+                                        stage_cache=stage_cache)
         log_data_file_path = 'data/log_data'
 
         print(f"Processing file path:{log_data_file_path}")
-        process_data(cur, conn, filepath=log_data_file_path, funcs=[process_time, process_users, process_songplays])
+        # the song ids of the songplays are looked up in the songs loaded from the song data
+        process_data(warehouse, filepath=log_data_file_path, schema=LOG_SCHEMA,
+                     stages={'time': transform_time, 'users': transform_users, 'songplays': transform_songplays},
+                     stage_cache=stage_cache, parameters={'song_data': song_data_inputs})
 
     except Exception as e:
         print("Something terrible happened" + str(e))
         raise
 
     finally:
-        conn.close()
+        warehouse.close()
 
     print("ETL job complete")
 
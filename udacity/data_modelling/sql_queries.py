@@ -1,6 +1,7 @@
 # DROP TABLES
 
 songplay_table_drop = "DROP TABLE IF EXISTS songplays;"
+songplay_sequence_drop = "DROP SEQUENCE IF EXISTS songplays_seq"
 user_table_drop = "DROP TABLE IF EXISTS users"
 song_table_drop = "DROP TABLE IF EXISTS songs"
 artist_table_drop = "DROP TABLE IF EXISTS artists"
@@ -8,9 +9,13 @@ time_table_drop = "DROP TABLE IF EXISTS time"
 
 # CREATE TABLES
 
+# an explicit sequence instead of serial and double precision instead of float (a 4 byte real in DuckDB), so that the
+# DDL runs the same on Postgres and DuckDB
+songplay_sequence_create = "CREATE SEQUENCE IF NOT EXISTS songplays_seq"
+
 songplay_table_create = ("""
 CREATE TABLE IF NOT EXISTS Songplays(
-    songplay_id serial PRIMARY KEY,
+    songplay_id bigint PRIMARY KEY DEFAULT nextval('songplays_seq'),
     start_time bigint,
     user_id int,
     level text,
@@ -38,7 +43,7 @@ CREATE TABLE IF NOT EXISTS Songs(
     title text,
     artist_id text,
     year int,
-    duration float
+    duration double precision
 )
 """)
 
@@ -47,8 +52,8 @@ CREATE TABLE IF NOT EXISTS Artists(
     artist_id text PRIMARY KEY,
     name text,
     location text,
-    latitude float,
-    longitude float
+    latitude double precision,
+    longitude double precision
 )
 """)
 
@@ -176,7 +181,16 @@ song_select = ("""
         AND s.duration = %(duration)s
 """)
 
+# ids of all the songs by title, artist name and duration, the songplays are matched with them in memory
+song_lookup_select = ("""
+    SELECT s.title, a.name AS artist_name, s.duration, s.song_id, a.artist_id
+    FROM songs AS s INNER JOIN artists AS a
+    ON s.artist_id = a.artist_id
+""")
+
 # QUERY LISTS
 
-create_table_queries = [songplay_table_create, user_table_create, song_table_create, artist_table_create, time_table_create]
-drop_table_queries = [songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop]
\ No newline at end of file
+create_table_queries = [songplay_sequence_create, songplay_table_create, user_table_create, song_table_create,
+                        artist_table_create, time_table_create]
+drop_table_queries = [songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop,
+                      songplay_sequence_drop]
\ No newline at end of file
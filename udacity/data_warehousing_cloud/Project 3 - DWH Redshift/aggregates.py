@@ -0,0 +1,125 @@
+from typing import Dict, List, NamedTuple, Tuple
+
+HOUR_MILLIS = 60 * 60 * 1000
+DAY_MILLIS = 24 * HOUR_MILLIS
+
+
+class AggregateTable(NamedTuple):
+    """
+    Declarative definition of an aggregate table over the songplay fact table. The rows are grouped by a time bucket
+    of grain_millis width (stored in bucket_column as epoch millis of the bucket start) and by the dimensions.
+    """
+    name: str
+    bucket_column: str
+    grain_millis: int
+    # column name -> column type
+    dimensions: Dict[str, str]
+    # column name -> (aggregate expression over songplay, column type)
+    measures: Dict[str, Tuple[str, str]]
+
+
+AGGREGATE_TABLES = [
+    AggregateTable(
+        name='agg_plays_by_hour',
+        bucket_column='play_hour',
+        grain_millis=HOUR_MILLIS,
+        dimensions={},
+        measures={
+            'plays': ('count(*)', 'bigint'),
+            'users': ('count(DISTINCT user_id)', 'bigint')
+        }
+    ),
+    AggregateTable(
+        name='agg_plays_by_level_hour',
+        bucket_column='play_hour',
+        grain_millis=HOUR_MILLIS,
+        dimensions={'level': 'varchar'},
+        measures={
+            'plays': ('count(*)', 'bigint'),
+            'users': ('count(DISTINCT user_id)', 'bigint')
+        }
+    ),
+    AggregateTable(
+        name='agg_plays_by_artist_day',
+        bucket_column='play_day',
+        grain_millis=DAY_MILLIS,
+        dimensions={'artist_id': 'varchar'},
+        measures={
+            'plays': ('count(*)', 'bigint'),
+            'users': ('count(DISTINCT user_id)', 'bigint')
+        }
+    ),
+]
+
+
+def get_create_query(aggregate: AggregateTable) -> str:
+    """
+    The function generates the DDL of an aggregate table.
+    :param aggregate: aggregate table definition.
+    :return: create table query.
+    """
+    columns = [f'"{aggregate.bucket_column}" bigint NOT NULL SORTKEY'] + \
+              [f'"{name}" {column_type}' for name, column_type in aggregate.dimensions.items()] + \
+              [f'"{name}" {column_type}' for name, (_, column_type) in aggregate.measures.items()]
+    column_definitions = ',\n    '.join(columns)
+    return f"""
+CREATE TABLE {aggregate.name} (
+    {column_definitions}
+) diststyle all;
+"""
+
+
+def get_drop_query(aggregate: AggregateTable) -> str:
+    """
+    The function generates the drop query of an aggregate table.
+    :param aggregate: aggregate table definition.
+    :return: drop table query.
+    """
+    return f"DROP TABLE IF EXISTS {aggregate.name}"
+
+
+def get_refresh_query(aggregate: AggregateTable) -> str:
+    """
+    The function generates the query that recomputes the buckets of an aggregate table between %(bucket_start)s and
+    %(bucket_end)s from the songplay table. Only the buckets touched by the processed window are deleted and
+    re-inserted, so the refresh is proportional to the window and not to the whole fact table.
+    :param aggregate: aggregate table definition.
+    :return: delete/insert query to run with the parameters provided by get_refresh_params.
+    """
+    bucket_expression = f"(start_time / {aggregate.grain_millis}) * {aggregate.grain_millis}"
+    columns = [aggregate.bucket_column] + list(aggregate.dimensions) + list(aggregate.measures)
+    selected = [f"{bucket_expression} AS {aggregate.bucket_column}"] + \
+               list(aggregate.dimensions) + \
+               [f"{expression} AS {name}" for name, (expression, _) in aggregate.measures.items()]
+    group_by = ', '.join(str(position) for position in range(1, len(aggregate.dimensions) + 2))
+    return f"""
+DELETE FROM {aggregate.name}
+WHERE {aggregate.bucket_column} >= %(bucket_start)s
+  AND {aggregate.bucket_column} < %(bucket_end)s;
+
+INSERT INTO {aggregate.name} ({', '.join(columns)})
+SELECT {', '.join(selected)}
+FROM songplay
+WHERE start_time >= %(bucket_start)s
+  AND start_time < %(bucket_end)s
+GROUP BY {group_by};
+"""
+
+
+def get_refresh_params(aggregate: AggregateTable, window: Dict) -> Dict:
+    """
+    The function widens a time window to the whole buckets of an aggregate table, so a partially processed bucket is
+    always recomputed in full.
+    :param aggregate: aggregate table definition.
+    :param window: time window (window_start/window_end in epoch millis).
+    :return: parameters for the refresh query.
+    """
+    grain = aggregate.grain_millis
+    return {
+        'bucket_start': (window['window_start'] // grain) * grain,
+        'bucket_end': -(-window['window_end'] // grain) * grain
+    }
+
+
+aggregate_table_create_queries: List[str] = [get_create_query(aggregate) for aggregate in AGGREGATE_TABLES]
+aggregate_table_drop_queries: List[str] = [get_drop_query(aggregate) for aggregate in AGGREGATE_TABLES]
@@ -2,6 +2,7 @@ import configparser
 
 import psycopg2
 
+from query_profiler import ProfilingCursor
 from redshift_utils import get_redshift_connection_string
 from sql_queries import create_table_queries, drop_table_queries
 
@@ -42,13 +43,15 @@ def main():
 
     connection_string = get_redshift_connection_string(config=config)
     conn = psycopg2.connect(connection_string)
-    cur = conn.cursor()
+    cur = ProfilingCursor(conn.cursor())
 
     drop_tables(cur, conn)
     create_tables(cur, conn)
 
     conn.close()
 
+    cur.print_report()
+
     print("Tables have been successfully created")
 
 
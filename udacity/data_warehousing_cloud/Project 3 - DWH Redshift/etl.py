@@ -1,32 +1,209 @@
+import argparse
 import configparser
+from datetime import date, datetime, timedelta, timezone
+from typing import Dict, List, Optional, Tuple
+
 import psycopg2
 
-from redshift_utils import get_redshift_connection_string
-from sql_queries import copy_table_queries, insert_table_queries
+from aggregates import AGGREGATE_TABLES, get_refresh_params, get_refresh_query
+from query_profiler import ProfilingCursor
+from redshift_utils import get_log_partition_days, get_redshift_connection_string
+from sql_queries import (insert_table_queries, log_data_prefix, staging_events_copy_template, staging_events_truncate,
+                         staging_events_copy_options, staging_songs_copy, staging_songs_truncate, high_water_mark_select,
+                         high_water_mark_upsert, staging_events_max_ts_select)
+
+ETL_PIPELINE_NAME = 'sparkify_songplays'
 
+# Bounds (epoch millis) used when the whole log history is processed.
+FULL_HISTORY_WINDOW = {'window_start': 0, 'window_end': 2 ** 62}
 
-def load_staging_tables(cur, conn):
+
+def load_staging_tables(cur, conn, window: Dict = None, reload_songs: bool = True,
+                        partition_days: Optional[List[date]] = None):
     """
-    The function to load data from s3 to the staging tables.
+    The function to load data from s3 to the staging tables. The staging tables are truncated before each load, so
+    that only the data of the current run is merged into the star schema.
     :param cur: cursor to execute the query with.
     :param conn: connection to commit transaction.
+    :param window: time window (window_start/window_end in epoch millis) to copy the log partitions for. The whole
+    LOG_DATA prefix is copied if not provided.
+    :param reload_songs: whether the song data needs to be copied to the staging_songs table as well. If not, the
+    songs staged by a previous run are reused.
+    :param partition_days: days with a log file in s3, only their partitions are copied on windowed runs.
     """
-    for query in copy_table_queries:
-        cur.execute(query)
+    cur.execute(staging_events_truncate)
+    conn.commit()
+    for prefix in get_log_partition_prefixes(window, partition_days):
+        print(f"Copying log data from {prefix}")
+        try:
+            cur.execute(staging_events_copy_template.format(log_data_prefix=prefix,
+                                                           copy_options=staging_events_copy_options))
+            conn.commit()
+        except psycopg2.InternalError as e:
+            # Partitions with no log files for the day are skipped
+            if 'does not exist' not in str(e):
+                raise
+            conn.rollback()
+            print(f"No log data found in {prefix}")
+
+    if reload_songs:
+        cur.execute(staging_songs_truncate)
+        conn.commit()
+        cur.execute(staging_songs_copy)
         conn.commit()
 
 
-def insert_tables(cur, conn):
+def insert_tables(cur, conn, window: Dict = None):
     """
     The function to insert the data from the staging tables to the star schema tables.
     :param cur: cursor to execute the query with.
     :param conn: connection to commit transaction.
+    :param window: time window (window_start/window_end in epoch millis) the merges are limited to. All the staged
+    data is merged if not provided.
     """
     for query in insert_table_queries:
-        cur.execute(query)
+        cur.execute(query, window or FULL_HISTORY_WINDOW)
+        conn.commit()
+
+
+def refresh_aggregate_tables(cur, conn, window: Dict = None):
+    """
+    The function to refresh the aggregate tables described in aggregates.py from the songplay table. Only the time
+    buckets covered by the window are recomputed.
+    :param cur: cursor to execute the query with.
+    :param conn: connection to commit transaction.
+    :param window: time window (window_start/window_end in epoch millis) to refresh the aggregates for. All the
+    buckets are recomputed if not provided.
+    """
+    for aggregate in AGGREGATE_TABLES:
+        cur.execute(get_refresh_query(aggregate), get_refresh_params(aggregate, window or FULL_HISTORY_WINDOW))
         conn.commit()
 
 
+def get_log_partition_prefixes(window: Dict = None, partition_days: Optional[List[date]] = None) -> List[str]:
+    """
+    The function converts a time window to the list of s3 key prefixes of the log files that cover the window.
+    Log files are stored as log_data/{year}/{month}/{year}-{month}-{day}-events.json, so one prefix per day is returned.
+    :param window: time window (window_start/window_end in epoch millis).
+    :param partition_days: days with a log file in s3, every day of the window is probed if not provided.
+    :return: list of s3 prefixes to copy the log data from.
+    """
+    if not window or window == FULL_HISTORY_WINDOW:
+        return [log_data_prefix]
+
+    day = to_datetime(window['window_start']).date()
+    last_day = to_datetime(window['window_end'] - 1).date()
+    prefixes = []
+    while day <= last_day:
+        if partition_days is None or day in partition_days:
+            prefixes.append(f"{log_data_prefix}/{day:%Y}/{day:%m}/{day:%Y-%m-%d}")
+        day = day + timedelta(days=1)
+    return prefixes
+
+
+def get_high_water_mark(cur) -> Optional[int]:
+    """
+    The function reads the timestamp (epoch millis) up to which the log data has been processed by the previous runs.
+    :param cur: cursor to execute the query with.
+    :return: high-water mark or None if the pipeline has never been run.
+    """
+    cur.execute(high_water_mark_select, {'pipeline': ETL_PIPELINE_NAME})
+    result = cur.fetchone()
+    return result[0] if result else None
+
+
+def set_high_water_mark(cur, conn, high_water_mark: int):
+    """
+    The function stores the timestamp (epoch millis) up to which the log data has been processed.
+    :param cur: cursor to execute the query with.
+    :param conn: connection to commit transaction.
+    :param high_water_mark: new high-water mark.
+    """
+    cur.execute(high_water_mark_upsert, {'pipeline': ETL_PIPELINE_NAME, 'high_water_mark': high_water_mark})
+    conn.commit()
+
+
+def get_window(cur, args) -> Optional[Dict]:
+    """
+    The function resolves the time window to process from the command line arguments.
+    :param cur: cursor to execute the query with.
+    :param args: parsed command line arguments.
+    :return: time window (window_start/window_end in epoch millis) or None if the whole history is to be processed.
+    """
+    if args.incremental:
+        window_start = get_high_water_mark(cur)
+        if window_start is None:
+            print("No high-water mark found, processing the whole history")
+            return None
+        window_end = to_epoch_millis(datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0))
+    elif args.start:
+        window_start = to_epoch_millis(args.start)
+        window_end = to_epoch_millis(args.end) if args.end else window_start + 60 * 60 * 1000
+    else:
+        return None
+
+    return {'window_start': window_start, 'window_end': window_end}
+
+
+def get_window_months(window: Dict) -> List[Tuple[int, int]]:
+    """
+    The function lists the months of a time window, the log partitions are listed from s3 one month prefix at a time.
+    :param window: time window (window_start/window_end in epoch millis).
+    :return: (year, month) of every month the window covers.
+    """
+    month = to_datetime(window['window_start']).date().replace(day=1)
+    last_month = to_datetime(window['window_end'] - 1).date().replace(day=1)
+    months = []
+    while month <= last_month:
+        months.append((month.year, month.month))
+        month = (month + timedelta(days=32)).replace(day=1)
+    return months
+
+
+def limit_window_to_partitions(window: Dict, partition_days: List[date]) -> Dict:
+    """
+    The function ends an incremental window with the newest log partition, so that the high-water mark does not move
+    past the days without logs yet.
+    :param window: time window (window_start/window_end in epoch millis).
+    :param partition_days: days of the window with a log file in s3.
+    :return: time window ending at the end of the newest partition day at most, empty if the window has no partition.
+    """
+    if not partition_days:
+        return {'window_start': window['window_start'], 'window_end': window['window_start']}
+    newest_partition_end = datetime.combine(partition_days[-1] + timedelta(days=1), datetime.min.time())
+    return {'window_start': window['window_start'],
+            'window_end': min(window['window_end'], to_epoch_millis(newest_partition_end))}
+
+
+def to_epoch_millis(value: datetime) -> int:
+    """
+    Convenience method to convert a datetime (naive datetimes are treated as utc) to epoch millis.
+    """
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return int(value.timestamp() * 1000)
+
+
+def to_datetime(epoch_millis: int) -> datetime:
+    """
+    Convenience method to convert epoch millis to a utc datetime.
+    """
+    return datetime.fromtimestamp(epoch_millis / 1000, tz=timezone.utc)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Populate the dwh tables for the sparkify system.')
+    parser.add_argument('--start', type=datetime.fromisoformat,
+                        help='start (utc, inclusive) of the time window to process, e.g. 2018-11-05T13:00')
+    parser.add_argument('--end', type=datetime.fromisoformat,
+                        help='end (utc, exclusive) of the time window to process. Defaults to an hour after --start')
+    parser.add_argument('--incremental', action='store_true',
+                        help='process the data from the stored high-water mark up to the current hour')
+    parser.add_argument('--reload-songs', action='store_true',
+                        help='copy the song data to staging on windowed runs too (always done for full runs)')
+    return parser.parse_args()
+
+
 def main():
     """
     The main method to run in order to populate the dwh tables for the sparkify system.
@@ -35,20 +212,52 @@ def main():
     1. Loading data from s3 to the staging tables.
     2. Inserting data to the dwh tables from the staging tables. Any data found in the staging tables that is also
     present in the facts/dimension tables is removed to avoid duplicates or stale state.
+    3. Refreshing the aggregate tables over the songplay table for the processed time buckets.
+    Every statement is profiled and a timing table is printed at the end (details are saved to etl_profile.json).
+    Both steps can be limited to a time window (--start/--end) or to the data newer than the high-water mark stored in
+    the etl_control table (--incremental). The high-water mark is moved forward after every successful run.
     """
+    args = parse_args()
     print("Starting etl")
     config = configparser.ConfigParser()
     config.read('dwh.cfg')
 
     connection_string = get_redshift_connection_string(config=config)
     conn = psycopg2.connect(connection_string)
-    cur = conn.cursor()
+    cur = ProfilingCursor(conn.cursor())
 
-    load_staging_tables(cur, conn)
-    insert_tables(cur, conn)
+    window = get_window(cur, args)
+    partition_days = None
+    if window:
+        # only the month prefixes of the window are listed
+        partition_days = get_log_partition_days(config, log_data_prefix, get_window_months(window))
+        if args.incremental:
+            window = limit_window_to_partitions(window, partition_days)
+    if window and window['window_start'] >= window['window_end']:
+        print("The high-water mark is up to date, nothing to process")
+        conn.close()
+        return
+    if window:
+        print(f"Processing window {to_datetime(window['window_start'])} - {to_datetime(window['window_end'])}")
+
+    load_staging_tables(cur, conn, window=window, reload_songs=window is None or args.reload_songs,
+                        partition_days=partition_days)
+    insert_tables(cur, conn, window=window)
+    refresh_aggregate_tables(cur, conn, window=window)
+
+    if window:
+        set_high_water_mark(cur, conn, window['window_end'])
+    else:
+        cur.execute(staging_events_max_ts_select)
+        max_ts = cur.fetchone()[0]
+        if max_ts is not None:
+            set_high_water_mark(cur, conn, max_ts + 1)
 
     conn.close()
 
+    cur.print_report()
+    cur.save_report('etl_profile.json')
+
     print("Etl is finished")
 
 
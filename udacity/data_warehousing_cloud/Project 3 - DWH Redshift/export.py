@@ -0,0 +1,197 @@
+import argparse
+import configparser
+import json
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List
+
+import psycopg2
+
+from redshift_utils import get_redshift_connection_string
+from sql_queries import unload_template, unload_count_select, export_queries
+
+# Postgres type oids mapped to the arrow type names the exported columns are read with. Any other type is read as string.
+POSTGRES_TO_ARROW_TYPES = {
+    16: 'bool',
+    20: 'int64',
+    21: 'int16',
+    23: 'int32',
+    700: 'float32',
+    701: 'float64',
+    1700: 'float64',
+    1082: 'date32',
+    1114: 'timestamp',
+    1184: 'timestamp',
+}
+
+
+def unload_to_s3(conn, name: str, query: str, partition_by: List[str], location: str) -> Dict:
+    """
+    The function exports the result of a query to s3 as parquet files with the redshift UNLOAD command. Redshift
+    writes the files in parallel from all the slices together with a manifest listing them.
+    :param conn: connection to the redshift cluster.
+    :param name: name of the export, used as the s3 folder name.
+    :param query: query to export the result of.
+    :param partition_by: columns to partition the output by.
+    :param location: s3 location to export the data to.
+    :return: export description to be stored in the run manifest.
+    """
+    target = f"{location}/{name}/"
+    cur = conn.cursor()
+    cur.execute(unload_template.format(
+        query=query.replace("'", "\\'"),
+        location=target,
+        partition_by=f"PARTITION BY ({', '.join(partition_by)})" if partition_by else ""
+    ))
+    cur.execute(unload_count_select)
+    rows = cur.fetchone()[0]
+    conn.commit()
+    return {'location': target, 'manifest': f"{target}manifest", 'rows': rows}
+
+
+def copy_to_parquet(conn, name: str, query: str, partition_by: List[str], location: str) -> Dict:
+    """
+    The function exports the result of a query from a (local) postgres database to parquet files. The data is streamed
+    out with COPY TO into a temporary csv file and then written batch by batch with arrow, so the query result never
+    has to fit in memory.
+    :param conn: connection to the postgres database.
+    :param name: name of the export, used as the output folder name.
+    :param query: query to export the result of.
+    :param partition_by: columns to partition the output by.
+    :param location: local folder to export the data to.
+    :return: export description to be stored in the run manifest.
+    """
+    import pyarrow.csv as pa_csv
+    import pyarrow.dataset as pa_dataset
+
+    target = os.path.join(location, name)
+    cur = conn.cursor()
+    cur.execute(f"SELECT * FROM ({query.rstrip().rstrip(';')}) AS export LIMIT 0")
+    column_types = {column.name: get_arrow_type(column.type_code) for column in cur.description}
+
+    with tempfile.TemporaryFile() as csv_file:
+        cur.copy_expert(f"COPY ({query.rstrip().rstrip(';')}) TO STDOUT WITH CSV HEADER", csv_file)
+        conn.commit()
+        csv_file.seek(0)
+        reader = pa_csv.open_csv(csv_file, convert_options=pa_csv.ConvertOptions(column_types=column_types))
+
+        written_files = []
+        pa_dataset.write_dataset(
+            reader,
+            target,
+            format='parquet',
+            partitioning=partition_by or None,
+            partitioning_flavor='hive' if partition_by else None,
+            existing_data_behavior='delete_matching',
+            file_visitor=lambda written_file: written_files.append(written_file)
+        )
+
+    manifest = {
+        'entries': [{'url': written_file.path, 'meta': {'rows': written_file.metadata.num_rows}}
+                    for written_file in written_files]
+    }
+    with open(os.path.join(target, 'manifest'), 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+
+    return {
+        'location': target,
+        'manifest': os.path.join(target, 'manifest'),
+        'rows': sum(entry['meta']['rows'] for entry in manifest['entries'])
+    }
+
+
+def get_arrow_type(type_code: int):
+    """
+    Convenience method to get the arrow type to read a postgres column of the given type oid with.
+    """
+    import pyarrow as pa
+
+    type_name = POSTGRES_TO_ARROW_TYPES.get(type_code, 'string')
+    return pa.timestamp('us') if type_name == 'timestamp' else getattr(pa, type_name)()
+
+
+def run_exports(connect: Callable, export_function: Callable, exports: Dict, location: str, parallelism: int) -> Dict:
+    """
+    The function runs a set of exports concurrently, each on its own connection.
+    :param connect: function returning a new database connection.
+    :param export_function: unload_to_s3 for redshift or copy_to_parquet for a local postgres database.
+    :param exports: exports to run, name -> (query, partition columns).
+    :param location: location to export the data to.
+    :param parallelism: maximum number of exports to run at the same time.
+    :return: run manifest, export name -> export description.
+    """
+    def run_export(name):
+        query, partition_by = exports[name]
+        print(f"Exporting {name}")
+        start = time.time()
+        conn = connect()
+        try:
+            result = export_function(conn, name, query, partition_by, location)
+        finally:
+            conn.close()
+        result['partition_by'] = partition_by
+        result['seconds'] = round(time.time() - start, 3)
+        print(f"Exported {result['rows']} rows of {name} in {result['seconds']}s")
+        return name, result
+
+    with ThreadPoolExecutor(max_workers=parallelism) as executor:
+        return dict(executor.map(run_export, exports))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Export the sparkify star schema tables to partitioned parquet.')
+    parser.add_argument('exports', nargs='*', default=list(export_queries.keys()),
+                        help=f"exports to run. Available: {', '.join(export_queries.keys())}. Defaults to all")
+    parser.add_argument('--query', nargs=2, action='append', default=[], metavar=('NAME', 'SQL'),
+                        help='additional ad hoc query to export under the given name')
+    parser.add_argument('--partition-by', default='',
+                        help='comma-separated partition columns for the --query exports')
+    parser.add_argument('--local', metavar='DSN',
+                        help='export from a local postgres database with the given connection string instead of '
+                             'redshift')
+    parser.add_argument('--parallelism', type=int, help='number of exports to run at the same time')
+    return parser.parse_args()
+
+
+def main():
+    """
+    The main method to run in order to export the dwh tables for the sparkify system.
+    The exports are described in sql_queries.py and the target locations are configured in the EXPORT section of dwh.cfg.
+    On redshift the data is unloaded to s3, when --local is passed the data is streamed out of a postgres database and
+    written to the local file system. A manifest of the run is written to export_manifest.json.
+    """
+    args = parse_args()
+    print("Starting export")
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+
+    exports = {name: export_queries[name] for name in args.exports}
+    ad_hoc_partition_by = [column.strip() for column in args.partition_by.split(',') if column.strip()]
+    exports.update({name: (query, ad_hoc_partition_by) for name, query in args.query})
+
+    if args.local:
+        connect = lambda: psycopg2.connect(args.local)
+        export_function = copy_to_parquet
+        location = config.get('EXPORT', 'LOCAL_LOCATION')
+    else:
+        connection_string = get_redshift_connection_string(config=config)
+        connect = lambda: psycopg2.connect(connection_string)
+        export_function = unload_to_s3
+        location = config.get('EXPORT', 'S3_LOCATION').strip("'").rstrip('/')
+
+    run_manifest = run_exports(connect=connect,
+                               export_function=export_function,
+                               exports=exports,
+                               location=location,
+                               parallelism=args.parallelism or config.getint('EXPORT', 'PARALLELISM'))
+
+    with open('export_manifest.json', 'w') as manifest_file:
+        json.dump(run_manifest, manifest_file, indent=2)
+
+    print("Export is finished")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+import json
+import re
+import time
+from typing import Dict, List
+
+import psycopg2
+
+QUERY_ID_SELECT = "SELECT pg_last_query_id()"
+
+QUERY_SUMMARY_SELECT = """
+SELECT seg, step, label, rows, bytes, maxtime, is_diskbased
+FROM svl_query_summary
+WHERE query = %(query_id)s
+ORDER BY seg, step
+"""
+
+LOAD_ERRORS_SELECT = """
+SELECT query, filename, line_number, colname, type, err_code, err_reason
+FROM stl_load_errors
+WHERE session = pg_backend_pid()
+  AND starttime >= %(started_at)s
+ORDER BY starttime DESC
+LIMIT 10
+"""
+
+STATEMENT_DESCRIPTION_PATTERN = re.compile(
+    r'^\s*(COPY|UNLOAD|TRUNCATE|DELETE FROM|INSERT INTO|UPDATE|SELECT|DROP TABLE IF EXISTS|DROP TABLE|'
+    r'CREATE TABLE IF NOT EXISTS|CREATE TABLE|REFRESH MATERIALIZED VIEW|ANALYZE|VACUUM)\s+(\S+)',
+    re.IGNORECASE
+)
+
+
+class ProfilingCursor:
+    """
+    This class wraps a psycopg2 cursor and records the wall time, the number of affected rows and (on redshift) the
+    query id, the svl_query_summary rows and the stl_load_errors rows of every statement executed through it.
+    Any other cursor attribute (fetchone, description, ...) is delegated to the wrapped cursor.
+    """
+    def __init__(self, cursor):
+        self.__cursor = cursor
+        self.__is_redshift = self.__detect_redshift()
+        self.records = []
+
+    def __getattr__(self, name):
+        return getattr(self.__cursor, name)
+
+    def execute(self, query, params=None):
+        """
+        Executes the query with the wrapped cursor and records its profile.
+        :param query: query to execute.
+        :param params: query parameters.
+        """
+        record = {
+            'step': len(self.records) + 1,
+            'statement': describe_statement(query),
+            'seconds': None,
+            'rows': None,
+            'query_id': None,
+            'query_summary': [],
+            'load_errors': []
+        }
+        self.records.append(record)
+
+        started_at = time.time()
+        try:
+            self.__cursor.execute(query, params)
+        except psycopg2.Error as e:
+            record['seconds'] = round(time.time() - started_at, 3)
+            record['error'] = str(e).strip()
+            if self.__is_redshift and record['statement'].upper().startswith('COPY'):
+                record['load_errors'] = self.__get_load_errors(started_at)
+            raise
+        record['seconds'] = round(time.time() - started_at, 3)
+        record['rows'] = self.__cursor.rowcount
+
+        if self.__is_redshift:
+            record['query_id'] = self.__fetch_all(QUERY_ID_SELECT)[0][0]
+            record['query_summary'] = self.__fetch_all(QUERY_SUMMARY_SELECT, {'query_id': record['query_id']})
+
+    def print_report(self):
+        """
+        Prints the timing table of all the statements executed so far and flags the slowest one.
+        """
+        timed_records = [record for record in self.records if record['seconds'] is not None]
+        if not timed_records:
+            return
+        total = sum(record['seconds'] for record in timed_records) or 1
+        slowest = max(timed_records, key=lambda r: r['seconds'])
+
+        print(f"{'step':>4}  {'statement':<60}  {'seconds':>9}  {'share':>6}  {'rows':>10}  {'query id':>9}")
+        for record in timed_records:
+            print(f"{record['step']:>4}  {record['statement'][:60]:<60}  {record['seconds']:>9.3f}  "
+                  f"{record['seconds'] / total:>6.1%}  {format_optional(record['rows']):>10}  "
+                  f"{format_optional(record['query_id']):>9}"
+                  f"{'  <-- slowest' if record is slowest else ''}")
+        print(f"Total: {sum(record['seconds'] for record in timed_records):.3f} seconds")
+
+        for row in slowest['query_summary']:
+            print(f"    {row}")
+        for record in timed_records:
+            for row in record['load_errors']:
+                print(f"    load error in step {record['step']}: {row}")
+
+    def save_report(self, path: str):
+        """
+        Saves the profile of all the statements executed so far as json.
+        :param path: path of the file to save the profile to.
+        """
+        with open(path, 'w') as report_file:
+            json.dump(self.records, report_file, indent=2, default=str)
+
+    ####################################################################################################################
+    #                                                                                                                  #
+    #                                                  Private methods                                                 #
+    #                                                                                                                  #
+    ####################################################################################################################
+
+    def __detect_redshift(self) -> bool:
+        """
+        The function checks whether the cursor is connected to redshift, where the system tables are available.
+        """
+        return 'redshift' in self.__fetch_all("SELECT version()")[0][0].lower()
+
+    def __fetch_all(self, query: str, params: Dict = None) -> List:
+        """
+        The function runs a query on a separate cursor, so the result set of the profiled statement is kept intact.
+        """
+        cursor = self.__cursor.connection.cursor()
+        try:
+            cursor.execute(query, params)
+            return cursor.fetchall()
+        finally:
+            cursor.close()
+
+    def __get_load_errors(self, started_at: float) -> List:
+        """
+        The function reads the stl_load_errors rows of a failed COPY. The failed transaction needs to be rolled back
+        before the system table can be queried.
+        """
+        self.__cursor.connection.rollback()
+        return self.__fetch_all(LOAD_ERRORS_SELECT,
+                                {'started_at': time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(started_at))})
+
+
+def describe_statement(query: str) -> str:
+    """
+    Convenience method to get a short description of the statements in a query, e.g. "DELETE FROM songplay; INSERT INTO
+    songplay".
+    :param query: query to describe.
+    :return: description of the query.
+    """
+    descriptions = []
+    for statement in query.split(';'):
+        if not statement.strip():
+            continue
+        match = STATEMENT_DESCRIPTION_PATTERN.match(statement)
+        descriptions.append(
+            f"{match.group(1).upper()} {match.group(2)}" if match else ' '.join(statement.split())[:40]
+        )
+    return '; '.join(descriptions)
+
+
+def format_optional(value) -> str:
+    return '' if value is None else str(value)
@@ -0,0 +1,96 @@
+import re
+from typing import Dict, Tuple
+
+# dashboard query name -> (query against the star schema, equivalent query against the aggregate tables)
+DASHBOARD_QUERIES: Dict[str, Tuple[str, str]] = {
+    'plays_per_hour': ("""
+SELECT (start_time / 3600000) * 3600000 AS play_hour,
+       count(*)                         AS plays
+FROM songplay
+GROUP BY 1
+ORDER BY 1
+""", """
+SELECT play_hour,
+       plays
+FROM agg_plays_by_hour
+ORDER BY 1
+"""),
+    'plays_per_level': ("""
+SELECT level,
+       count(*) AS plays
+FROM songplay
+GROUP BY level
+ORDER BY plays DESC
+""", """
+SELECT level,
+       sum(plays) AS plays
+FROM agg_plays_by_level_hour
+GROUP BY level
+ORDER BY plays DESC
+"""),
+    'plays_per_level_and_hour': ("""
+SELECT (start_time / 3600000) * 3600000 AS play_hour,
+       level,
+       count(*)                         AS plays
+FROM songplay
+GROUP BY 1, 2
+ORDER BY 1, 2
+""", """
+SELECT play_hour,
+       level,
+       plays
+FROM agg_plays_by_level_hour
+ORDER BY 1, 2
+"""),
+    'top_artists': ("""
+SELECT a.name,
+       count(*) AS plays
+FROM songplay AS sp
+         JOIN artist AS a
+              ON sp.artist_id = a.artist_id
+GROUP BY a.name
+ORDER BY plays DESC
+LIMIT 10
+""", """
+SELECT a.name,
+       sum(agg.plays) AS plays
+FROM agg_plays_by_artist_day AS agg
+         JOIN artist AS a
+              ON agg.artist_id = a.artist_id
+GROUP BY a.name
+ORDER BY plays DESC
+LIMIT 10
+"""),
+}
+
+
+def normalize_query(query: str) -> str:
+    """
+    Convenience method to bring a query to a canonical form (lower case, single spaces, no trailing semicolon), so that
+    formatting differences do not prevent a dashboard query from being recognised.
+    """
+    return re.sub(r'\s+', ' ', query).strip().rstrip(';').strip().lower()
+
+
+ROUTES: Dict[str, str] = {
+    normalize_query(fact_query): aggregate_query for fact_query, aggregate_query in DASHBOARD_QUERIES.values()
+}
+
+
+def route_query(query: str) -> str:
+    """
+    The function rewrites a known dashboard query to the equivalent query against the aggregate tables.
+    :param query: query to route.
+    :return: query against the aggregate tables, or the query itself if it is not a known dashboard query.
+    """
+    return ROUTES.get(normalize_query(query), query)
+
+
+def execute_routed(cur, query: str, params=None):
+    """
+    Convenience method to execute a query with the cursor after routing it to the aggregate tables if possible.
+    :param cur: cursor to execute the query with.
+    :param query: query to execute.
+    :param params: query parameters.
+    """
+    cur.execute(route_query(query), params)
@@ -1,5 +1,7 @@
+import re
 from configparser import ConfigParser
-from typing import Dict
+from datetime import date
+from typing import Dict, Iterable, List, Tuple
 
 import boto3
 
@@ -45,3 +47,35 @@ def get_redshift_connection_string(config: ConfigParser) -> str:
         secret=SECRET,
         cluster_identifier=DWH_CLUSTER_IDENTIFIER)['Endpoint']
     return f"host={endpoint_info['Address']} dbname={DWH_DB} user={DWH_DB_USER} password={DWH_DB_PASSWORD} port={endpoint_info['Port']}"
+
+
+# log files are stored as log_data/{year}/{month}/{year}-{month}-{day}-events.json
+LOG_FILE_PATTERN = re.compile(r"(\d{4})-(\d{2})-(\d{2})-events\.json$")
+
+
+def get_log_partition_days(config: ConfigParser, location: str, months: Iterable[Tuple[int, int]]) -> List[date]:
+    """
+    Convenience method to list the days that have a log file in s3, so that only the existing log partitions are copied.
+    Only the {year}/{month} prefixes of the given months are listed, so the listing does not grow with the history.
+    :param config: config with the aws credentials (dwh.cfg)
+    :param location: s3 location of the log data, e.g. s3://udacity-dend/log_data
+    :param months: (year, month) of the partitions to list
+    :return: sorted days with a log file
+    """
+    bucket, _, prefix = location[len('s3://'):].partition('/')
+    s3 = boto3.client(
+        's3',
+        region_name=config.get("S3", "REGION").strip("'"),
+        aws_access_key_id=config.get("AWS", "KEY"),
+        aws_secret_access_key=config.get("AWS", "SECRET")
+    )
+
+    days = set()
+    paginator = s3.get_paginator('list_objects_v2')
+    for year, month in months:
+        for page in paginator.paginate(Bucket=bucket, Prefix=f"{prefix}/{year}/{month:02d}/"):
+            for s3_object in page.get('Contents', []):
+                match = LOG_FILE_PATTERN.search(s3_object['Key'])
+                if match:
+                    days.add(date(*map(int, match.groups())))
+    return sorted(days)
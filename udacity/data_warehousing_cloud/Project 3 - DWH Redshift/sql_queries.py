@@ -1,5 +1,8 @@
 import configparser
 
+from aggregates import aggregate_table_create_queries, aggregate_table_drop_queries
+from staging_settings import load_staging_settings, get_copy_options, apply_column_settings
+
 
 # CONFIG
 config = configparser.ConfigParser()
@@ -7,12 +10,21 @@ config.read('dwh.cfg')
 
 # var_name = config.get("", "")
 log_data_location = config.get("S3", "LOG_DATA")
+log_data_prefix = log_data_location.strip("'")
 song_data_location = config.get("S3", "SONG_DATA")
+song_data_prefix = song_data_location.strip("'")
 logs_json_format = config.get("S3", "LOG_JSONPATH")
 songs_json_format = 'auto'
 aws_region = config.get("S3", "REGION")
 iam_role = config.get("IAM_ROLE", "ARN")
 # iam_role = config.get("DWH", "DWH_IAM_ROLE_NAME")
+staging_settings = load_staging_settings(config.get("STAGING", "SETTINGS_FILE"))
+staging_events_settings = staging_settings.get('staging_events', {})
+staging_songs_settings = staging_settings.get('staging_songs', {})
+staging_events_copy_options = get_copy_options(
+    staging_events_settings.get('profile', config.get("STAGING", "EVENTS_PROFILE")))
+staging_songs_copy_options = get_copy_options(
+    staging_songs_settings.get('profile', config.get("STAGING", "SONGS_PROFILE")))
 
 # DROP TABLES
 
@@ -23,6 +35,7 @@ user_table_drop = "DROP TABLE IF EXISTS user_data"
 song_table_drop = "DROP TABLE IF EXISTS song"
 artist_table_drop = "DROP TABLE IF EXISTS artist"
 time_table_drop = "DROP TABLE IF EXISTS time"
+etl_control_table_drop = "DROP TABLE IF EXISTS etl_control"
 
 # CREATE TABLES
 
@@ -47,6 +60,8 @@ CREATE TABLE staging_events (
     "userAgent"         varchar,
     "userId"            varchar   
 )
+distkey("artist")
+sortkey("ts")
 """)
 
 staging_songs_table_create = ("""
@@ -62,8 +77,18 @@ CREATE TABLE staging_songs (
     "title"                 varchar,
     "year"                  smallint
 )
+distkey("artist_name")
+sortkey("artist_name", "title")
 """)
 
+# the staging DDL before the stored settings are applied, tune_staging.py measures the staging data with it
+staging_events_table_base_create = staging_events_table_create
+staging_songs_table_base_create = staging_songs_table_create
+
+# The varchar sizes and column encodings found by tune_staging.py are applied to the staging tables
+staging_events_table_create = apply_column_settings(staging_events_table_create, staging_events_settings)
+staging_songs_table_create = apply_column_settings(staging_songs_table_create, staging_songs_settings)
+
 songplay_table_create = ("""
 CREATE TABLE songplay (
     "songplay_id"   bigint identity(0,1),
@@ -129,23 +154,64 @@ CREATE TABLE time(
 ) diststyle all;
 """)
 
+etl_control_table_create = ("""
+CREATE TABLE IF NOT EXISTS etl_control(
+    "pipeline"          varchar     NOT NULL,
+    "high_water_mark"   bigint      NOT NULL,
+    "updated_at"        timestamp   DEFAULT getdate(),
+    PRIMARY KEY("pipeline")
+) diststyle all;
+""")
+
+# ETL CONTROL
+
+high_water_mark_select = ("""
+SELECT high_water_mark
+FROM etl_control
+WHERE pipeline = %(pipeline)s;
+""")
+
+high_water_mark_upsert = ("""
+DELETE FROM etl_control
+WHERE pipeline = %(pipeline)s;
+
+INSERT INTO etl_control (pipeline, high_water_mark)
+VALUES (%(pipeline)s, %(high_water_mark)s);
+""")
+
+staging_events_max_ts_select = "SELECT max(ts) FROM staging_events"
+
 # STAGING TABLES
 
-staging_events_copy = f"""
-COPY staging_events FROM {log_data_location} 
+staging_events_truncate = "TRUNCATE staging_events"
+staging_songs_truncate = "TRUNCATE staging_songs"
+
+# {log_data_prefix} is either the whole LOG_DATA location or one of its year/month/day key prefixes,
+# {copy_options} are the options of a staging profile (see staging_settings.py)
+staging_events_copy_template = f"""
+COPY staging_events FROM '{{log_data_prefix}}'
 credentials 'aws_iam_role={iam_role}'
 region {aws_region}
 FORMAT AS json {logs_json_format}
+{{copy_options}}
 """
 
-staging_songs_copy = f"""
-COPY staging_songs FROM {song_data_location}
+staging_events_copy = staging_events_copy_template.format(log_data_prefix=log_data_prefix,
+                                                          copy_options=staging_events_copy_options)
+
+staging_songs_copy_template = f"""
+COPY staging_songs FROM '{{song_data_prefix}}'
 credentials 'aws_iam_role={iam_role}'
 region {aws_region}
 FORMAT AS json '{songs_json_format}'
+{{copy_options}}
 """
 
+staging_songs_copy = staging_songs_copy_template.format(song_data_prefix=song_data_prefix,
+                                                        copy_options=staging_songs_copy_options)
+
 # FINAL TABLES
+# The merges below are scoped to the [%(window_start)s, %(window_end)s) range of event timestamps (epoch millis).
 
 songplay_table_insert = ("""
 DELETE FROM songplay
@@ -157,7 +223,9 @@ WHERE songplay.song_id = ss.song_id
 AND songplay.user_id = userid
 AND songplay.artist_id = ss.artist_id
 AND songplay.start_time = se.ts
-AND songplay.session_id = se.sessionid;
+AND songplay.session_id = se.sessionid
+AND se.ts >= %(window_start)s
+AND se.ts < %(window_end)s;
 
 INSERT INTO songplay (
     start_time,
@@ -181,13 +249,18 @@ FROM staging_events AS se
          JOIN staging_songs AS ss
               ON se.artist = ss.artist_name
                   and se.song = ss.title
-WHERE se.page = 'NextSong';
+WHERE se.page = 'NextSong'
+  AND se.ts >= %(window_start)s
+  AND se.ts < %(window_end)s;
 """)
 
 user_table_insert = ("""
 DELETE FROM user_data
 USING staging_events AS ss
-WHERE user_data.user_id = ss.userid;
+WHERE user_data.user_id = ss.userid
+AND ss.page = 'NextSong'
+AND ss.ts >= %(window_start)s
+AND ss.ts < %(window_end)s;
 
 INSERT INTO user_data (user_id,
                        first_name,
@@ -200,7 +273,9 @@ SELECT DISTINCT userId    AS user_id,
                 gender,
                 level
 FROM staging_events
-WHERE page = 'NextSong';
+WHERE page = 'NextSong'
+  AND ts >= %(window_start)s
+  AND ts < %(window_end)s;
 """)
 
 song_table_insert = ("""
@@ -242,7 +317,9 @@ FROM staging_songs;
 time_table_insert = ("""
 DELETE FROM time
 USING staging_events
-    WHERE start_time = ts;
+    WHERE start_time = ts
+    AND ts >= %(window_start)s
+    AND ts < %(window_end)s;
 
 INSERT INTO time (start_time,
                   hour,
@@ -254,7 +331,9 @@ INSERT INTO time (start_time,
 with converted_ts as (
     select distinct ts                                                  as start_time,
                     TIMESTAMP 'epoch' + ts / 1000 * INTERVAL '1 second' as ts_for_extraction
-    from staging_events)
+    from staging_events
+    where ts >= %(window_start)s
+      and ts < %(window_end)s)
 
 select start_time,
        EXTRACT(hour FROM ts_for_extraction)  AS hour,
@@ -266,9 +345,48 @@ select start_time,
 from converted_ts;
 """)
 
+# EXPORTS
+
+# {query} has its single quotes escaped, {partition_by} is either empty or a PARTITION BY (...) clause
+unload_template = f"""
+UNLOAD ('{{query}}')
+TO '{{location}}'
+credentials 'aws_iam_role={iam_role}'
+FORMAT AS PARQUET
+{{partition_by}}
+MANIFEST
+ALLOWOVERWRITE
+"""
+
+unload_count_select = "SELECT pg_last_unload_count()"
+
+# export name -> (query, partition columns)
+export_queries = {
+    'songplay': ("""
+SELECT sp.songplay_id,
+       sp.start_time,
+       sp.user_id,
+       sp.level,
+       sp.song_id,
+       sp.artist_id,
+       sp.session_id,
+       sp.location,
+       sp.user_agent,
+       t.year,
+       t.month
+FROM songplay AS sp
+         JOIN time AS t
+              ON sp.start_time = t.start_time
+""", ['year', 'month']),
+    'user_data': ("SELECT * FROM user_data", []),
+    'song': ("SELECT * FROM song", []),
+    'artist': ("SELECT * FROM artist", []),
+    'time': ("SELECT * FROM time", ['year', 'month']),
+}
+
 # QUERY LISTS
 
-create_table_queries = [staging_events_table_create, staging_songs_table_create, user_table_create, song_table_create, artist_table_create, time_table_create, songplay_table_create]
-drop_table_queries = [staging_events_table_drop, staging_songs_table_drop, songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop]
+create_table_queries = [etl_control_table_create, staging_events_table_create, staging_songs_table_create, user_table_create, song_table_create, artist_table_create, time_table_create, songplay_table_create] + aggregate_table_create_queries
+drop_table_queries = aggregate_table_drop_queries + [etl_control_table_drop, staging_events_table_drop, staging_songs_table_drop, songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop]
 copy_table_queries = [staging_events_copy, staging_songs_copy]
 insert_table_queries = [songplay_table_insert, user_table_insert, song_table_insert, artist_table_insert, time_table_insert]
\ No newline at end of file
@@ -0,0 +1,94 @@
+import json
+import os
+import re
+from typing import Dict, List
+
+# COPY options applied on top of the source format for each staging profile.
+COPY_PROFILES: Dict[str, List[str]] = {
+    # redshift defaults: automatic compression analysis and statistics update on every load into an empty table
+    'default': [],
+    # no compression analysis and statistics update, the encodings are declared in the DDL instead
+    'fast': ['COMPUPDATE OFF', 'STATUPDATE OFF'],
+    # as fast, but values wider than the sized columns and a few bad records do not fail the load
+    'tolerant': ['COMPUPDATE OFF', 'STATUPDATE OFF', 'TRUNCATECOLUMNS', 'BLANKSASNULL', 'EMPTYASNULL', 'MAXERROR 10'],
+}
+
+MIN_VARCHAR_SIZE = 16
+MAX_VARCHAR_SIZE = 65535
+
+COLUMN_DEFINITION_PATTERN = re.compile(r'^(\s*"(\w+)"\s+)(\w+)', re.MULTILINE)
+
+
+def load_staging_settings(path: str) -> Dict:
+    """
+    The function loads the staging settings (copy profile, varchar sizes and column encodings per staging table) stored
+    by tune_staging.py.
+    :param path: path to the settings file.
+    :return: settings per staging table, empty if the settings have not been stored yet.
+    """
+    if not os.path.exists(path):
+        return {}
+    with open(path) as settings_file:
+        return json.load(settings_file)
+
+
+def save_staging_settings(path: str, settings: Dict):
+    """
+    The function stores the staging settings.
+    :param path: path to the settings file.
+    :param settings: settings per staging table.
+    """
+    with open(path, 'w') as settings_file:
+        json.dump(settings, settings_file, indent=2, sort_keys=True)
+
+
+def get_copy_options(profile: str) -> str:
+    """
+    Convenience method to get the COPY options of a staging profile.
+    :param profile: name of the profile, one of COPY_PROFILES.
+    :return: options to append to a COPY query.
+    """
+    return '\n'.join(COPY_PROFILES[profile])
+
+
+def get_varchar_size(max_length: int) -> int:
+    """
+    The function sizes a varchar column from the longest value (in bytes) found in a sample. The size is doubled for
+    headroom and rounded up to a power of two.
+    :param max_length: length of the longest value in the sample.
+    :return: varchar size.
+    """
+    size = MIN_VARCHAR_SIZE
+    while size < (max_length or 0) * 2 and size < MAX_VARCHAR_SIZE:
+        size = size * 2
+    return min(size, MAX_VARCHAR_SIZE)
+
+
+def get_varchar_columns(create_query: str) -> List[str]:
+    """
+    Convenience method to get the names of the varchar columns of a create table query.
+    """
+    return [match.group(2) for match in COLUMN_DEFINITION_PATTERN.finditer(create_query)
+            if match.group(3).lower() == 'varchar']
+
+
+def apply_column_settings(create_query: str, table_settings: Dict) -> str:
+    """
+    The function applies the stored varchar sizes and column encodings to a create table query.
+    :param create_query: create table query with unsized varchar columns.
+    :param table_settings: settings of the table (varchar_sizes and encodings, column name -> value).
+    :return: create table query with the settings applied.
+    """
+    # redshift folds the column names to lower case, so the settings are matched case-insensitively
+    varchar_sizes = {name.lower(): size for name, size in table_settings.get('varchar_sizes', {}).items()}
+    encodings = {name.lower(): encoding for name, encoding in table_settings.get('encodings', {}).items()}
+
+    def apply(match):
+        column_name, column_type = match.group(2).lower(), match.group(3)
+        if column_type.lower() == 'varchar' and column_name in varchar_sizes:
+            column_type = f"varchar({varchar_sizes[column_name]})"
+        if column_name in encodings:
+            column_type = f"{column_type} ENCODE {encodings[column_name]}"
+        return f"{match.group(1)}{column_type}"
+
+    return COLUMN_DEFINITION_PATTERN.sub(apply, create_query)
@@ -0,0 +1,163 @@
+import argparse
+import configparser
+import time
+
+import psycopg2
+
+from query_profiler import ProfilingCursor
+from redshift_utils import get_redshift_connection_string
+from sql_queries import (staging_events_copy_template, staging_songs_copy_template, staging_events_table_base_create,
+                         staging_songs_table_base_create, staging_events_truncate, staging_songs_truncate,
+                         log_data_prefix, song_data_prefix)
+from staging_settings import (COPY_PROFILES, MAX_VARCHAR_SIZE, apply_column_settings, get_copy_options,
+                              get_varchar_columns, get_varchar_size, load_staging_settings, save_staging_settings)
+
+
+def get_staging_sources(config, full: bool):
+    """
+    Convenience method to describe the staging tables and the s3 locations (the whole data set or a sample) they are
+    loaded from.
+    :param config: config with parameters for the project (dwh.cfg).
+    :param full: whether to load the whole data set instead of the sample.
+    :return: table name -> (truncate query, copy query for the given copy options, create table query)
+    """
+    events_location = log_data_prefix if full else config.get("STAGING", "LOG_DATA_SAMPLE").strip("'")
+    songs_location = song_data_prefix if full else config.get("STAGING", "SONG_DATA_SAMPLE").strip("'")
+    return {
+        'staging_events': (
+            staging_events_truncate,
+            lambda copy_options: staging_events_copy_template.format(log_data_prefix=events_location,
+                                                                     copy_options=copy_options),
+            staging_events_table_base_create
+        ),
+        'staging_songs': (
+            staging_songs_truncate,
+            lambda copy_options: staging_songs_copy_template.format(song_data_prefix=songs_location,
+                                                                    copy_options=copy_options),
+            staging_songs_table_base_create
+        )
+    }
+
+
+def analyse(cur, conn, config, args):
+    """
+    The function loads the whole data set of each source to the staging tables and stores the settings the staging
+    tables should be created with:
+    1. The varchar columns are sized from the longest value in the data set. The staging tables are recreated with
+    the widest varchar columns first, so that no value is truncated while it is measured and the fast profile never
+    meets a value wider than its column.
+    2. The column encodings are the ones suggested by ANALYZE COMPRESSION, so that automatic compression analysis can be
+    switched off for the regular loads.
+    3. The copy profile is the one passed on the command line (or the configured one).
+    The settings are applied to the staging tables on the next create_tables.py run.
+    """
+    settings_file = config.get("STAGING", "SETTINGS_FILE")
+    settings = load_staging_settings(settings_file)
+    profiles = {'staging_events': args.events_profile or config.get("STAGING", "EVENTS_PROFILE"),
+                'staging_songs': args.songs_profile or config.get("STAGING", "SONGS_PROFILE")}
+
+    for table, (_, get_copy_query, create_query) in get_staging_sources(config, full=True).items():
+        print(f"Analysing {table}")
+        varchar_columns = get_varchar_columns(create_query)
+        cur.execute(f"DROP TABLE IF EXISTS {table}")
+        cur.execute(apply_column_settings(create_query, {
+            'varchar_sizes': {column: MAX_VARCHAR_SIZE for column in varchar_columns}
+        }))
+        conn.commit()
+        cur.execute(get_copy_query(get_copy_options('tolerant')))
+        conn.commit()
+
+        max_length_columns = ', '.join(f'max(octet_length("{column}"))' for column in varchar_columns)
+        cur.execute(f"SELECT {max_length_columns} FROM {table}")
+        max_lengths = cur.fetchone()
+
+        cur.execute(f"ANALYZE COMPRESSION {table}")
+        encodings = {row[1]: row[2] for row in cur.fetchall()}
+        conn.commit()
+
+        settings[table] = {
+            'profile': profiles[table],
+            'varchar_sizes': {column: get_varchar_size(max_length)
+                              for column, max_length in zip(varchar_columns, max_lengths)},
+            'encodings': encodings
+        }
+        print(f"{table}: {settings[table]}")
+
+    save_staging_settings(settings_file, settings)
+    print(f"Staging settings saved to {settings_file}. Run create_tables.py to apply them.")
+
+
+def benchmark(cur, conn, config, args):
+    """
+    The function loads each source to its staging table once per copy profile and prints the load times.
+    The results are stored together with the staging settings.
+    """
+    settings_file = config.get("STAGING", "SETTINGS_FILE")
+    settings = load_staging_settings(settings_file)
+    sources = get_staging_sources(config, args.full)
+    results = {}
+
+    for profile in args.profiles or COPY_PROFILES:
+        results[profile] = {}
+        for table, (truncate_query, get_copy_query, _) in sources.items():
+            cur.execute(truncate_query)
+            conn.commit()
+            start = time.time()
+            cur.execute(get_copy_query(get_copy_options(profile)))
+            conn.commit()
+            results[profile][table] = round(time.time() - start, 3)
+
+    print(f"{'profile':<10}" + ''.join(f"  {table:>15}" for table in sources))
+    for profile, timings in results.items():
+        print(f"{profile:<10}" + ''.join(f"  {timings[table]:>15.3f}" for table in sources))
+    for table in sources:
+        fastest = min(results, key=lambda p: results[p][table])
+        print(f"Fastest profile for {table}: {fastest}")
+
+    settings['benchmark'] = {'full': args.full, 'seconds': results}
+    save_staging_settings(settings_file, settings)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Tune the loads of the staging tables for the sparkify system.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    analyse_parser = subparsers.add_parser('analyse', help='size the staging columns and choose their encodings')
+    analyse_parser.add_argument('--events-profile', choices=COPY_PROFILES,
+                                help='copy profile to store for staging_events')
+    analyse_parser.add_argument('--songs-profile', choices=COPY_PROFILES,
+                                help='copy profile to store for staging_songs')
+
+    benchmark_parser = subparsers.add_parser('benchmark', help='compare the load times of the copy profiles')
+    benchmark_parser.add_argument('--profiles', nargs='+', choices=COPY_PROFILES,
+                                  help='profiles to compare. Defaults to all')
+    benchmark_parser.add_argument('--full', action='store_true', help='load the whole data set instead of the sample')
+    return parser.parse_args()
+
+
+def main():
+    """
+    The main method to run in order to tune the loads of the staging tables, see analyse and benchmark.
+    Please note that the staging tables are truncated and left with the loaded data, analyse leaves them with the
+    widest varchar columns until create_tables.py is run.
+    """
+    args = parse_args()
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+
+    connection_string = get_redshift_connection_string(config=config)
+    conn = psycopg2.connect(connection_string)
+    cur = ProfilingCursor(conn.cursor())
+
+    if args.command == 'analyse':
+        analyse(cur, conn, config, args)
+    else:
+        benchmark(cur, conn, config, args)
+
+    conn.close()
+
+    cur.print_report()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+"""
+Data skipping index of the data lake tables: a sidecar table with a row per parquet file of a table, holding the min and
+max value and a bloom filter of every indexed column of the file. The lookups prune the files with the index before
+spark opens them, so that "all plays for user X" only reads the files that may have user X.
+The index is stored in the _data_skipping_index directory of the table, spark does not read the directories starting
+with an underscore as part of the table.
+"""
+import hashlib
+import math
+
+from pyspark.sql.functions import col, collect_set, input_file_name, udf, min as spark_min, max as spark_max
+from pyspark.sql.types import BinaryType
+
+INDEX_DIRECTORY = '_data_skipping_index'
+
+BLOOM_FALSE_POSITIVE_RATE = 0.01
+BLOOM_HASH_COUNT = 7
+
+
+def build_bloom_filter(values):
+    """
+    The function builds the bloom filter of a set of values, sized for BLOOM_FALSE_POSITIVE_RATE.
+    :param values: values of a column in a file, compared as strings.
+    :return: bits of the bloom filter.
+    """
+    values = values or []
+    bit_count = max(8, math.ceil(-len(values) * math.log(BLOOM_FALSE_POSITIVE_RATE) / math.log(2) ** 2))
+    bloom = bytearray(math.ceil(bit_count / 8))
+    for value in values:
+        for position in get_bloom_positions(value, len(bloom) * 8):
+            bloom[position // 8] |= 1 << (position % 8)
+    return bloom
+
+
+def might_contain(bloom, value) -> bool:
+    """
+    The function checks if the value may be in the set of a bloom filter, with BLOOM_FALSE_POSITIVE_RATE false
+    positives and no false negatives.
+    """
+    return all(bloom[position // 8] & (1 << (position % 8)) for position in get_bloom_positions(value, len(bloom) * 8))
+
+
+def get_bloom_positions(value, bit_count):
+    """
+    Convenience method to get the bits of a value in a bloom filter, from the two halves of its blake2b digest.
+    """
+    digest = hashlib.blake2b(str(value).encode('utf-8'), digest_size=16).digest()
+    first_hash = int.from_bytes(digest[:8], 'little')
+    second_hash = int.from_bytes(digest[8:], 'little')
+    return [(first_hash + i * second_hash) % bit_count for i in range(BLOOM_HASH_COUNT)]
+
+
+def write_data_skipping_index(spark, table_path, columns):
+    """
+    The function (re)builds the index of a table from the files it has just been written to.
+    :param spark: spark session to execute queries against
+    :param table_path: location of the parquet table
+    :param columns: columns to index
+    """
+    bloom_filter_udf = udf(build_bloom_filter, BinaryType())
+
+    aggregates = []
+    for column in columns:
+        aggregates += [
+            spark_min(column).alias(f'{column}_min'),
+            spark_max(column).alias(f'{column}_max'),
+            collect_set(column).alias(f'{column}_values')
+        ]
+    index_df = spark.read.parquet(table_path) \
+        .withColumn('file', input_file_name()) \
+        .groupBy('file') \
+        .agg(*aggregates)
+    for column in columns:
+        index_df = index_df \
+            .withColumn(f'{column}_bloom', bloom_filter_udf(col(f'{column}_values'))) \
+            .drop(f'{column}_values')
+
+    index_df \
+        .coalesce(1) \
+        .write \
+        .mode("overwrite") \
+        .parquet(f"{table_path}/{INDEX_DIRECTORY}")
+
+
+def prune_files(spark, table_path, **lookups):
+    """
+    The function gets the files of a table that may have the rows of a lookup.
+    :param spark: spark session to execute queries against
+    :param table_path: location of the parquet table
+    :param lookups: looked up value of indexed columns, e.g. user_id='15'
+    :return: paths of the files whose min and max values and bloom filters do not rule the lookup out
+    """
+    files = []
+    for index_row in spark.read.parquet(f"{table_path}/{INDEX_DIRECTORY}").collect():
+        if all(_may_have_value(index_row, column, value) for column, value in lookups.items()):
+            files.append(index_row['file'])
+    return files
+
+
+def read_with_index(spark, table_path, **lookups):
+    """
+    The function reads the rows of a lookup from a table, opening only the files the index does not rule out.
+    :param spark: spark session to execute queries against
+    :param table_path: location of the parquet table
+    :param lookups: looked up value of indexed columns, e.g. user_id='15'
+    :return: dataframe with the rows of the lookup, with the partition columns of the table
+    """
+    files = prune_files(spark, table_path, **lookups)
+    if not files:
+        return spark.read.parquet(table_path).limit(0)
+
+    df = spark.read.option("basePath", table_path).parquet(*files)
+    for column, value in lookups.items():
+        df = df.where(col(column) == value)
+    return df
+
+
+########################################################################################################################
+#                                                                                                                      #
+#                                               Private functions                                                      #
+#                                                                                                                      #
+########################################################################################################################
+
+
+def _may_have_value(index_row, column, value):
+    minimum, maximum = index_row[f'{column}_min'], index_row[f'{column}_max']
+    if minimum is None or not minimum <= value <= maximum:
+        return False
+    return might_contain(index_row[f'{column}_bloom'], value)
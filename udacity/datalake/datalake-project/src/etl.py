@@ -1,11 +1,23 @@
+import argparse
 import configparser
 import uuid
 from datetime import datetime
 import os
+import sys
 from pyspark.sql import SparkSession, Window
-from pyspark.sql.functions import udf, col, row_number, last, from_unixtime
+from pyspark.sql.functions import udf, col, row_number, last, from_unixtime, count, countDistinct
 from pyspark.sql.functions import year, month, dayofmonth, hour, weekofyear, date_format
-from pyspark.sql.types import StructType, StructField, StringType, FloatType, IntegerType, TimestampType
+from pyspark.sql.functions import lit, when, length, pmod, collect_list, bin as spark_bin, hash as spark_hash, \
+    max as spark_max
+from pyspark.sql.types import StructType, StructField, StringType, FloatType, IntegerType, TimestampType, LongType
+
+import data_skipping
+from sketches import HLL_REGISTER_COUNT, HLL_RANK_BITS, SKETCHES_BY_DAY_TABLE, SKETCHES_BY_ARTIST_DAY_TABLE, \
+    USERS_SKETCH, SESSIONS_SKETCH
+
+# the stage cache is shared by the Sparkify projects
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', '..'))
+from stage_cache import StageCache
 
 config = configparser.ConfigParser()
 config.read_file(open('dl.cfg'))
@@ -14,15 +26,92 @@ os.environ['AWS_ACCESS_KEY_ID'] = config['AWS']['AWS_ACCESS_KEY_ID']
 os.environ['AWS_SECRET_ACCESS_KEY'] = config['AWS']['AWS_SECRET_ACCESS_KEY']
 input_location_cfg = config['AWS']['INPUT_LOCATION']
 output_location_cfg = config['AWS']['OUTPUT_LOCATION']
+stage_cache_dir_cfg = config.get('CACHE', 'STAGE_CACHE_DIR', fallback='.stage_cache')
+stage_cache_max_mb_cfg = config.getint('CACHE', 'STAGE_CACHE_MAX_MB', fallback=1024)
+
+SONG_DATA_GLOB = 'song_data/*/*/*/*.json'
+LOG_DATA_GLOB = 'log_data/*/*/*.json'
+LOG_DATA_MONTH_GLOB = 'log_data/{year}/{month:02d}/*.json'
+
+# columns of the data skipping index of a table, the common lookup keys
+SONGS_INDEX_COLUMNS = ['song_id', 'title']
+SONGPLAYS_INDEX_COLUMNS = ['user_id', 'song_id']
+
 
 def create_spark_session():
     spark = SparkSession \
         .builder \
         .config("spark.jars.packages", "org.apache.hadoop:hadoop-aws:2.7.0") \
         .getOrCreate()
+    # the executors build the bloom filters of the data skipping index
+    spark.sparkContext.addPyFile(data_skipping.__file__)
     return spark
 
 
+def get_songplay_rollups():
+    """
+    Convenience method to get the rollups of the songplays, the columns need an active spark context to be created.
+    :return: the columns the plays are grouped by within the year and month partitions and the aggregate column, by
+    rollup table name
+    """
+    return {
+        'plays_by_hour_level': (['day', 'hour', 'level'], count('*').alias('plays')),
+        'plays_by_artist_day': (['day', 'artist_id'], count('*').alias('plays')),
+        'active_users_by_day': (['day'], countDistinct('userId').alias('active_users'))
+    }
+
+
+def fingerprint_input(spark, path_pattern):
+    """
+    The function fingerprints the input files of a path pattern by their path, size and modification time, as listed by
+    the hadoop file system of the path (s3a, hdfs or local), without reading them.
+    :param spark: spark session to execute queries against
+    :param path_pattern: glob pattern of the input files
+    :return: sorted path, size and modification time of every file
+    """
+    path = spark.sparkContext._jvm.org.apache.hadoop.fs.Path(path_pattern)
+    file_system = path.getFileSystem(spark.sparkContext._jsc.hadoopConfiguration())
+    statuses = file_system.globStatus(path) or []
+    return sorted(
+        (status.getPath().toString(), status.getLen(), status.getModificationTime()) for status in statuses
+    )
+
+
+def output_exists(spark, table_path):
+    """
+    The function checks that a table has been written completely, spark writes the _SUCCESS file last.
+    """
+    path = spark.sparkContext._jvm.org.apache.hadoop.fs.Path(f"{table_path}/_SUCCESS")
+    return path.getFileSystem(spark.sparkContext._jsc.hadoopConfiguration()).exists(path)
+
+
+def run_stage(spark, stage_cache, stage_name, inputs, output_data, outputs, code, write_stage, parameters=None):
+    """
+    The function runs a stage, unless the stage cache has its key and its output tables are still there.
+    The outputs of the stages are already persisted in the output location, so the cache entries of the spark stages
+    only record the keys of the stages that wrote them; as the dataframes are lazy, a skipped stage computes nothing.
+    :param spark: spark session to execute queries against
+    :param stage_cache: cache of the stages, None to run all the stages
+    :param stage_name: name of the stage
+    :param inputs: fingerprints of the input files of the stage
+    :param output_data: s3 bucket (formatted) of the output data
+    :param outputs: names of the tables the stage writes
+    :param code: functions and modules of the transformation of the stage
+    :param write_stage: function computing and writing the outputs of the stage
+    :param parameters: parameters of the stage other than the output location
+    """
+    if stage_cache is None:
+        write_stage()
+        return
+
+    key = StageCache.get_key(stage_name, inputs, {'output_data': output_data, **(parameters or {})}, code)
+    if stage_cache.get(key) and all(output_exists(spark, f"{output_data}/{output}") for output in outputs):
+        print(f"Stage {stage_name} is unchanged, skipping it")
+        return
+    with stage_cache.put(key):
+        write_stage()
+
+
 def read_song_data(spark, input_data):
     """
     Convenience wrapper function to get a read dataframe for the song data json files
@@ -30,7 +119,7 @@ def read_song_data(spark, input_data):
     :param input_data: s3 bucket (formatted) location of the input data
     :return: spark dataframe with the loaded song data
     """
-    song_data = f"{input_data}/song_data/*/*/*/*.json"
+    song_data = f"{input_data}/{SONG_DATA_GLOB}"
 
     schema = StructType([
         StructField("artist_id", StringType()),
@@ -47,16 +136,33 @@ def read_song_data(spark, input_data):
     return spark.read.json(song_data, schema=schema)
 
 
-def process_song_data(spark, input_data, output_data):
+def process_song_data(spark, input_data, output_data, stage_cache=None):
     """
     The function that starts processing of the song data set
     :param spark: spark session to execute queries against
     :param input_data: s3 bucket (formatted) location of the input data
     :param output_data: s3 bucket (formatted) of the output data
+    :param stage_cache: cache of the stages, the stages whose key did not change since a previous run are skipped
     """
+    song_data_inputs = fingerprint_input(spark, f"{input_data}/{SONG_DATA_GLOB}")
     song_df = read_song_data(spark, input_data)
     song_df.cache()
 
+    run_stage(spark, stage_cache, 'songs', song_data_inputs, output_data, ['songs_table'],
+              code=[read_song_data, write_songs_table, data_skipping],
+              write_stage=lambda: write_songs_table(spark, song_df, output_data))
+    run_stage(spark, stage_cache, 'artists', song_data_inputs, output_data, ['artists_table'],
+              code=[read_song_data, write_artists_table],
+              write_stage=lambda: write_artists_table(song_df, output_data))
+
+
+def write_songs_table(spark, song_df, output_data):
+    """
+    The function writes the songs table and its data skipping index
+    :param spark: spark session to execute queries against
+    :param song_df: song data set
+    :param output_data: s3 bucket (formatted) of the output data
+    """
     songs_table_df = song_df.dropDuplicates(["song_id"]).select(
         song_df.song_id,
         song_df.title,
@@ -65,12 +171,22 @@ def process_song_data(spark, input_data, output_data):
         song_df.duration
     )
 
+    # the files are sorted by song id so that their min and max values are narrow
     songs_table_df \
+        .sortWithinPartitions('song_id') \
         .write \
         .mode("overwrite") \
         .partitionBy("year","artist_id") \
         .parquet(f"{output_data}/songs_table")
+    data_skipping.write_data_skipping_index(spark, f"{output_data}/songs_table", SONGS_INDEX_COLUMNS)
+
 
+def write_artists_table(song_df, output_data):
+    """
+    The function writes the artists table
+    :param song_df: song data set
+    :param output_data: s3 bucket (formatted) of the output data
+    """
     artists_table_df = song_df.dropDuplicates(["artist_id"]).select(
         song_df.artist_id,
         song_df.artist_name.alias('name'),
@@ -85,22 +201,104 @@ def process_song_data(spark, input_data, output_data):
         .parquet(f"{output_data}/artists_table")
 
 
-def process_log_data(spark, input_data, output_data):
+def process_log_data(spark, input_data, output_data, stage_cache=None, months=None):
     """
     The function that starts processing of the log data set
     :param spark: spark session to execute queries against
     :param input_data: s3 bucket (formatted) location of the input data
     :param output_data: s3 bucket (formatted) of the output data
+    :param stage_cache: cache of the stages, the stages whose key did not change since a previous run are skipped
+    :param months: (year, month) of the log data the songplays, their rollups and sketches are rebuilt for, None for
+    all the months. The users and time tables are always rebuilt from the whole log data set.
     """
     # get filepath to log data file
-    log_data = f"{input_data}/log_data/*/*/*.json"
+    log_data = f"{input_data}/{LOG_DATA_GLOB}"
+    log_data_inputs = fingerprint_input(spark, log_data)
 
     # read log data file
     log_df = spark.read.json(log_data)
 
-    # filter by actions for song plays
-    next_song_log_df = log_df.filter(col('page') == 'NextSong')
+    next_song_log_df = get_next_song_events(log_df)
+
+    run_stage(spark, stage_cache, 'users', log_data_inputs, output_data, ['users_table'],
+              code=[get_next_song_events, write_users_table],
+              write_stage=lambda: write_users_table(next_song_log_df, output_data))
+
+    log_with_time_df = get_log_with_time(log_df)
+    run_stage(spark, stage_cache, 'time', log_data_inputs, output_data, ['time_table'],
+              code=[get_log_with_time, write_time_table],
+              write_stage=lambda: write_time_table(log_with_time_df, output_data))
+
+    # the songplays only read the log data of the months of the run, whose partitions are the only ones rewritten
+    songplays_log_with_time_df = log_with_time_df
+    songplays_log_inputs = log_data_inputs
+    if months:
+        month_inputs = {
+            log_data_month: fingerprint_input(spark, log_data_month)
+            for log_data_month in get_log_data_month_globs(input_data, months)
+        }
+        songplays_log_inputs = sorted(fingerprint for inputs in month_inputs.values() for fingerprint in inputs)
+        if not songplays_log_inputs:
+            print(f"No log data in the months {months}, skipping the songplays")
+            return
+        # spark fails on the paths without file, the months without log data are left out
+        songplays_log_df = spark.read.json(
+            [log_data_month for log_data_month, inputs in month_inputs.items() if inputs]
+        )
+        # the events of another month in the files of a month are dropped, they would overwrite that month with a part
+        # of its events
+        songplays_log_with_time_df = get_log_with_time(songplays_log_df).where(get_months_condition(months))
+
+    # the songplays are joined with the song data
+    songplays_inputs = songplays_log_inputs + fingerprint_input(spark, f"{input_data}/{SONG_DATA_GLOB}")
+    songplays_outputs = ['songplays_table', SKETCHES_BY_DAY_TABLE, SKETCHES_BY_ARTIST_DAY_TABLE] + \
+        list(get_songplay_rollups().keys())
+    run_stage(spark, stage_cache, 'songplays', songplays_inputs, output_data, songplays_outputs,
+              code=[get_log_with_time, get_log_data_month_globs, get_months_condition, read_song_data,
+                    write_songplays_tables, get_songplay_rollups, write_songplay_rollup, write_songplay_sketches,
+                    build_hll_sketch, write_month_partitions, data_skipping],
+              write_stage=lambda: write_songplays_tables(spark, songplays_log_with_time_df, input_data, output_data),
+              parameters={'months': months})
+
+
+def get_log_data_month_globs(input_data, months):
+    """
+    Convenience method to get the glob patterns of the log data files of some months
+    :param input_data: s3 bucket (formatted) location of the input data
+    :param months: (year, month) of the log data
+    :return: glob pattern of the log data files of every month
+    """
+    return [f"{input_data}/{LOG_DATA_MONTH_GLOB.format(year=year_value, month=month_value)}"
+            for year_value, month_value in months]
 
+
+def get_months_condition(months):
+    """
+    The function builds the condition keeping the rows of some months
+    :param months: (year, month) of the rows to keep
+    :return: condition on the year and month columns
+    """
+    condition = lit(False)
+    for year_value, month_value in months:
+        condition = condition | ((col('year') == year_value) & (col('month') == month_value))
+    return condition
+
+
+def get_next_song_events(log_df):
+    """
+    The function filters the log data set by actions for song plays
+    :param log_df: log data set
+    :return: NextSong events of the log data set
+    """
+    return log_df.filter(col('page') == 'NextSong')
+
+
+def write_users_table(next_song_log_df, output_data):
+    """
+    The function writes the users table with the latest state of every user
+    :param next_song_log_df: NextSong events of the log data set
+    :param output_data: s3 bucket (formatted) of the output data
+    """
     # extract columns for users table
     user_id_by_ts_window = Window.partitionBy(
         col('userId')) \
@@ -125,12 +323,19 @@ def process_log_data(spark, input_data, output_data):
         .mode("overwrite") \
         .parquet(f"{output_data}/users_table")
 
+
+def get_log_with_time(log_df):
+    """
+    The function adds the time columns of the events to the log data set
+    :param log_df: log data set
+    :return: log data set with the time columns
+    """
     # create timestamp column from original timestamp column
     log_with_time_df = log_df \
         .withColumn('start_time',
                     (col('ts') / 1000).cast(IntegerType())) \
         .dropDuplicates()
-    log_with_time_df = log_with_time_df \
+    return log_with_time_df \
         .withColumn('ts_as_datetime', from_unixtime(col('start_time'), 'yyyy-MM-dd HH:mm:ss').cast(TimestampType())) \
         .withColumn('hour', hour(col('ts_as_datetime'))) \
         .withColumn('day', dayofmonth(col('ts_as_datetime'))) \
@@ -139,6 +344,13 @@ def process_log_data(spark, input_data, output_data):
         .withColumn('year', year(col('ts_as_datetime'))) \
         .withColumn('weekday', weekofyear(col('ts_as_datetime')))
 
+
+def write_time_table(log_with_time_df, output_data):
+    """
+    The function writes the time table
+    :param log_with_time_df: log data set with the time columns
+    :param output_data: s3 bucket (formatted) of the output data
+    """
     # write time table to parquet files partitioned by year and month
     log_with_time_df \
         .write \
@@ -146,14 +358,27 @@ def process_log_data(spark, input_data, output_data):
         .mode("overwrite") \
         .parquet(f"{output_data}/time_table")
 
+
+def write_songplays_tables(spark, log_with_time_df, input_data, output_data):
+    """
+    The function writes the songplays table, its data skipping index, its rollups and its sketches
+    :param spark: spark session to execute queries against
+    :param log_with_time_df: log data set with the time columns, of the months to rewrite
+    :param input_data: s3 bucket (formatted) location of the input data
+    :param output_data: s3 bucket (formatted) of the output data
+    """
     # read in song data to use for songplays table
     song_df = read_song_data(spark, input_data)
     song_df = song_df.drop('year')
 
     uuidUdf = udf(lambda: str(uuid.uuid4()), StringType())
+    # the join output is cached as both the songplays table and its rollups are computed from it
+    songplays_joined_df = log_with_time_df \
+        .join(song_df, song_df.title == log_with_time_df.song) \
+        .cache()
+
     # extract columns from joined song and log datasets to create songplays table
-    songplays_table = log_with_time_df \
-        .join(song_df, song_df.title == log_df.song) \
+    songplays_table = songplays_joined_df \
         .select(
             uuidUdf().alias('songplay_id'),
             col('start_time').alias('start_time'),
@@ -169,22 +394,126 @@ def process_log_data(spark, input_data, output_data):
         )
 
 # write songplays table to parquet files partitioned by year and month
-    songplays_table \
+    # every file of a month gets a range of the users, sorted by user and song so that the lookups skip the other files
+    write_month_partitions(
+        songplays_table.repartitionByRange('year', 'month', 'user_id').sortWithinPartitions('user_id', 'song_id'),
+        output_data,
+        'songplays_table'
+    )
+    data_skipping.write_data_skipping_index(spark, f"{output_data}/songplays_table", SONGPLAYS_INDEX_COLUMNS)
+
+    for rollup_name, (group_columns, aggregate_column) in get_songplay_rollups().items():
+        write_songplay_rollup(songplays_joined_df, output_data, rollup_name, group_columns, aggregate_column)
+
+    # distinct users and sessions sketches, merged by the sketches.query_distinct_count helper
+    write_songplay_sketches(songplays_joined_df, output_data, SKETCHES_BY_DAY_TABLE, ['day'])
+    write_songplay_sketches(songplays_joined_df, output_data, SKETCHES_BY_ARTIST_DAY_TABLE, ['day', 'artist_id'])
+
+    songplays_joined_df.unpersist()
+
+
+def write_songplay_rollup(songplays_joined_df, output_data, rollup_name, group_columns, aggregate_column):
+    """
+    The function aggregates the songplays into a rollup table partitioned by year and month like the songplays table,
+    so that the common questions are answered without scanning the fact.
+    :param songplays_joined_df: cached join output of the log and song data sets
+    :param output_data: s3 bucket (formatted) of the output data
+    :param rollup_name: name of the rollup table
+    :param group_columns: columns the plays are grouped by within a year and month
+    :param aggregate_column: aggregate of the plays of a group
+    """
+    rollup_df = songplays_joined_df \
+        .groupBy('year', 'month', *group_columns) \
+        .agg(aggregate_column)
+    write_month_partitions(rollup_df, output_data, rollup_name)
+
+
+def write_songplay_sketches(songplays_joined_df, output_data, table_name, group_columns):
+    """
+    The function stores the HyperLogLog sketches of the distinct users and sessions of the songplays per group, in a
+    table partitioned by year and month like the songplays table.
+    :param songplays_joined_df: cached join output of the log and song data sets
+    :param output_data: s3 bucket (formatted) of the output data
+    :param table_name: name of the sketches table
+    :param group_columns: columns the songplays are grouped by within a year and month
+    """
+    group_columns = ['year', 'month'] + group_columns
+    users_sketch_df = build_hll_sketch(songplays_joined_df, group_columns, ['userId'], USERS_SKETCH)
+    sessions_sketch_df = build_hll_sketch(songplays_joined_df, group_columns, ['userId', 'sessionId'], SESSIONS_SKETCH)
+    write_month_partitions(users_sketch_df.join(sessions_sketch_df, group_columns), output_data, table_name)
+
+
+def build_hll_sketch(df, group_columns, value_columns, sketch_name):
+    """
+    The function builds a HyperLogLog sketch of the distinct values per group with the spark sql functions.
+    The register of a value is given by its murmur3 hash and its rank by the first 1 bit of a second hash (of the value
+    and a salt), the sketch keeps the highest rank per register in the sparse format described in sketches.py.
+    :param df: dataframe with the values
+    :param group_columns: columns of the groups
+    :param value_columns: columns whose distinct combinations are counted, the rows with a null value are skipped
+    :param sketch_name: name of the sketch column
+    :return: dataframe with the group columns and the sketch column
+    """
+    rank_hash = spark_hash(lit('hll_rank'), *value_columns).cast(LongType()).bitwiseAND(lit(0xFFFFFFFF))
+    # the position of the first 1 bit of the 32 bits hash, 33 if all the bits are 0
+    rank = when(rank_hash == 0, 33).otherwise(33 - length(spark_bin(rank_hash)))
+    register = pmod(spark_hash(*value_columns), lit(HLL_REGISTER_COUNT))
+
+    not_null_df = df
+    for value_column in value_columns:
+        not_null_df = not_null_df.where(col(value_column).isNotNull())
+
+    return not_null_df \
+        .select(*group_columns, register.alias('hll_register'), rank.alias('hll_rank')) \
+        .groupBy(*group_columns, 'hll_register') \
+        .agg(spark_max('hll_rank').alias('hll_rank')) \
+        .groupBy(*group_columns) \
+        .agg(collect_list(col('hll_register') * (1 << HLL_RANK_BITS) + col('hll_rank')).alias(sketch_name))
+
+
+def write_month_partitions(df, output_data, table_name):
+    """
+    The function writes a table partitioned by year and month like the songplays table. The partitions are overwritten
+    dynamically: the year and month partitions of the dataframe are replaced, the months it does not have are kept, so
+    a run of some months only rewrites their partitions.
+    :param df: dataframe to write, with year and month columns
+    :param output_data: s3 bucket (formatted) of the output data
+    :param table_name: name of the table
+    """
+    df \
         .write \
         .mode("overwrite") \
+        .option("partitionOverwriteMode", "dynamic") \
         .partitionBy("year", "month") \
-        .parquet(f"{output_data}/songplays_table")
+        .parquet(f"{output_data}/{table_name}")
+
+
+def parse_month(value):
+    """
+    Convenience method to parse a YYYY-MM month argument
+    :return: (year, month) of the argument
+    """
+    parsed = datetime.strptime(value, '%Y-%m')
+    return parsed.year, parsed.month
+
 
 def main():
     """
     The main funcion to run for ETL
     """
+    parser = argparse.ArgumentParser(description='Sparkify data lake ETL')
+    parser.add_argument('--months', nargs='+', type=parse_month, metavar='YYYY-MM',
+                        help='months of the log data the songplays, their rollups and sketches are rebuilt for, '
+                             'all the months by default')
+    args = parser.parse_args()
+
     spark = create_spark_session()
     input_data = input_location_cfg
     output_data = output_location_cfg
+    stage_cache = StageCache(stage_cache_dir_cfg, max_bytes=stage_cache_max_mb_cfg << 20)
 
-    process_song_data(spark, input_data, output_data)
-    process_log_data(spark, input_data, output_data)
+    process_song_data(spark, input_data, output_data, stage_cache)
+    process_log_data(spark, input_data, output_data, stage_cache, args.months)
 
 
 if __name__ == "__main__":
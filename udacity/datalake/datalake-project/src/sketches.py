@@ -0,0 +1,86 @@
+"""
+HyperLogLog sketches of the distinct users and sessions of the songplays, and the helper to query them.
+
+The ETL stores a sketch per day (songplay_sketches_by_day) and per day and artist (songplay_sketches_by_artist_day).
+A sketch has HLL_REGISTER_COUNT registers, a register keeps the highest rank (position of the first 1 bit of a hash) of
+the values hashed to it. The sketches are stored sparse, as an array with an int per non-empty register:
+register * 2 ** HLL_RANK_BITS + rank. Merging sketches takes the highest rank per register, so the sketches of any set
+of days or artists merge into the sketch of their union, and its distinct count is estimated without scanning the fact.
+
+Error bound: the relative standard error of an estimate is 1.04 / sqrt(HLL_REGISTER_COUNT), 1.6% with 4096 registers.
+About 68% of the estimates are within 1.6% of the exact count, 95% within 3.3% and 99.7% within 4.9%. Counts below
+2.5 * HLL_REGISTER_COUNT (10240) are estimated by linear counting, which is more accurate for them.
+"""
+import math
+from datetime import date
+
+import numpy
+import pyarrow.dataset
+
+HLL_PRECISION = 12
+HLL_REGISTER_COUNT = 1 << HLL_PRECISION
+HLL_RANK_BITS = 6
+HLL_STANDARD_ERROR = 1.04 / math.sqrt(HLL_REGISTER_COUNT)
+
+SKETCHES_BY_DAY_TABLE = 'songplay_sketches_by_day'
+SKETCHES_BY_ARTIST_DAY_TABLE = 'songplay_sketches_by_artist_day'
+USERS_SKETCH = 'users_sketch'
+SESSIONS_SKETCH = 'sessions_sketch'
+
+
+def merge_sketches(sketches):
+    """
+    The function merges sparse sketches into the dense registers of their union.
+    :param sketches: sparse sketches, sequences of register * 2 ** HLL_RANK_BITS + rank ints.
+    :return: numpy array with the highest rank of every register.
+    """
+    registers = numpy.zeros(HLL_REGISTER_COUNT, dtype=numpy.uint8)
+    entries = [numpy.asarray(sketch, dtype=numpy.int64) for sketch in sketches if sketch is not None and len(sketch)]
+    if entries:
+        entries = numpy.concatenate(entries)
+        numpy.maximum.at(registers, entries >> HLL_RANK_BITS, (entries & ((1 << HLL_RANK_BITS) - 1)).astype(numpy.uint8))
+    return registers
+
+
+def estimate_distinct_count(registers) -> float:
+    """
+    The function estimates the distinct count of the values of dense registers with the HyperLogLog estimator, and
+    linear counting for the small counts.
+    :param registers: highest rank of every register.
+    :return: estimated distinct count, within HLL_STANDARD_ERROR relative standard error.
+    """
+    register_count = len(registers)
+    alpha = 0.7213 / (1 + 1.079 / register_count)
+    estimate = alpha * register_count ** 2 / numpy.sum(numpy.power(2.0, -registers.astype(numpy.float64)))
+    empty_registers = int(numpy.count_nonzero(registers == 0))
+    if estimate <= 2.5 * register_count and empty_registers:
+        return register_count * math.log(register_count / empty_registers)
+    return float(estimate)
+
+
+def query_distinct_count(output_data, sketch_column, start_date: date, end_date: date, artist_id=None) -> float:
+    """
+    The function estimates the distinct users or sessions of the songplays of a date range, for all the artists or for
+    one of them, by merging the stored sketches of the range.
+    :param output_data: s3 bucket (formatted) or local directory of the output data
+    :param sketch_column: USERS_SKETCH or SESSIONS_SKETCH
+    :param start_date: first day of the range
+    :param end_date: last day of the range, included
+    :param artist_id: artist whose songplays are counted, all the artists if None
+    :return: estimated distinct count, within HLL_STANDARD_ERROR relative standard error.
+    """
+    table_name = SKETCHES_BY_DAY_TABLE if artist_id is None else SKETCHES_BY_ARTIST_DAY_TABLE
+    dataset = pyarrow.dataset.dataset(f"{output_data}/{table_name}", format='parquet', partitioning='hive')
+
+    # the year and month partitions of the range are read, then the days are filtered
+    month_keys = pyarrow.dataset.field('year') * 100 + pyarrow.dataset.field('month')
+    row_filter = (month_keys >= start_date.year * 100 + start_date.month) & \
+                 (month_keys <= end_date.year * 100 + end_date.month)
+    if artist_id is not None:
+        row_filter = row_filter & (pyarrow.dataset.field('artist_id') == artist_id)
+    table = dataset.to_table(columns=['year', 'month', 'day', sketch_column], filter=row_filter)
+
+    days = [date(year, month, day) for year, month, day in
+            zip(table['year'].to_pylist(), table['month'].to_pylist(), table['day'].to_pylist())]
+    sketches = [sketch for day, sketch in zip(days, table[sketch_column].to_pylist()) if start_date <= day <= end_date]
+    return estimate_distinct_count(merge_sketches(sketches))
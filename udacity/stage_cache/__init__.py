@@ -0,0 +1,11 @@
+"""
+Content-addressed cache of the transformation stages of the Sparkify ETLs: a stage is keyed by the fingerprints of its
+input files, its parameters and the source code of its transformation, so a rerun skips the stages none of them changed.
+"""
+from stage_cache.cache import StageCache, code_version, fingerprint_files
+
+__all__ = [
+    'StageCache',
+    'code_version',
+    'fingerprint_files'
+]
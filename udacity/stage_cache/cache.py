@@ -0,0 +1,135 @@
+import hashlib
+import inspect
+import json
+import os
+import shutil
+from contextlib import contextmanager
+from typing import Any, Iterable, List, Optional, Sequence, Tuple
+
+
+def fingerprint_files(paths: Iterable[str]) -> List[Tuple[str, int, int]]:
+    """
+    The function fingerprints input files by their path, size and modification time, which is much cheaper than
+    hashing their content and changes whenever a file is rewritten.
+    :param paths: paths of the input files.
+    :return: sorted path, size and modification time (ns) of every file.
+    """
+    fingerprints = []
+    for path in sorted(paths):
+        stat = os.stat(path)
+        fingerprints.append((path, stat.st_size, stat.st_mtime_ns))
+    return fingerprints
+
+
+def code_version(*code) -> str:
+    """
+    The function hashes the source code of the functions, classes or modules of a transformation, and the queries (given
+    as strings) it runs, so that a stage is recomputed when its own code changes but not when the code of another stage
+    does.
+    """
+    digest = hashlib.sha256()
+    for code_object in code:
+        source = code_object if isinstance(code_object, str) else inspect.getsource(code_object)
+        digest.update(source.encode('utf-8'))
+    return digest.hexdigest()
+
+
+class StageCache:
+    """
+    Local cache of the stage outputs, an entry is a directory named after the key of the stage, the stage writes its
+    output in it. The entries are evicted in least recently used order once they take more than max_bytes.
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int = 1 << 30):
+        """
+        :param cache_dir: directory of the cache entries, created if needed.
+        :param max_bytes: size of the entries above which the least recently used ones are evicted.
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def get_key(stage_name: str, inputs: Any, parameters: Optional[dict] = None, code: Sequence[Any] = ()) -> str:
+        """
+        The function computes the content address of a stage output.
+        :param stage_name: name of the stage, e.g. 'songs'.
+        :param inputs: fingerprints of the input files of the stage, see fingerprint_files.
+        :param parameters: parameters of the stage, json serializable.
+        :param code: functions, classes or modules of the transformation of the stage, and the queries it runs.
+        :return: key of the stage output.
+        """
+        content = json.dumps({
+            'stage': stage_name,
+            'inputs': inputs,
+            'parameters': parameters or {},
+            'code': code_version(*code)
+        }, sort_keys=True, default=str)
+        return f"{stage_name}-{hashlib.sha256(content.encode('utf-8')).hexdigest()}"
+
+    def get(self, key: str) -> Optional[str]:
+        """
+        Looks an entry up, and marks it as the most recently used.
+        :return: directory of the entry, None if the stage has to be computed.
+        """
+        entry_dir = os.path.join(self.cache_dir, key)
+        if not os.path.isdir(entry_dir):
+            return None
+        os.utime(entry_dir)
+        return entry_dir
+
+    @contextmanager
+    def put(self, key: str):
+        """
+        Creates an entry, the stage writes its output in the yielded directory. The entry is only added to the cache if
+        the stage succeeds, so a failed stage never leaves a partial output behind.
+        """
+        temporary_dir = os.path.join(self.cache_dir, f".{key}.{os.getpid()}.tmp")
+        shutil.rmtree(temporary_dir, ignore_errors=True)
+        os.makedirs(temporary_dir)
+        try:
+            yield temporary_dir
+        except BaseException:
+            shutil.rmtree(temporary_dir, ignore_errors=True)
+            raise
+
+        entry_dir = os.path.join(self.cache_dir, key)
+        if os.path.isdir(entry_dir):
+            # the same output has been stored meanwhile
+            shutil.rmtree(temporary_dir)
+        else:
+            os.replace(temporary_dir, entry_dir)
+        self.evict()
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the entries take at most max_bytes.
+        """
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            entry_dir = os.path.join(self.cache_dir, name)
+            if name.startswith('.') or not os.path.isdir(entry_dir):
+                continue
+            entries.append((os.stat(entry_dir).st_mtime, self.__get_size(entry_dir), entry_dir))
+
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, entry_dir in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            print(f"Evicting stage cache entry {os.path.basename(entry_dir)} ({size} bytes)")
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total_bytes -= size
+
+    ####################################################################################################################
+    #                                                                                                                  #
+    #                                               Private functions                                                  #
+    #                                                                                                                  #
+    ####################################################################################################################
+
+    @staticmethod
+    def __get_size(entry_dir: str) -> int:
+        return sum(
+            os.path.getsize(os.path.join(directory, file_name))
+            for directory, _, file_names in os.walk(entry_dir)
+            for file_name in file_names
+        )
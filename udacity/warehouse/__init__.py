@@ -0,0 +1,42 @@
+"""
+Warehouse backends shared by the Sparkify loaders: the same star schema build runs against Postgres, Redshift or an
+embedded DuckDB database (the default for local development and benchmarks).
+The engine drivers are imported only when their backend is created, so psycopg2 or duckdb are only needed if used.
+"""
+from warehouse.backend import WarehouseBackend
+
+BACKEND_DUCKDB = 'duckdb'
+BACKEND_POSTGRES = 'postgres'
+BACKEND_REDSHIFT = 'redshift'
+
+BACKENDS = [BACKEND_DUCKDB, BACKEND_POSTGRES, BACKEND_REDSHIFT]
+
+
+def get_backend(name: str = BACKEND_DUCKDB, **kwargs) -> WarehouseBackend:
+    """
+    The function creates a backend by name.
+    :param name: one of BACKENDS.
+    :param kwargs: arguments of the backend (database for DuckDB, dsn for Postgres, dsn, iam_role and copy_options for
+    Redshift).
+    :return: backend connected to the engine.
+    """
+    if name == BACKEND_DUCKDB:
+        from warehouse.duckdb_backend import DuckDBBackend
+        return DuckDBBackend(**kwargs)
+    if name == BACKEND_POSTGRES:
+        from warehouse.postgres_backend import PostgresBackend
+        return PostgresBackend(**kwargs)
+    if name == BACKEND_REDSHIFT:
+        from warehouse.redshift_backend import RedshiftBackend
+        return RedshiftBackend(**kwargs)
+    raise ValueError(f"Unknown backend {name}, expected one of {BACKENDS}")
+
+
+__all__ = [
+    'WarehouseBackend',
+    'BACKEND_DUCKDB',
+    'BACKEND_POSTGRES',
+    'BACKEND_REDSHIFT',
+    'BACKENDS',
+    'get_backend'
+]
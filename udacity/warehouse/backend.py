@@ -0,0 +1,128 @@
+from abc import ABC, abstractmethod
+from typing import Any, List, Optional, Sequence
+
+
+def get_columns(data) -> List[str]:
+    """
+    Convenience method to get the column names of a pandas DataFrame or a pyarrow Table.
+    """
+    if hasattr(data, 'column_names'):
+        return list(data.column_names)
+    return list(data.columns)
+
+
+def keep_last_per_key(data, key_columns: Sequence[str]):
+    """
+    The function drops the rows of a pandas DataFrame or a pyarrow Table whose key appears again further down, so that
+    a merge applies the last row of every key as the row by row upserts would.
+    :param data: rows to deduplicate.
+    :param key_columns: columns of the key.
+    :return: rows with unique keys.
+    """
+    if not hasattr(data, 'column_names'):
+        return data.drop_duplicates(subset=list(key_columns), keep='last')
+
+    import pyarrow
+    import pyarrow.compute
+
+    row_numbers = data.append_column('__row_number', pyarrow.array(range(data.num_rows), pyarrow.int64()))
+    last_row_numbers = row_numbers.group_by(list(key_columns)).aggregate([('__row_number', 'max')])['__row_number_max']
+    # the rows are taken in their original order
+    return data.take(pyarrow.compute.take(last_row_numbers, pyarrow.compute.sort_indices(last_row_numbers)))
+
+
+class WarehouseBackend(ABC):
+    """
+    Interface of the engines the Sparkify star schema can be built in. The queries are written with the psycopg2
+    parameter style (%s and %(name)s), the backends of the engines with another style translate them.
+    The bulk loads and merges take a pandas DataFrame or a pyarrow Table whose column names match the table's.
+    """
+
+    @abstractmethod
+    def execute(self, query: str, parameters: Any = None) -> int:
+        """
+        Executes a statement.
+        :param query: statement to execute.
+        :param parameters: statement parameters.
+        :return: number of rows affected by the statement, -1 if unknown.
+        """
+
+    @abstractmethod
+    def fetch(self, query: str, parameters: Any = None) -> List[tuple]:
+        """
+        Executes a query and fetches all its rows.
+        """
+
+    @abstractmethod
+    def fetch_table(self, query: str, parameters: Any = None):
+        """
+        Executes a query and fetches all its rows as a pyarrow Table, with the column names of the query.
+        """
+
+    @abstractmethod
+    def bulk_load(self, table: str, data) -> int:
+        """
+        Appends the rows to the table with the engine's bulk load path.
+        :param table: table to load.
+        :param data: rows to load, the columns missing in the data get their default values.
+        :return: number of rows loaded.
+        """
+
+    @abstractmethod
+    def commit(self):
+        pass
+
+    @abstractmethod
+    def rollback(self):
+        pass
+
+    @abstractmethod
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def fetch_one(self, query: str, parameters: Any = None) -> Optional[tuple]:
+        rows = self.fetch(query, parameters)
+        return rows[0] if rows else None
+
+    def merge(self, table: str, data, key_columns: Sequence[str], update_columns: Optional[Sequence[str]] = None) -> int:
+        """
+        The function upserts the rows into the table: the rows of new keys are inserted, the rows of existing keys
+        update the update_columns (or are ignored if there are none). If a key appears several times in the data, its
+        last row is applied.
+        :param table: table to merge into, the key columns must be its primary key.
+        :param data: rows to merge.
+        :param key_columns: columns of the key.
+        :param update_columns: columns updated for the existing keys.
+        :return: number of rows inserted or updated.
+        """
+        columns = get_columns(data)
+        staging_table = f"{table}_merge_staging"
+        self.execute(f"DROP TABLE IF EXISTS {staging_table}")
+        self.execute(f"CREATE TEMP TABLE {staging_table} AS SELECT {', '.join(columns)} FROM {table} LIMIT 0")
+        self.bulk_load(staging_table, keep_last_per_key(data, key_columns))
+        row_count = self._merge_from_staging(table, staging_table, columns, key_columns, update_columns)
+        self.execute(f"DROP TABLE {staging_table}")
+        return row_count
+
+    def _merge_from_staging(self, table: str, staging_table: str, columns: Sequence[str],
+                            key_columns: Sequence[str], update_columns: Optional[Sequence[str]]) -> int:
+        """
+        Merges a staging table with unique keys into the table with INSERT ... ON CONFLICT, the engines without it
+        override this function.
+        """
+        column_list = ', '.join(columns)
+        if update_columns:
+            conflict_action = 'DO UPDATE SET ' + ', '.join(f"{column} = excluded.{column}" for column in update_columns)
+        else:
+            conflict_action = 'DO NOTHING'
+        return self.execute(f"""
+            INSERT INTO {table} ({column_list})
+            SELECT {column_list} FROM {staging_table}
+            ON CONFLICT ({', '.join(key_columns)}) {conflict_action}
+        """)
@@ -0,0 +1,81 @@
+import re
+from typing import Any, List, Tuple
+
+import duckdb
+
+from warehouse.backend import WarehouseBackend, get_columns
+
+PARAMETER_PATTERN = re.compile(r"%\((\w+)\)s|%s|%%")
+
+
+def translate_query(query: str, parameters: Any = None) -> Tuple[str, Any]:
+    """
+    The function translates a query with psycopg2 parameters (%(name)s, %s and %% for a literal %) to DuckDB's $name and
+    ? parameters. DuckDB does not accept the named parameters the query does not use, so they are left out.
+    :param query: query with psycopg2 parameters.
+    :param parameters: sequence or dict of parameters.
+    :return: DuckDB query and parameters.
+    """
+    names = []
+
+    def translate(match):
+        if match.group(0) == '%%':
+            return '%'
+        if match.group(1):
+            names.append(match.group(1))
+            return f"${match.group(1)}"
+        return '?'
+
+    duckdb_query = PARAMETER_PATTERN.sub(translate, query)
+    if isinstance(parameters, dict):
+        parameters = {name: parameters[name] for name in names}
+    return duckdb_query, parameters
+
+
+class DuckDBBackend(WarehouseBackend):
+    """
+    Backend of an embedded DuckDB database, the default for local development and benchmarks: the star schema is built
+    in-process, with no database server. The bulk loads scan the DataFrame or Table in place.
+    As with psycopg2, the statements run in a transaction until commit or rollback.
+    """
+
+    def __init__(self, database: str = 'sparkify.duckdb'):
+        """
+        :param database: path of the database file, ':memory:' for an in-memory database.
+        """
+        self.conn = duckdb.connect(database)
+        self.conn.begin()
+
+    def execute(self, query: str, parameters: Any = None) -> int:
+        result = self.conn.execute(*translate_query(query, parameters))
+        # the data modification statements return their row count as the single "Count" column, DDL statements return
+        # the column with no rows
+        if result.description and result.description[0][0] == 'Count':
+            row = result.fetchone()
+            return row[0] if row else -1
+        return -1
+
+    def fetch(self, query: str, parameters: Any = None) -> List[tuple]:
+        return self.conn.execute(*translate_query(query, parameters)).fetchall()
+
+    def fetch_table(self, query: str, parameters: Any = None):
+        return self.conn.execute(*translate_query(query, parameters)).fetch_arrow_table()
+
+    def bulk_load(self, table: str, data) -> int:
+        column_list = ', '.join(get_columns(data))
+        self.conn.register('bulk_load_data', data)
+        try:
+            return self.execute(f"INSERT INTO {table} ({column_list}) SELECT {column_list} FROM bulk_load_data")
+        finally:
+            self.conn.unregister('bulk_load_data')
+
+    def commit(self):
+        self.conn.commit()
+        self.conn.begin()
+
+    def rollback(self):
+        self.conn.rollback()
+        self.conn.begin()
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,156 @@
+import io
+import struct
+from typing import Dict, Iterable, Iterator, Optional
+
+import numpy
+import pyarrow
+import pyarrow.compute
+
+PG_COPY_SIGNATURE = b'PGCOPY\n\377\r\n\0'
+PG_COPY_HEADER = PG_COPY_SIGNATURE + struct.pack('>ii', 0, 0)
+PG_COPY_TRAILER = struct.pack('>h', -1)
+
+# arrow type and big-endian numpy type of the fixed-width Postgres types, text columns are written as utf-8
+PG_FIXED_WIDTH_TYPES = {
+    'smallint': (pyarrow.int16(), '>i2'),
+    'integer': (pyarrow.int32(), '>i4'),
+    'bigint': (pyarrow.int64(), '>i8'),
+    'real': (pyarrow.float32(), '>f4'),
+    'double precision': (pyarrow.float64(), '>f8'),
+    'boolean': (pyarrow.bool_(), '>u1')
+}
+PG_TEXT_TYPES = {'text', 'character varying'}
+
+
+def is_supported(pg_type: str) -> bool:
+    """
+    Convenience method to check if a column of the Postgres type can be written by encode_batch.
+    """
+    return pg_type in PG_FIXED_WIDTH_TYPES or pg_type.split('(')[0] in PG_TEXT_TYPES
+
+
+def encode_batch(batch: pyarrow.RecordBatch, pg_types: Dict[str, str]) -> bytes:
+    """
+    The function encodes the rows of a record batch as tuples of the binary COPY format, with numpy operations over
+    whole columns: no Python object is created per row or per value.
+    Every tuple is a 16 bit field count, then per field a 32 bit length (-1 for null) and the value in network order.
+    :param batch: rows to encode.
+    :param pg_types: Postgres type of every column of the batch, e.g. {'user_id': 'integer'}.
+    :return: encoded tuples, without the header and trailer of the COPY stream.
+    """
+    row_count = batch.num_rows
+    columns = []
+    field_sizes = []
+    for name in batch.schema.names:
+        column, sizes = _prepare_column(batch.column(name), pg_types[name])
+        columns.append(column)
+        field_sizes.append(sizes)
+
+    # offset of the first field of every row, then of every field within the buffer
+    row_sizes = 2 + numpy.sum(field_sizes, axis=0, dtype=numpy.int64) if field_sizes else numpy.full(row_count, 2)
+    row_offsets = numpy.concatenate(([0], numpy.cumsum(row_sizes)[:-1])).astype(numpy.int64)
+    buffer = numpy.zeros(int(row_sizes.sum()), dtype=numpy.uint8)
+
+    _scatter(buffer, row_offsets, numpy.full(row_count, len(columns), dtype='>i2'))
+    field_offsets = row_offsets + 2
+    for column, sizes in zip(columns, field_sizes):
+        _write_field(buffer, field_offsets, column)
+        field_offsets = field_offsets + sizes
+    return buffer.tobytes()
+
+
+class BinaryCopyStream(io.RawIOBase):
+    """
+    File-like object psycopg2's copy_expert reads a binary COPY stream from. The record batches are encoded one at a
+    time as the cursor reads, so only one encoded batch is held in memory.
+    """
+
+    def __init__(self, batches: Iterable[pyarrow.RecordBatch], pg_types: Dict[str, str]):
+        """
+        :param batches: record batches to stream.
+        :param pg_types: Postgres type of every column of the batches.
+        """
+        super(BinaryCopyStream, self).__init__()
+        self.__chunks = self.__generate_chunks(batches, pg_types)
+        self.__pending = b''
+
+    def readable(self) -> bool:
+        return True
+
+    def read(self, size: Optional[int] = -1) -> bytes:
+        while size is None or size < 0 or len(self.__pending) < size:
+            chunk = next(self.__chunks, None)
+            if chunk is None:
+                break
+            self.__pending += chunk
+        if size is None or size < 0:
+            size = len(self.__pending)
+        data, self.__pending = self.__pending[:size], self.__pending[size:]
+        return data
+
+    @staticmethod
+    def __generate_chunks(batches: Iterable[pyarrow.RecordBatch], pg_types: Dict[str, str]) -> Iterator[bytes]:
+        yield PG_COPY_HEADER
+        for batch in batches:
+            yield encode_batch(batch, pg_types)
+        yield PG_COPY_TRAILER
+
+
+########################################################################################################################
+#                                                                                                                      #
+#                                               Private functions                                                      #
+#                                                                                                                      #
+########################################################################################################################
+
+
+def _prepare_column(column: pyarrow.Array, pg_type: str):
+    """
+    Casts the column to the Arrow type of the Postgres type and computes the size of its field in every row.
+    """
+    is_valid = column.is_valid().to_numpy(zero_copy_only=False)
+    if pg_type in PG_FIXED_WIDTH_TYPES:
+        arrow_type, numpy_type = PG_FIXED_WIDTH_TYPES[pg_type]
+        column = column.cast(arrow_type)
+        sizes = numpy.where(is_valid, 4 + numpy.dtype(numpy_type).itemsize, 4)
+        return (column, is_valid, numpy_type), sizes
+    if pg_type.split('(')[0] in PG_TEXT_TYPES:
+        column = column.cast(pyarrow.string())
+        lengths = pyarrow.compute.fill_null(pyarrow.compute.binary_length(column), 0).to_numpy().astype(numpy.int64)
+        return (column, is_valid, None), 4 + lengths
+    raise ValueError(f"Binary COPY of {pg_type} columns is not supported")
+
+
+def _write_field(buffer: numpy.ndarray, field_offsets: numpy.ndarray, prepared):
+    """
+    Writes the length and the value of the column's field in every row, the fields start at the field offsets.
+    """
+    column, is_valid, numpy_type = prepared
+    if numpy_type is not None:
+        values = pyarrow.compute.fill_null(column, False if numpy_type == '>u1' else 0).to_numpy(zero_copy_only=False)
+        lengths = numpy.where(is_valid, numpy.dtype(numpy_type).itemsize, -1).astype('>i4')
+        _scatter(buffer, field_offsets, lengths)
+        _scatter(buffer, (field_offsets + 4)[is_valid], values[is_valid].astype(numpy_type))
+        return
+
+    lengths = pyarrow.compute.fill_null(pyarrow.compute.binary_length(column), 0).to_numpy().astype(numpy.int64)
+    _scatter(buffer, field_offsets, numpy.where(is_valid, lengths, -1).astype('>i4'))
+
+    # the utf-8 bytes of all the values are copied in one go from the string data buffer
+    _, value_offsets, data = column.buffers()
+    source_starts = numpy.frombuffer(value_offsets, dtype=numpy.int32)[column.offset:column.offset + len(column)]
+    total_length = int(lengths.sum())
+    if total_length == 0:
+        return
+    shift = numpy.repeat(field_offsets + 4 - numpy.cumsum(lengths) + lengths, lengths)
+    source_shift = numpy.repeat(source_starts.astype(numpy.int64) - numpy.cumsum(lengths) + lengths, lengths)
+    positions = numpy.arange(total_length, dtype=numpy.int64)
+    buffer[shift + positions] = numpy.frombuffer(data, dtype=numpy.uint8)[source_shift + positions]
+
+
+def _scatter(buffer: numpy.ndarray, offsets: numpy.ndarray, values: numpy.ndarray):
+    """
+    Writes the bytes of every value at its offset of the buffer.
+    """
+    width = values.dtype.itemsize
+    value_bytes = numpy.ascontiguousarray(values).view(numpy.uint8).reshape(-1, width)
+    buffer[offsets[:, None] + numpy.arange(width)] = value_bytes
@@ -0,0 +1,124 @@
+import io
+from typing import Any, Dict, List
+
+import psycopg2
+
+from warehouse.backend import WarehouseBackend, get_columns
+
+
+class PostgresBackend(WarehouseBackend):
+    """
+    Backend of a Postgres database, the bulk loads are streamed with COPY FROM STDIN: the pyarrow Tables in the binary
+    format, encoded column by column from the Arrow buffers, the pandas DataFrames as csv.
+    """
+
+    def __init__(self, dsn: str, batch_size: int = 65536):
+        """
+        :param dsn: libpq connection string, e.g. "host=127.0.0.1 dbname=sparkifydb user=student password=student".
+        :param batch_size: rows encoded at a time by the binary bulk loads.
+        """
+        self.conn = psycopg2.connect(dsn)
+        self.cur = self.conn.cursor()
+        self.batch_size = batch_size
+
+    def execute(self, query: str, parameters: Any = None) -> int:
+        self.cur.execute(query, parameters)
+        return self.cur.rowcount
+
+    def fetch(self, query: str, parameters: Any = None) -> List[tuple]:
+        self.cur.execute(query, parameters)
+        return self.cur.fetchall()
+
+    def fetch_table(self, query: str, parameters: Any = None):
+        import pyarrow
+
+        rows = self.fetch(query, parameters)
+        columns = []
+        for i, column in enumerate(self.cur.description):
+            # the columns are typed from the result description, so that an empty result keeps its column types
+            arrow_type = get_arrow_type(column.type_code)
+            if arrow_type is None and not rows:
+                arrow_type = pyarrow.string()
+            columns.append(pyarrow.array([row[i] for row in rows], type=arrow_type))
+        return pyarrow.table(columns, names=[column.name for column in self.cur.description])
+
+    def bulk_load(self, table: str, data) -> int:
+        columns = get_columns(data)
+        if hasattr(data, 'column_names'):
+            from warehouse.pgcopy import BinaryCopyStream, is_supported
+
+            pg_types = self.get_column_types(table)
+            if all(is_supported(pg_types[column]) for column in columns):
+                self.cur.copy_expert(
+                    f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT binary)",
+                    BinaryCopyStream(data.to_batches(max_chunksize=self.batch_size), pg_types)
+                )
+                return self.cur.rowcount
+
+        self.cur.copy_expert(
+            f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)",
+            io.StringIO(to_csv(data))
+        )
+        return self.cur.rowcount
+
+    def get_column_types(self, table: str) -> Dict[str, str]:
+        """
+        The function gets the type of every column of the table as the binary format needs the exact column types.
+        :param table: table name, resolved with the search path so that temporary tables are found too.
+        :return: type name of every column, e.g. {'user_id': 'integer', 'first_name': 'text'}.
+        """
+        return dict(self.fetch("""
+            SELECT attname, format_type(atttypid, atttypmod)
+            FROM pg_attribute
+            WHERE attrelid = %s::regclass AND attnum > 0 AND NOT attisdropped
+        """, (table,)))
+
+    def commit(self):
+        self.conn.commit()
+
+    def rollback(self):
+        self.conn.rollback()
+
+    def close(self):
+        self.conn.close()
+
+
+# type oids of the result columns -> pyarrow type names, the other types are inferred from the values
+PG_ARROW_TYPES = {
+    16: 'bool',
+    20: 'int64',
+    21: 'int16',
+    23: 'int32',
+    700: 'float32',
+    701: 'float64',
+    19: 'string',
+    25: 'string',
+    1042: 'string',
+    1043: 'string',
+    1082: 'date32',
+    1114: 'timestamp[us]'
+}
+
+
+def get_arrow_type(type_oid: int):
+    """
+    Convenience method to get the pyarrow type of a result column from its type oid, None if it is inferred.
+    """
+    import pyarrow
+
+    type_name = PG_ARROW_TYPES.get(type_oid)
+    return pyarrow.type_for_alias(type_name) if type_name else None
+
+
+def to_csv(data) -> str:
+    """
+    Convenience method to get the rows of a pandas DataFrame or a pyarrow Table as csv without header, the nulls are
+    written as unquoted empty values as COPY expects them.
+    """
+    if hasattr(data, 'column_names'):
+        import pyarrow.csv
+
+        buffer = io.BytesIO()
+        pyarrow.csv.write_csv(data, buffer, write_options=pyarrow.csv.WriteOptions(include_header=False))
+        return buffer.getvalue().decode('utf-8')
+    return data.to_csv(index=False, header=False)
@@ -0,0 +1,72 @@
+from typing import Optional, Sequence
+
+from psycopg2.extras import execute_values
+
+from warehouse.backend import get_columns
+from warehouse.postgres_backend import PostgresBackend
+
+
+class RedshiftBackend(PostgresBackend):
+    """
+    Backend of a Redshift cluster. Redshift has no COPY FROM STDIN, so the bulk loads copy from s3 (the data is given as
+    an s3 path) and the in-memory rows are inserted in multi-row INSERT batches. Redshift has no INSERT ... ON CONFLICT
+    either, the merges delete the existing keys and insert the staged rows in the same transaction.
+    """
+
+    def __init__(self, dsn: str, iam_role: Optional[str] = None, copy_options: str = '', page_size: int = 1000):
+        """
+        :param dsn: libpq connection string of the cluster.
+        :param iam_role: ARN of the role the cluster reads s3 with.
+        :param copy_options: format and load options of the COPY from s3, e.g. "FORMAT AS JSON 'auto' REGION 'us-west-2'".
+        :param page_size: rows per INSERT statement for the in-memory rows.
+        """
+        super(RedshiftBackend, self).__init__(dsn)
+        self.iam_role = iam_role
+        self.copy_options = copy_options
+        self.page_size = page_size
+
+    def bulk_load(self, table: str, data) -> int:
+        if isinstance(data, str):
+            self.execute(f"COPY {table} FROM '{data}' IAM_ROLE '{self.iam_role}' {self.copy_options}")
+            return self.fetch_one("SELECT pg_last_copy_count()")[0]
+
+        columns = get_columns(data)
+        rows = data.to_pylist() if hasattr(data, 'to_pylist') else data.to_dict('records')
+        execute_values(
+            self.cur,
+            f"INSERT INTO {table} ({', '.join(columns)}) VALUES %s",
+            [tuple(row[column] for column in columns) for row in rows],
+            page_size=self.page_size
+        )
+        return len(rows)
+
+    def merge(self, table: str, data, key_columns: Sequence[str], update_columns: Optional[Sequence[str]] = None) -> int:
+        """
+        Upserts the rows as WarehouseBackend.merge does, an s3 path is copied into the staging table with all the
+        columns of the table, its keys are expected to be unique.
+        """
+        if not isinstance(data, str):
+            return super(RedshiftBackend, self).merge(table, data, key_columns, update_columns)
+
+        staging_table = f"{table}_merge_staging"
+        self.execute(f"DROP TABLE IF EXISTS {staging_table}")
+        self.execute(f"CREATE TEMP TABLE {staging_table} (LIKE {table})")
+        self.bulk_load(staging_table, data)
+        self.execute(f"SELECT * FROM {table} LIMIT 0")
+        columns = [column.name for column in self.cur.description]
+        row_count = self._merge_from_staging(table, staging_table, columns, key_columns, update_columns)
+        self.execute(f"DROP TABLE {staging_table}")
+        return row_count
+
+    def _merge_from_staging(self, table: str, staging_table: str, columns: Sequence[str],
+                            key_columns: Sequence[str], update_columns: Optional[Sequence[str]]) -> int:
+        key_condition = ' AND '.join(f"{table}.{column} = {staging_table}.{column}" for column in key_columns)
+        if update_columns:
+            # the staged rows replace the existing ones as a whole, the update columns are expected to be all the
+            # staged columns but the key
+            self.execute(f"DELETE FROM {table} USING {staging_table} WHERE {key_condition}")
+        else:
+            # the existing keys are kept as they are
+            self.execute(f"DELETE FROM {staging_table} USING {table} WHERE {key_condition}")
+        column_list = ', '.join(columns)
+        return self.execute(f"INSERT INTO {table} ({column_list}) SELECT {column_list} FROM {staging_table}")